@@ -2,12 +2,26 @@
 CSC 361 Programming Assignment 1
 A simple HTTP server that accepts only GET requests.
 
-Args: IP to use; Port to use
+Requests are recorded in an access log, one line of JSON per request, which is
+written by a background thread so that serving never waits on the terminal or
+disk. Every few seconds the log also gets a summary of the latencies of the
+requests served since the last one, by status code.
+
+Args: IP to use; Port to use; Access log file (optional, default stdout)
 '''
 
+import bisect
+import json
 import os
 import socket as soc
 import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
 
 httpCodeDescriptions = {
     200: 'OK',
@@ -18,6 +32,147 @@ httpCodeDescriptions = {
     501: 'Not Implemented'
 }
 
+ACCESS_LOG_QUEUE_SIZE = 10000 # Records waiting to be written; more are dropped
+ACCESS_LOG_BATCH_SIZE = 100 # Most records written at once
+SUMMARY_INTERVAL = 10 # Seconds between latency summaries
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BOUNDS_MS = [0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+                     5000, 10000]
+
+'''
+Counts of request latencies in buckets bounded by LATENCY_BOUNDS_MS, plus one
+for anything slower.
+'''
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+        self.count = 0
+        self.maxMs = 0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.maxMs = max(self.maxMs, ms)
+
+    '''
+    An upper bound on the pth percentile latency: the bound of the bucket it
+    falls in, or the slowest latency seen if that is lower.
+    '''
+    def percentile(self, p):
+        rank = max(1, p / 100.0 * self.count)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and i < len(LATENCY_BOUNDS_MS):
+                return min(LATENCY_BOUNDS_MS[i], self.maxMs)
+        return self.maxMs
+
+'''
+Writes access log records on a background thread. Records are queued by
+log(), which never blocks (if the writer falls too far behind, records are
+dropped and counted instead), and written in batches as lines of JSON:
+
+    {"bytes": 95, "client": "127.0.0.1:51234", "duration_ms": 0.412,
+     "path": "/hello.html", "status": 200, "time": 1792401173.531}
+
+The writer keeps a LatencyHistogram per status code, and every interval
+seconds writes a summary of the requests logged, and of the records dropped,
+since the last one:
+
+    {"dropped": 0, "interval_s": 10,
+     "summary": {"200": {"count": 812, "max_ms": 31.2, "p50_ms": 1,
+                         "p90_ms": 2.5, "p99_ms": 25}}}
+'''
+class AccessLog(threading.Thread):
+    def __init__(self, output=sys.stdout, interval=SUMMARY_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.output = output
+        self.interval = interval
+        self.records = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+        self.dropped = 0 # Since startup
+        self.droppedReported = 0 # As of the last summary
+        self.histograms = {}
+
+    '''
+    Queues a record of a request served. Path is None if the request had none.
+    '''
+    def log(self, clientAdr, path, status, nbytes, duration):
+        try:
+            self.records.put_nowait(
+                (time.time(), clientAdr, path, status, nbytes, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    '''
+    Writes any records still queued and a last summary, then stops the writer.
+    '''
+    def close(self):
+        self.records.put(None)
+        self.join()
+
+    def run(self):
+        nextSummary = time.time() + self.interval
+        done = False
+        while not done:
+            # Wait for a record, but no longer than until the next summary
+            batch = []
+            try:
+                batch.append(self.records.get(
+                    timeout=max(0, nextSummary - time.time())))
+                while len(batch) < ACCESS_LOG_BATCH_SIZE:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                done = True
+            lines = [self.formatRecord(record) for record in batch]
+            if done or time.time() >= nextSummary:
+                if self.histograms or self.dropped != self.droppedReported:
+                    lines.append(self.formatSummary())
+                nextSummary = time.time() + self.interval
+
+            if lines:
+                self.output.write('\n'.join(lines) + '\n')
+                self.output.flush()
+
+    def formatRecord(self, record):
+        loggedAt, clientAdr, path, status, nbytes, duration = record
+        durationMs = duration * 1000
+        if status not in self.histograms:
+            self.histograms[status] = LatencyHistogram()
+        self.histograms[status].observe(durationMs)
+        return json.dumps({'time': round(loggedAt, 3),
+                           'client': '{}:{}'.format(*clientAdr),
+                           'path': path,
+                           'status': status,
+                           'bytes': nbytes,
+                           'duration_ms': round(durationMs, 3)},
+                          sort_keys=True)
+
+    '''
+    Summarises and resets the histograms, and counts the records dropped since
+    the last summary. The running total is only ever added to by log(), so
+    that a drop while the summary is written is not lost.
+    '''
+    def formatSummary(self):
+        total = self.dropped
+        dropped, self.droppedReported = total - self.droppedReported, total
+        summary = {}
+        for status, histogram in self.histograms.items():
+            summary[str(status)] = dict(
+                [('p{}_ms'.format(p), round(histogram.percentile(p), 3))
+                 for p in (50, 90, 99)],
+                count=histogram.count, max_ms=round(histogram.maxMs, 3))
+        self.histograms = {}
+        return json.dumps({'summary': summary,
+                           'interval_s': self.interval,
+                           'dropped': dropped},
+                          sort_keys=True)
+
 '''
 Creates an HTTP header for the given response code.
 This includes two CRLF's at the end. 
@@ -30,17 +185,16 @@ def getHeader(code=200):
 
 '''
 Responds to a GET request for the specified file.
+Returns the response code and the number of bytes sent.
 '''
 def handleGetRequest(filename, clientSocket):
     # Do not allow clients to query server source code.
     if filename == os.path.basename(__file__):
-        clientSocket.send(getHeader(403))
-        return
+        return 403, clientSocket.send(getHeader(403))
 
     # Ensure file exists
     if not os.path.isfile(filename):
-        clientSocket.send(getHeader(404))
-        return
+        return 404, clientSocket.send(getHeader(404))
 
     # Process get request
     try:
@@ -48,22 +202,25 @@ def handleGetRequest(filename, clientSocket):
         outputdata = file.read()        
         file.close()
 
-        clientSocket.send(getHeader(200))
+        header = getHeader(200)
+        clientSocket.send(header)
         clientSocket.sendall(outputdata)
+        return 200, len(header) + len(outputdata)
     
     except IOError:
-        clientSocket.send(getHeader(500)) # Server error
+        return 500, clientSocket.send(getHeader(500)) # Server error
 
 '''
 The "main" loop of the program. This method services client connections until 
 the server process is terminated.
 '''
-def serve(serverSocket, ip, port):
+def serve(serverSocket, ip, port, accessLog):
+    print('Ready to serve on {}:{} ...'.format(ip, port))
     while True:
         # Establish the connection
-        print('Ready to serve on {}:{} ...'.format(ip, port))
         clientSocket, clientAdr = serverSocket.accept()
-        print('Serving client {}'.format(clientAdr))                 
+        start = time.time()
+        path = None
 
         # Get client request
         BUFFER_SIZE = 1024
@@ -72,17 +229,19 @@ def serve(serverSocket, ip, port):
 
         if not msgTokens: 
             # Ensure that there is content to parse
-            clientSocket.send(getHeader(400))
+            code, nbytes = 400, clientSocket.send(getHeader(400))
         elif msgTokens[0] != "GET": 
             # Only GET requests are implemented
-            clientSocket.send(getHeader(501))
+            code, nbytes = 501, clientSocket.send(getHeader(501))
         else:
-            filename = msgTokens[1][1:] # Assume leading slash
-            handleGetRequest(filename, clientSocket)
+            path = msgTokens[1]
+            filename = path[1:] # Assume leading slash
+            code, nbytes = handleGetRequest(filename, clientSocket)
 
         clientSocket.close()
+        accessLog.log(clientAdr, path, code, nbytes, time.time() - start)
 
-def main(ip, port=80):
+def main(ip, port=80, accessLogFile=None):
     # Create, bind the socket
     serverSocket = soc.socket(soc.AF_INET, soc.SOCK_STREAM)
     serverSocket.bind((ip, port))
@@ -90,14 +249,22 @@ def main(ip, port=80):
     BACKLOG = 5 # Conventional queue size 
     serverSocket.listen(BACKLOG)
 
+    output = open(accessLogFile, 'a') if accessLogFile else sys.stdout
+    accessLog = AccessLog(output)
+    accessLog.start()
+
     try:
-        serve(serverSocket, ip, port)
+        serve(serverSocket, ip, port, accessLog)
     except:
          # Catch and re-raise any unexpected exception (such as 
          # user interrupt) after closing the server's socket 
          raise
     finally:
         serverSocket.close() 
+        accessLog.close()
+        if accessLogFile:
+            output.close()
 
 if __name__ == '__main__':
-    main(str(sys.argv[1]), int(sys.argv[2]))
+    accessLogFile = sys.argv[3] if len(sys.argv) > 3 else None
+    main(str(sys.argv[1]), int(sys.argv[2]), accessLogFile)
@@ -0,0 +1,386 @@
+"""
+    Throughput and latency benchmarks for RDP over loopback.
+
+    For each combination of transport, file size, concurrency level and loss
+    rate, a fresh `RDP_Server.Server` process is started and `concurrency`
+    clients fetch the same file from it simultaneously. The transport is UDP
+    over loopback, or `AF_UNIX` datagram sockets (`unix`) with their larger
+    packets. With a non-zero loss rate the clients reach a UDP server through
+    an `RDP_Impairment.LossyProxy` which drops that fraction of the datagrams
+    in each direction; loss is not simulated for `unix`. Throughput, time to
+    first byte, completion time, CPU time and peak RSS are recorded and
+    written to a JSON file, and optionally compared against a stored baseline.
+
+    Peak RSS is the high-water mark of the case alone: the server's is read
+    from its own process just before it is stopped, and the clients' peak is
+    reset before each case. Both come from `/proc`, so are `null` on platforms
+    without it:
+
+        python3 -m a3.bench.RDP_Benchmark --output results.json
+        python3 -m a3.bench.RDP_Benchmark --baseline results.json
+        python3 -m a3.bench.RDP_Benchmark --sizes 64K --loss 0,0.01,0.05 --fec 8
+        python3 -m a3.bench.RDP_Benchmark --sizes 1M,64M --transport udp,unix
+
+    The comparison exits with a non-zero status if any case regressed by more
+    than the tolerance.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+from a3.bench.RDP_Impairment import LossyProxy
+from a3.src import RDP_Client, RDP_Pacing
+from a3.src.RDP_Server import Server
+
+LOOPBACK_IP = "127.0.0.1"
+
+TRANSPORT_UDP = "udp"
+TRANSPORT_UNIX = "unix"
+
+DEFAULT_TRANSPORTS = TRANSPORT_UDP
+DEFAULT_SIZES = "0,1K,64K,1M"
+DEFAULT_CONCURRENCY = "1,2,4"
+DEFAULT_LOSS = "0"
+DEFAULT_TOLERANCE = 0.2
+
+SERVER_START_TIMEOUT = 5
+FILE_WRITE_BLOCK = 1 << 20
+
+_SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    """ Parses a byte count such as `512`, `64K`, `1M` or `1G`.
+    """
+    text = text.strip().upper()
+    multiplier = _SIZE_SUFFIXES.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(text) * multiplier
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((LOOPBACK_IP, 0))
+        return sock.getsockname()[1]
+
+
+def _run_server(adr, directory, server_options, ready):
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(directory)
+    server = Server(adr, **server_options)
+    server.serve(ready)
+
+
+def _peak_rss_kb(pid="self"):
+    """ The peak resident set size of a process in KiB, or `None` if it is
+    not available.
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """ Resets this process's peak resident set size to its current size.
+
+    :return: False if it could not be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _create_file(path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, FILE_WRITE_BLOCK)
+            f.write(os.urandom(block))
+            remaining -= block
+
+
+def fetch(server_adr, filename, options=None):
+    """ Fetches a file over a new connection from an ephemeral port.
+
+    :return: A dict of timings, or `None` if the transfer failed
+    """
+    start = time.monotonic()
+    with RDP_Client.create_socket_for(server_adr) as sock:
+        connection = None
+        for _ in range(RDP_Client.STREAM_CONNECT_ATTEMPTS):
+            connection = RDP_Client.connect_to_server(
+                server_adr, sock, options, linger=RDP_Client.LINGER)
+            if connection:
+                break
+        if not connection:
+            return None
+
+        content = RDP_Client.get_from_server(filename, connection)
+        end = time.monotonic()
+        if content is None:
+            return None
+
+        return {
+            "bytes": len(content),
+            "ttfb": connection.first_data_at - start,
+            "completion": end - start,
+        }
+
+
+def run_case(size, concurrency, directory, client_options=None,
+             server_options=None, loss=0.0, seed=0, transport=TRANSPORT_UDP):
+    """ Runs a single benchmark case against a fresh server process.
+
+    :param loss The fraction of datagrams to drop in each direction
+    :param seed Seeds the choice of datagrams to drop
+    :param transport `TRANSPORT_UDP` or `TRANSPORT_UNIX`
+    """
+    if loss and transport != TRANSPORT_UDP:
+        raise ValueError("Loss is only simulated over UDP")
+    filename = "bench-{}.bin".format(size)
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        _create_file(path, size)
+
+    if transport == TRANSPORT_UNIX:
+        adr = os.path.join(directory, "rdp.sock")
+    else:
+        adr = (LOOPBACK_IP, _free_port())
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=_run_server,
+        args=(adr, directory, server_options or {}, ready),
+        daemon=True)
+
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server.start()
+    try:
+        if not ready.wait(SERVER_START_TIMEOUT):
+            raise RuntimeError("Server did not start")
+
+        proxy = LossyProxy(adr, loss, seed) if loss else None
+        client_adr = proxy.adr if proxy else adr
+        if proxy:
+            proxy.start()
+
+        client_rss_reset = _reset_peak_rss()
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            futures = [pool.submit(fetch, client_adr, filename, client_options)
+                       for _ in range(concurrency)]
+            transfers = [f.result() for f in futures]
+        elapsed = time.monotonic() - start
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        client_peak_rss = _peak_rss_kb() if client_rss_reset else None
+        server_peak_rss = _peak_rss_kb(server.pid)
+        if proxy:
+            proxy.stop()
+    finally:
+        server.terminate()
+        server.join()
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    succeeded = [t for t in transfers if t and t["bytes"] == size]
+    result = {
+        "transport": transport,
+        "size": size,
+        "concurrency": concurrency,
+        "loss": loss,
+        "transfers": len(transfers),
+        "failures": len(transfers) - len(succeeded),
+        "wall_seconds": elapsed,
+        "throughput_bytes_per_second":
+            sum(t["bytes"] for t in succeeded) / elapsed if elapsed else None,
+        "client_cpu_seconds": _cpu(self_after) - _cpu(self_before),
+        "server_cpu_seconds": _cpu(children_after) - _cpu(children_before),
+        "client_peak_rss_kb": client_peak_rss,
+        "server_peak_rss_kb": server_peak_rss,
+    }
+    for key in ["ttfb", "completion"]:
+        values = [t[key] for t in succeeded]
+        result[key + "_seconds_median"] = \
+            statistics.median(values) if values else None
+        result[key + "_seconds_max"] = max(values) if values else None
+    return result
+
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_benchmarks(sizes, concurrency_levels, client_options=None,
+                   server_options=None, loss_rates=(0.0,),
+                   transports=(TRANSPORT_UDP,)):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for transport in transports:
+            for size in sizes:
+                for concurrency in concurrency_levels:
+                    for loss in loss_rates:
+                        if loss and transport != TRANSPORT_UDP:
+                            continue
+                        result = run_case(size, concurrency, directory,
+                                          client_options, server_options,
+                                          loss, transport=transport)
+                        results.append(result)
+                        print(_format_result(result))
+                        sys.stdout.flush()
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+        },
+        "client_options": client_options or {},
+        "server_options": server_options or {},
+        "results": results,
+    }
+
+
+def _format_result(result):
+    throughput = result["throughput_bytes_per_second"]
+    completion = result["completion_seconds_median"]
+    return ("{:<4} size={:>11} concurrency={:>3} loss={:<5} failures={:>3} "
+            "throughput={:>12} B/s completion(median)={} s"
+            .format(result.get("transport", TRANSPORT_UDP),
+                    result["size"], result["concurrency"],
+                    result.get("loss", 0), result["failures"],
+                    "-" if throughput is None else "{:.0f}".format(throughput),
+                    "-" if completion is None
+                    else "{:.4f}".format(completion)))
+
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """ Compares benchmark results with a baseline report.
+
+    A case regresses if its throughput dropped, or its median completion time
+    rose, by more than `tolerance` (a fraction), or if it has more failures.
+
+    :return: A list of human readable regression descriptions
+    """
+    def key(result):
+        return result.get("transport", TRANSPORT_UDP), result["size"], \
+            result["concurrency"], result.get("loss", 0)
+
+    baseline_results = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = baseline_results.get(key(result))
+        if not old:
+            continue
+        name = "{} size={} concurrency={} loss={}".format(*key(result))
+
+        if result["failures"] > old["failures"]:
+            regressions.append("{}: failures {} -> {}".format(
+                name, old["failures"], result["failures"]))
+
+        new_tp = result["throughput_bytes_per_second"]
+        old_tp = old["throughput_bytes_per_second"]
+        if new_tp is not None and old_tp and \
+                new_tp < old_tp * (1 - tolerance):
+            regressions.append("{}: throughput {:.0f} -> {:.0f} B/s".format(
+                name, old_tp, new_tp))
+
+        new_ct = result["completion_seconds_median"]
+        old_ct = old["completion_seconds_median"]
+        if new_ct is not None and old_ct and \
+                new_ct > old_ct * (1 + tolerance):
+            regressions.append("{}: completion {:.4f} -> {:.4f} s".format(
+                name, old_ct, new_ct))
+    return regressions
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.bench.RDP_Benchmark")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="Comma separated file sizes, e.g. 0,1K,1M,1G "
+                             "(default {})".format(DEFAULT_SIZES))
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY,
+                        help="Comma separated numbers of simultaneous clients "
+                             "(default {})".format(DEFAULT_CONCURRENCY))
+    parser.add_argument("--loss", default=DEFAULT_LOSS,
+                        help="Comma separated fractions of datagrams to drop "
+                             "in each direction (default {})"
+                        .format(DEFAULT_LOSS))
+    parser.add_argument("--transport", default=DEFAULT_TRANSPORTS,
+                        help="Comma separated transports: {}, or {} for "
+                             "AF_UNIX datagram sockets (default {})"
+                        .format(TRANSPORT_UDP, TRANSPORT_UNIX,
+                                DEFAULT_TRANSPORTS))
+    parser.add_argument("--compress",
+                        help="Codecs for clients to offer the server")
+    parser.add_argument("--fec", type=int, metavar="K",
+                        help="FEC group size for clients to offer the server")
+    parser.add_argument("--pace", type=RDP_Pacing.parse_setting,
+                        metavar="RATE",
+                        help="Pacing rate for the server (bytes per second, "
+                             "or 'auto')")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="Compare results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed fractional regression (default {})"
+                             .format(DEFAULT_TOLERANCE))
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    client_options = {}
+    if args.compress:
+        client_options["compress"] = args.compress
+    if args.fec:
+        client_options["fec"] = args.fec
+
+    server_options = {}
+    if args.pace:
+        server_options["pacing"] = args.pace
+
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    loss_rates = [float(loss) for loss in args.loss.split(",")]
+    transports = args.transport.split(",")
+    report = run_benchmarks(sizes, concurrency_levels, client_options,
+                            server_options, loss_rates, transports)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+        print("No regressions against {}".format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+    A local network impairment for RDP benchmarks.
+
+    `LossyProxy` is a UDP proxy which forwards datagrams between clients and a
+    server, dropping each one independently with a given probability. Each
+    client is given its own socket towards the server, so the server still
+    sees one address per client. Drops are drawn from a seeded random number
+    generator, so a run can be repeated.
+"""
+import random
+import selectors
+import socket
+import threading
+
+LOOPBACK_IP = "127.0.0.1"
+MAX_DATAGRAM_SIZE = 65535
+
+
+class LossyProxy(threading.Thread):
+    """ Forwards datagrams to and from `target_adr`, dropping a fraction
+    `loss` of them in each direction. Clients send to `adr`.
+    """
+
+    def __init__(self, target_adr, loss=0.0, seed=None, ip=LOOPBACK_IP):
+        super().__init__(daemon=True)
+        self.target_adr = target_adr
+        self.loss = loss
+        self.forwarded = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._stopped = threading.Event()
+
+        self._front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._front.bind((ip, 0))
+        self.adr = self._front.getsockname()
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._front, selectors.EVENT_READ)
+        self._backs = {}  # Client address -> socket towards the target
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                for key, _ in self._selector.select(0.1):
+                    try:
+                        data, adr = key.fileobj.recvfrom(MAX_DATAGRAM_SIZE)
+                    except OSError:
+                        continue  # An ICMP error for an earlier datagram
+                    if key.fileobj is self._front:
+                        self._forward(self._back_for(adr), data,
+                                      self.target_adr)
+                    else:
+                        self._forward(self._front, data, key.data)
+        finally:
+            for sock in [self._front] + list(self._backs.values()):
+                sock.close()
+            self._selector.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def _back_for(self, client_adr):
+        back = self._backs.get(client_adr)
+        if not back:
+            back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            back.bind((self.adr[0], 0))
+            self._backs[client_adr] = back
+            self._selector.register(back, selectors.EVENT_READ, client_adr)
+        return back
+
+    def _forward(self, sock, data, adr):
+        if self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        try:
+            sock.sendto(data, adr)
+        except OSError:
+            pass  # The destination has gone away
@@ -0,0 +1,120 @@
+"""
+    Packet rate of the RDP state machines, without sockets or a kernel.
+
+    A sender's `RDP_Machine.Transmission`s and a client's
+    `RDP_Machine.ResponseReceiver` exchange the datagrams of one long response
+    in memory, on a virtual clock which jumps to the next retransmission
+    deadline whenever a datagram is lost. The rate is the number of datagrams
+    handled (APP messages, parity messages and ACKs) per second of real time,
+    so it is an upper bound on what any I/O backend driving the machines could
+    achieve:
+
+        python3 -m a3.bench.RDP_MachineBench --messages 100000
+        python3 -m a3.bench.RDP_MachineBench --fec 8 --loss 0.01 --seed 1
+"""
+import argparse
+import json
+import logging
+import random
+import time
+
+from a3.src import RDP_FEC
+from a3.src.RDP_Machine import ResponseReceiver, Transmission
+from a3.src.RDP_Protocol import HTTP_CODE_LEN, HTTP_OK_ENCODED, \
+    MAX_PAYLOAD_SIZE, OPTION_FEC, Connection, create_app_message
+
+SERVER_ADR = ("server", 1)
+CLIENT_ADR = ("client", 2)
+
+DEFAULT_MESSAGES = 100000
+
+
+def transfer(messages, group_size=0, loss=0.0, seed=None,
+             payload_size=MAX_PAYLOAD_SIZE - RDP_FEC.PARITY_OVERHEAD):
+    """ Sends a response of `messages` APP messages from a sender to a
+    receiver, dropping each datagram with probability `loss`.
+
+    :param group_size An FEC group size, or 0 to send messages one at a time
+    :return: A dict of results
+    """
+    rand = random.Random(seed)
+    options = {OPTION_FEC: str(group_size)} if group_size else {}
+    server = Connection(CLIENT_ADR, 7, 100)
+    server.options = options
+    client = Connection(SERVER_ADR, server.seq_num - 1, 7)
+    client.options = options
+
+    payload = HTTP_OK_ENCODED + bytes(payload_size - HTTP_CODE_LEN)
+    now = 0.0
+    receiver = ResponseReceiver(client, now, idle_timeout=float("inf"))
+    step = group_size or 1
+    delivered = datagrams = dropped = failures = 0
+
+    start = time.perf_counter()
+    for i in range(0, messages, step):
+        group = [create_app_message(server.get_seq_and_increment(),
+                                    server.last_index_received, payload)
+                 for _ in range(min(step, messages - i))]
+        if group_size:
+            group.append(RDP_FEC.create_parity_message(
+                server.get_seq_and_increment(), server.last_index_received,
+                group))
+        transmission = Transmission(group, CLIENT_ADR)
+        transmission.start(now)
+        while not transmission.is_done():
+            for data in transmission.datagrams_to_send():
+                datagrams += 1
+                if rand.random() < loss:
+                    dropped += 1
+                    continue
+                delivered += len(receiver.receive_datagram(data, SERVER_ADR,
+                                                           now))
+                for ack in receiver.datagrams_to_send():
+                    datagrams += 1
+                    if rand.random() < loss:
+                        dropped += 1
+                        continue
+                    transmission.receive_datagram(ack, CLIENT_ADR, now)
+            if not transmission.is_done():
+                now = transmission.deadline
+                transmission.handle_timer(now)
+        if transmission.failed:
+            failures += 1
+            break
+    seconds = time.perf_counter() - start
+
+    return {"messages": messages,
+            "fec": group_size,
+            "loss": loss,
+            "delivered": delivered,
+            "datagrams": datagrams,
+            "dropped": dropped,
+            "failures": failures,
+            "virtual_seconds": now,
+            "seconds": seconds,
+            "datagrams_per_second": datagrams / seconds if seconds else None}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python3 -m a3.bench.RDP_MachineBench")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES,
+                        help="APP messages in the response (default {})"
+                        .format(DEFAULT_MESSAGES))
+    parser.add_argument("--fec", type=int, default=0, metavar="K",
+                        help="Send the response in FEC groups of K messages")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="Fraction of datagrams dropped")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    print(json.dumps(transfer(args.messages, args.fec, args.loss, args.seed),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
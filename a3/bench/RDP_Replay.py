@@ -0,0 +1,176 @@
+"""
+    Replays a capture of the requests served by an RDP server (see
+    `RDP_Capture`) against a server, to reproduce a real request mix.
+
+    Each request is sent by a simulated client of its own, an
+    `RDP_Client.RDPSession` on an ephemeral port, at its original offset from
+    the first request divided by the speed-up factor. Up to `max_clients`
+    requests are in flight at once. Latency is measured from when a request
+    was due rather than from when it was sent, so a server (or replayer) which
+    falls behind shows as latency instead of silently lowering the load.
+
+    A request fails if its outcome differs from the capture's: a response was
+    captured but none was received, or the other way round. A request whose
+    connection was lost when it was captured (`completed` is false) may fail
+    again without counting as a failure. A response of a different size from
+    the captured one (when that was not compressed) is a byte mismatch.
+
+        python3 -m a3.src.RDP_Server 127.0.0.1 5000 --capture-file capture.jsonl
+        python3 -m a3.bench.RDP_Replay capture.jsonl 127.0.0.1 5000 --speedup 10
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import math
+import time
+
+from a3.src import RDP_Client
+from a3.src.RDP_Capture import read_capture
+from a3.src.RDP_Socket import UNIX_ADDRESS_PREFIX, parse_address
+
+DEFAULT_SPEEDUP = 1.0
+DEFAULT_MAX_CLIENTS = 64
+PERCENTILES = (50, 90, 99)
+
+HTTP_OK = 200
+
+
+def percentile(values, p):
+    """ The nearest-rank `p`th percentile of sorted `values`, or `None` if
+    there are none.
+    """
+    if not values:
+        return None
+    return values[max(1, math.ceil(p / 100 * len(values))) - 1]
+
+
+def _summarise(values):
+    values = sorted(values)
+    summary = {"p{}".format(p): percentile(values, p) for p in PERCENTILES}
+    summary["max"] = values[-1] if values else None
+    return summary
+
+
+def send_request(server_adr, request, options=None):
+    """ Sends a captured request over a new connection.
+
+    :return: The response body, or `None` if none was received
+    """
+    with RDP_Client.RDPSession(server_adr, options) as session:
+        return session.request(request["filename"],
+                               request.get("fields") or {})
+
+
+def _timed_request(server_adr, request, due, options):
+    started = time.monotonic()
+    body = send_request(server_adr, request, options)
+    finished = time.monotonic()
+    captured_ok = request["status"] == HTTP_OK
+    expected_failure = not request.get("completed", True) and body is None
+    return {"lateness": started - due,
+            "service": finished - started,
+            "latency": finished - due,
+            "bytes": len(body) if body is not None else None,
+            "failed": not expected_failure and
+            (body is not None) != captured_ok,
+            "expected_failure": expected_failure,
+            "byte_mismatch": body is not None and captured_ok and
+            not request.get("compressed") and
+            request.get("bytes") is not None and
+            len(body) != request["bytes"]}
+
+
+def replay(server_adr, requests, speedup=DEFAULT_SPEEDUP,
+           max_clients=DEFAULT_MAX_CLIENTS, options=None):
+    """ Replays requests read with `RDP_Capture.read_capture`.
+
+    :param speedup Divides the time between requests
+    :param options Connection options for the clients to offer
+    :return: A dict of results. Latency and service time percentiles are of
+    the requests which did not fail, other than expected failures.
+    """
+    start = time.monotonic()
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, max_clients)) as pool:
+        for request in requests:
+            due = start + (request["time"] - requests[0]["time"]) / speedup
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(_timed_request, server_adr, request,
+                                       due, options))
+        outcomes = [future.result() for future in futures]
+    elapsed = time.monotonic() - start
+
+    succeeded = [o for o in outcomes
+                 if not o["failed"] and not o["expected_failure"]]
+    return {"requests": len(outcomes),
+            "failures": sum(o["failed"] for o in outcomes),
+            "expected_failures": sum(o["expected_failure"] for o in outcomes),
+            "byte_mismatches": sum(o["byte_mismatch"] for o in outcomes),
+            "speedup": speedup,
+            "captured_seconds": requests[-1]["time"] - requests[0]["time"]
+            if requests else 0,
+            "wall_seconds": elapsed,
+            "requests_per_second": len(outcomes) / elapsed
+            if elapsed else None,
+            "bytes": sum(o["bytes"] or 0 for o in outcomes),
+            "latency_seconds": _summarise([o["latency"] for o in succeeded]),
+            "service_seconds": _summarise([o["service"] for o in succeeded]),
+            "max_lateness_seconds":
+                max((o["lateness"] for o in outcomes), default=None)}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.bench.RDP_Replay")
+    parser.add_argument("capture_file", metavar="<Capture File>")
+    parser.add_argument("ip", metavar="<Server IP>",
+                        help="An IP address, or {}<path> for a server on an "
+                             "AF_UNIX datagram socket"
+                        .format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("port", metavar="<Server Port>", type=int, nargs="?",
+                        help="Omitted for {}<path>".format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("--speedup", type=float, default=DEFAULT_SPEEDUP,
+                        help="Divide the time between requests by this "
+                             "(default {})".format(DEFAULT_SPEEDUP))
+    parser.add_argument("--max-clients", type=int,
+                        default=DEFAULT_MAX_CLIENTS,
+                        help="Most requests in flight at once (default {})"
+                        .format(DEFAULT_MAX_CLIENTS))
+    parser.add_argument("--compress",
+                        help="Codecs for clients to offer the server")
+    parser.add_argument("--fec", type=int, metavar="K",
+                        help="FEC group size for clients to offer the server")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+    if args.speedup <= 0:
+        parser.error("--speedup must be positive")
+    try:
+        args.server_adr = parse_address(args.ip, args.port)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def main():
+    args = _parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    options = {}
+    if args.compress:
+        options["compress"] = args.compress
+    if args.fec:
+        options["fec"] = args.fec
+
+    requests = read_capture(args.capture_file)
+    result = replay(args.server_adr, requests, args.speedup,
+                    args.max_clients, options)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
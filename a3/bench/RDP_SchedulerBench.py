@@ -0,0 +1,140 @@
+"""
+    Completion times of small transfers sharing a link with a large one, under
+    each `RDP_Scheduler` policy.
+
+    A large transfer starts at time 0 and small transfers arrive at random
+    (Poisson) times while it is in progress. Every transfer queues all of its
+    packets with a `SendScheduler` as soon as it arrives, as a send loop
+    pushing whole responses would, and the packets the scheduler picks are
+    sent over a link of fixed rate on a virtual clock. A transfer completes
+    when its last packet has been sent:
+
+        python3 -m a3.bench.RDP_SchedulerBench
+        python3 -m a3.bench.RDP_SchedulerBench --small 200 --weight 4
+"""
+import argparse
+import json
+import random
+
+from a3.bench.RDP_Benchmark import parse_size
+from a3.bench.RDP_Replay import percentile
+from a3.src.RDP_Metrics import SECONDS_BUCKETS, Histogram
+from a3.src.RDP_Protocol import MAX_PAYLOAD_SIZE
+from a3.src.RDP_Scheduler import DEFAULT_QUANTUM, POLICIES, SendScheduler
+
+LARGE = "large"
+
+DEFAULT_LARGE_SIZE = "16M"
+DEFAULT_SMALL_COUNT = 100
+DEFAULT_SMALL_SIZE = "16K"
+DEFAULT_RATE = 10e6  # Bytes per second
+DEFAULT_INTERVAL = 0.01  # Mean seconds between small transfers
+
+
+def simulate(policy,
+             large_size,
+             small_count=DEFAULT_SMALL_COUNT,
+             small_size=parse_size(DEFAULT_SMALL_SIZE),
+             rate=DEFAULT_RATE,
+             interval=DEFAULT_INTERVAL,
+             weight=1,
+             quantum=DEFAULT_QUANTUM,
+             seed=None):
+    """ Runs one simulation.
+
+    :param weight The large transfer's weight, for `drr`. Small transfers
+    have a weight of 1.
+    :return: A dict of results
+    """
+    rand = random.Random(seed)
+    arrivals = [(0.0, LARGE, large_size)]
+    arrived_at = 0.0
+    for i in range(small_count):
+        arrived_at += rand.expovariate(1 / interval)
+        arrivals.append((arrived_at, i, small_size))
+
+    now = 0.0
+    scheduler = SendScheduler(policy, quantum, clock=lambda: now)
+    started = {}
+    completion = {}
+    next_arrival = 0
+    while next_arrival < len(arrivals) or len(scheduler):
+        while next_arrival < len(arrivals) and \
+                arrivals[next_arrival][0] <= now:
+            arrived_at, key, size = arrivals[next_arrival]
+            next_arrival += 1
+            started[key] = arrived_at
+            scheduler.add_flow(key, weight if key == LARGE else 1, size)
+            # Each packet is queued with its size, and whether it is the last
+            for offset in range(0, max(size, 1), MAX_PAYLOAD_SIZE):
+                packet = min(MAX_PAYLOAD_SIZE, size - offset)
+                scheduler.enqueue(key, (packet, offset + packet >= size),
+                                  packet)
+        if not len(scheduler):
+            now = arrivals[next_arrival][0]
+            continue
+        key, (packet, last) = scheduler.next()
+        now += packet / rate
+        if last:
+            completion[key] = now - started[key]
+
+    small = sorted(completion[i] for i in range(small_count))
+    queueing_delay = Histogram(SECONDS_BUCKETS)
+    for i in range(small_count):
+        queueing_delay.merge(scheduler.flows[i].queueing_delay)
+    return {"policy": policy,
+            "large_size": large_size,
+            "large_weight": weight,
+            "small_count": small_count,
+            "small_size": small_size,
+            "rate": rate,
+            "large_completion_seconds": completion[LARGE],
+            "small_completion_seconds_p50": percentile(small, 50),
+            "small_completion_seconds_p99": percentile(small, 99),
+            "small_completion_seconds_max": small[-1] if small else None,
+            "small_queueing_delay_seconds_p99":
+                queueing_delay.percentile(99),
+            "virtual_seconds": now}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python3 -m a3.bench.RDP_SchedulerBench")
+    parser.add_argument("--policy", default=",".join(POLICIES),
+                        help="Comma separated policies (default {})"
+                        .format(",".join(POLICIES)))
+    parser.add_argument("--large", default=DEFAULT_LARGE_SIZE,
+                        help="Size of the large transfer (default {})"
+                        .format(DEFAULT_LARGE_SIZE))
+    parser.add_argument("--small", type=int, default=DEFAULT_SMALL_COUNT,
+                        help="Number of small transfers (default {})"
+                        .format(DEFAULT_SMALL_COUNT))
+    parser.add_argument("--small-size", default=DEFAULT_SMALL_SIZE,
+                        help="Size of each small transfer (default {})"
+                        .format(DEFAULT_SMALL_SIZE))
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="Link rate in bytes per second (default {:.0f})"
+                        .format(DEFAULT_RATE))
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help="Mean seconds between small transfers "
+                             "(default {})".format(DEFAULT_INTERVAL))
+    parser.add_argument("--weight", type=float, default=1,
+                        help="Weight of the large transfer under drr")
+    parser.add_argument("--quantum", type=int, default=DEFAULT_QUANTUM,
+                        help="Bytes per drr turn per unit of weight "
+                             "(default {})".format(DEFAULT_QUANTUM))
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    results = [simulate(policy, parse_size(args.large), args.small,
+                        parse_size(args.small_size), args.rate, args.interval,
+                        args.weight, args.quantum, args.seed)
+               for policy in args.policy.split(",")]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
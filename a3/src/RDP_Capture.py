@@ -0,0 +1,72 @@
+"""
+    A capture of the requests a server serves, for replaying its load later
+    with `a3.bench.RDP_Replay`.
+
+    Each request is appended to the capture file as one line of JSON once it
+    has been answered (or has failed):
+
+        {"time": 1722.41, "filename": "a.html", "fields": {"offset": "100"},
+         "status": 200, "bytes": 5120, "compressed": false, "seconds": 0.031,
+         "completed": true}
+
+    `time` is when the request arrived, on the server's clock, so only the
+    differences between requests are meaningful. `bytes` is the size of the
+    response body as sent, which is compressed if `compressed` is true, and
+    `seconds` the time taken to answer the request.
+"""
+import json
+import threading
+
+
+class RequestCapture:
+    """ Appends requests to a capture file. Lines are written whole, so
+    several servers may capture to the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.requests = 0
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, time, filename, fields, status, size, seconds,
+               completed=True, compressed=False):
+        """
+        :param fields The request's fields (see `RDP_Protocol.encode_request`)
+        :param status The HTTP status code of the response
+        :param completed False if the connection was lost while responding
+        :param compressed True if the response body was sent compressed
+        """
+        line = json.dumps({"time": time,
+                           "filename": filename,
+                           "fields": fields,
+                           "status": status,
+                           "bytes": size,
+                           "compressed": compressed,
+                           "seconds": seconds,
+                           "completed": completed}) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.requests += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """ Reads the requests of a capture file, skipping any partly written
+    last line.
+
+    :return: A list of request dicts, in order of time
+    """
+    requests = []
+    with open(path) as file:
+        for line in file:
+            try:
+                requests.append(json.loads(line))
+            except ValueError:
+                continue
+    requests.sort(key=lambda request: request["time"])
+    return requests
@@ -0,0 +1,292 @@
+"""
+    Content-defined chunking, for fetching only the changed parts of a file.
+
+    A file is cut into chunks where a rolling "gear" hash of the preceding
+    bytes falls below a threshold, so a boundary depends only on the content
+    just before it. An insertion or deletion changes the chunks around it but
+    not the boundaries (and so the chunks) elsewhere in the file. Chunks are
+    2 KiB to 64 KiB, about 10 KiB on average.
+
+    A file's manifest lists the size and SHA-256 digest of each of its chunks.
+    A client which offers the `dedup` option can ask for a file's manifest
+    (`method=MANIFEST`), look each chunk up in its `ChunkCache` by digest, and
+    request only the byte ranges of the chunks it does not have. Each chunk
+    received is checked against its digest before it is cached.
+
+    Chunking runs at a few MB/s, so a `ManifestCache` given an executor builds
+    the manifests of large files on it rather than on the caller's thread, and
+    has none to offer for a file until its manifest is built.
+"""
+import collections
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+MIN_CHUNK_SIZE = 2 * 1024
+AVERAGE_CHUNK_BITS = 13  # A boundary is found every 8 KiB after the minimum
+MAX_CHUNK_SIZE = 64 * 1024
+
+_HASH_MASK = (1 << 64) - 1
+_BOUNDARY_LIMIT = 1 << (64 - AVERAGE_CHUNK_BITS)
+# A fixed random value for each byte
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big")
+         for i in range(256)]
+
+_ENTRY = struct.Struct("!I32s")  # Chunk size, SHA-256 digest
+
+DEFAULT_MANIFEST_CACHE_ENTRIES = 256
+# Larger files are chunked on the cache's executor, if it has one
+DEFAULT_INLINE_MANIFEST_BYTES = 4 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+DEFAULT_CHUNK_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def chunk_ends(data,
+               min_size=MIN_CHUNK_SIZE,
+               max_size=MAX_CHUNK_SIZE):
+    """ Finds the content-defined chunk boundaries of `data`.
+
+    :return: The offset of the end of each chunk. Empty data has no chunks.
+    """
+    ends = []
+    start = 0
+    while start < len(data):
+        start = _chunk_end(data, start, min_size, max_size)
+        ends.append(start)
+    return ends
+
+
+def _chunk_end(data, start, min_size, max_size):
+    """ The end of the chunk of `data` starting at `start`.
+    """
+    end = min(start + max_size, len(data))
+    h = 0
+    gear = _GEAR
+    # Bytes before the minimum size cannot end a chunk, so are not hashed
+    for i in range(min(start + min_size, end), end):
+        h = ((h << 1) + gear[data[i]]) & _HASH_MASK
+        if h < _BOUNDARY_LIMIT:
+            return i + 1
+    return end
+
+
+def digest(chunk):
+    return hashlib.sha256(chunk).digest()
+
+
+def create_manifest(data):
+    """ :return: A list of the `(size, digest)` of each chunk of `data`
+    """
+    manifest = []
+    start = 0
+    for end in chunk_ends(data):
+        manifest.append((end - start, digest(data[start:end])))
+        start = end
+    return manifest
+
+
+def read_manifest(file, block_size=READ_BLOCK_SIZE):
+    """ Creates the manifest of the content of a binary file object, reading
+    it in blocks, so only a block or two of it is held at once however large
+    it is.
+
+    :return: The same manifest as `create_manifest` of the whole content
+    """
+    manifest = []
+    buffer = bytearray()
+    end_of_file = False
+    while buffer or not end_of_file:
+        while not end_of_file and \
+                len(buffer) < max(block_size, MAX_CHUNK_SIZE):
+            block = file.read(block_size)
+            end_of_file = not block
+            buffer += block
+        # A chunk is only cut once its maximum size is known to be buffered
+        start = 0
+        view = memoryview(buffer)
+        while start < len(buffer) and \
+                (end_of_file or len(buffer) - start >= MAX_CHUNK_SIZE):
+            end = _chunk_end(buffer, start, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+            manifest.append((end - start, digest(view[start:end])))
+            start = end
+        view.release()
+        del buffer[:start]
+    return manifest
+
+
+def encode_manifest(manifest):
+    return b"".join(_ENTRY.pack(size, chunk_digest)
+                    for size, chunk_digest in manifest)
+
+
+def decode_manifest(data):
+    """ Decodes a manifest encoded by `encode_manifest`.
+
+    :raises `ValueError` if the data is not a whole number of entries
+    """
+    if len(data) % _ENTRY.size:
+        raise ValueError("Truncated manifest of {} bytes".format(len(data)))
+    return list(_ENTRY.iter_unpack(data))
+
+
+def missing_ranges(manifest, present):
+    """ Coalesces the chunks not `present` into byte ranges of the file.
+
+    :param present A sequence of booleans, one for each chunk of `manifest`
+    :return: A list of `(offset, length, first, end)` tuples, where chunks
+    `first` up to `end` make up the range
+    """
+    ranges = []
+    offset = 0
+    for i, ((size, _), have) in enumerate(zip(manifest, present)):
+        if not have:
+            if ranges and ranges[-1][3] == i:
+                start, length, first, _ = ranges[-1]
+                ranges[-1] = (start, length + size, first, i + 1)
+            else:
+                ranges.append((offset, size, i, i + 1))
+        offset += size
+    return ranges
+
+
+class ManifestCache:
+    """ An LRU cache of encoded file manifests, invalidated when a file's size
+    or modification time changes, so each version of a file is only chunked
+    once.
+    """
+
+    def __init__(self,
+                 max_entries=DEFAULT_MANIFEST_CACHE_ENTRIES,
+                 inline_bytes=DEFAULT_INLINE_MANIFEST_BYTES):
+        """
+        :param inline_bytes Files larger than this are chunked on the executor
+        passed to `get`, if any
+        """
+        self.max_entries = max_entries
+        self.inline_bytes = inline_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._building = {}  # Path -> version being chunked on an executor
+        self._lock = threading.Lock()
+
+    def get(self, path, version=None, executor=None):
+        """ Returns the encoded manifest of the file at `path`.
+
+        :param version The file's size and modification time in nanoseconds,
+        or `None` to `stat` the file for them
+        :param executor A `concurrent.futures.Executor` to chunk the file on
+        if it is larger than `inline_bytes`. Without one, the file is chunked
+        before returning, however large it is.
+        :return: The manifest, or `None` if it is being built on the executor
+        """
+        key = os.path.abspath(path)
+        if version is None:
+            stat = os.stat(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if executor is not None and version[0] > self.inline_bytes:
+                if self._building.get(key) != version:
+                    self._building[key] = version
+                    executor.submit(self._build, path, key, version)
+                return None
+
+        return self._build(path, key, version)
+
+    def _build(self, path, key, version):
+        try:
+            with open(path, 'rb') as file:
+                manifest = encode_manifest(read_manifest(file))
+        except OSError as e:
+            logging.warning("Unable to chunk '{}': {}".format(path, e))
+            with self._lock:
+                if self._building.get(key) == version:
+                    del self._building[key]
+            raise
+
+        with self._lock:
+            self.misses += 1
+            if self._building.get(key) == version:
+                del self._building[key]
+            self._entries[key] = (version, manifest)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return manifest
+
+
+class ChunkCache:
+    """ A directory of chunks, each in a file named by its hex digest.
+
+    Reading a chunk marks it as recently used. `prune` removes the least
+    recently used chunks once the cache is over `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CHUNK_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, chunk_digest):
+        return os.path.join(self.directory, chunk_digest.hex())
+
+    def get(self, chunk_digest):
+        """ :return: The chunk with the given digest, or `None`
+        """
+        path = self._path(chunk_digest)
+        try:
+            with open(path, 'rb') as file:
+                chunk = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return chunk
+
+    def put(self, chunk):
+        """ Adds a chunk, written atomically so concurrent readers never see
+        part of it.
+        """
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(chunk)
+            os.replace(temp, self._path(digest(chunk)))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def prune(self):
+        """ Removes the least recently used chunks until the cache holds at
+        most `max_bytes`.
+
+        :return: The number of chunks removed
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
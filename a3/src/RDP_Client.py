@@ -1,13 +1,29 @@
+import argparse
+import concurrent.futures
 import hashlib
+import os
 import random
-import sys
+import threading
 
+from . import RDP_Chunking, RDP_Compression
+from .RDP_Linger import LINGER
+from .RDP_Machine import ResponseReceiver
+from .RDP_Metrics import ConnectionMetrics
 from .RDP_Protocol import *
+from .RDP_Socket import UNIX_ADDRESS_PREFIX, address_family, bind_socket, \
+    parse_address, wrap_socket
+from .RDP_Trace import TRACE
 
 logging.basicConfig(level=logging.INFO)
 
 CLIENT_PORT = 55555
 CLIENT_ADR = ('', CLIENT_PORT)
+EPHEMERAL_ADR = ('', 0)
+
+# Parallel downloads
+DEFAULT_STREAMS = 4
+STREAM_CONNECT_ATTEMPTS = 10
+RANGE_PIECE_SIZE = 1 << 20  # Most bytes of a range requested at once
 
 
 class ClientConnection(Connection):
@@ -16,68 +32,638 @@ class ClientConnection(Connection):
     def __init__(self, remote_adr, remote_seq_num, seq_num, sock):
         super().__init__(remote_adr, remote_seq_num, seq_num)
         self.sock = sock
+        self.decompressor = None
+        self.partial_content = None  # Content received before a failure
+        self.first_data_at = None  # When the latest response's first APP came
+        self.closed = False  # True once the connection has been released
+        self.first_response = None  # The first APP of a fast open response
+        self.linger = None  # An RDP_Linger.Linger to release the socket to
+        self.content_hash = None  # md5 of the response body received so far
+        self.server_digest = None  # The server's digest of the response body
+        self.response_size = None  # The body size announced by the server
+        self.body_received = 0  # Bytes of the response body received so far
+
+    def fec_group_size(self):
+        """ The negotiated FEC group size, or 0 if FEC is not in use.
+        """
+        return int(self.options.get(OPTION_FEC, 0))
+
+    def is_persistent(self):
+        return self.options.get(OPTION_PERSIST) == "1"
+
+
+class DownloadProgress:
+    """ The bytes received so far by the streams of a parallel download.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.received = 0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.received += nbytes
+
+
+def main(server_adr,
+         filename,
+         result_filename,
+         compression=None,
+         resume=False,
+         fast_open=False,
+         fec=None,
+         crc=False):
+    """ Retrieves a file from the server and saves it locally.
+
+    :param compression: A comma separated list of codecs to offer the server,
+    or `None` to request the file uncompressed.
+    :param resume: If true and the result file already exists, only the
+    remainder of the file is requested and appended to it. If the transfer
+    fails part way, whatever was received is saved so a later run can resume.
+    :param fast_open: If true, the request is sent in the SYN message.
+    :param fec: An FEC group size to offer the server, or `None` to not use
+    forward error correction.
+    :param crc: If true, ask for a CRC in every packet.
+
+    The content is verified against a digest sent by the server as it is
+    received. If the server does not send one, the source file is read instead
+    when it is available locally.
+
+    The connection lingers in the background once closed, so `LINGER` should
+    be waited for before the process exits.
+    """
+    offset = 0
+    if resume and os.path.isfile(result_filename):
+        offset = os.path.getsize(result_filename)
+        logging.info("Resuming '{}' from byte {}".format(filename, offset))
+
+    options = {OPTION_DIGEST: DIGEST_MD5, OPTION_SIZE: "1"}
+    if compression:
+        options[OPTION_COMPRESS] = compression
+    if fec:
+        options[OPTION_FEC] = fec
+    if crc:
+        options[OPTION_CRC] = "1"
+
+    with create_socket_for(server_adr, CLIENT_ADR) as sock:
+
+        if fast_open:
+            connection, content = fast_open_request(
+                server_adr, sock, filename, _range_fields(offset), options,
+                LINGER)
+        else:
+            connection = connect_to_server(server_adr, sock, options,
+                                           linger=LINGER)
+            content = get_from_server(filename, connection, offset) \
+                if connection else None
 
-def main(server_adr, filename, result_filename):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.bind(CLIENT_ADR)
-
-        connection = connect_to_server(server_adr, sock)
         if connection:
-            content = get_from_server(filename, connection)
-
             if content is not None:
-                create_file(result_filename, content, binary=True)
-                if checksum_matches(content, filename):
+                create_file(result_filename, content, binary=True,
+                            append=offset > 0)
+                if connection.server_digest is not None:
+                    # A mismatch would have failed the transfer
                     logging.info("CHECKSUM VERIFIED")
+                elif not os.path.isfile(filename):
+                    logging.info("No checksum available")
                 else:
-                    logging.warning("INVALID CHECKSUM")
+                    if offset:
+                        with open(result_filename, "rb") as f:
+                            content = f.read()
+                    if checksum_matches(content, filename):
+                        logging.info("CHECKSUM VERIFIED")
+                    else:
+                        logging.warning("INVALID CHECKSUM")
             else:
                 logging.error("Unable to retrieve '{}' from server.".
                               format(filename))
+                if resume and connection.partial_content:
+                    create_file(result_filename, connection.partial_content,
+                                binary=True, append=offset > 0)
+                    logging.info("Saved {} bytes. Run again to resume."
+                                 .format(len(connection.partial_content)))
+
+
+def parallel_main(server_adr,
+                  filename,
+                  result_filename,
+                  streams=DEFAULT_STREAMS,
+                  compression=None,
+                  fec=None,
+                  crc=False):
+    """ Retrieves a file using several connections at once and saves it
+    locally.
+
+    The file is split into `streams` byte ranges, each fetched over its own
+    connection from an ephemeral port (see `get_range_into_file`) and written
+    to the result file at its offset. Each piece of a range is verified
+    against the server's digest of it, and the whole file is checked once
+    written.
+
+    A server which handles one connection at a time serves the streams in
+    turn. A stream waiting for the server keeps trying to connect for as long
+    as the other streams are receiving data.
+
+    :return: True if the whole file was retrieved
+    """
+    options = {OPTION_DIGEST: DIGEST_MD5, OPTION_SIZE: "1"}
+    if compression:
+        options[OPTION_COMPRESS] = compression
+    if fec:
+        options[OPTION_FEC] = fec
+    if crc:
+        options[OPTION_CRC] = "1"
+
+    size = get_file_size(server_adr, filename)
+    if size is None:
+        logging.error("Unable to retrieve size of '{}' from server."
+                      .format(filename))
+        return False
+
+    ranges = split_ranges(size, streams)
+    logging.info("Fetching {} bytes over {} stream(s)"
+                 .format(size, len(ranges)))
+
+    progress = DownloadProgress()
+    with concurrent.futures.ThreadPoolExecutor(max(len(ranges), 1)) as pool, \
+            open(result_filename, "wb") as result:
+        result.truncate(size)
+        futures = [pool.submit(get_range_into_file, server_adr, filename,
+                               offset, length, result.fileno(), options,
+                               progress)
+                   for offset, length in ranges]
+
+        for future in futures:
+            if not future.result():
+                for f in futures:
+                    f.cancel()
+                return False
+
+    logging.info("Created '{}'".format(result_filename))
+
+    file_digest = _file_md5(result_filename)
+    if not os.path.isfile(filename):
+        logging.info("Source file not available locally. Checksum {}"
+                     .format(file_digest.hex()))
+    elif file_digest == _file_md5(filename):
+        logging.info("CHECKSUM VERIFIED")
+    else:
+        logging.warning("INVALID CHECKSUM")
+    return True
+
+
+def cached_main(server_adr,
+                filename,
+                result_filename,
+                cache_directory,
+                compression=None,
+                fec=None,
+                crc=False):
+    """ Retrieves a file and saves it locally, fetching only the chunks of it
+    not already in the chunk cache in `cache_directory` (see
+    `RDPSession.get_deduplicated`). Each chunk is verified against its digest
+    in the file's manifest.
+
+    :return: True if the whole file was retrieved
+    """
+    options = {OPTION_DIGEST: DIGEST_MD5, OPTION_SIZE: "1", OPTION_DEDUP: "1"}
+    if compression:
+        options[OPTION_COMPRESS] = compression
+    if fec:
+        options[OPTION_FEC] = fec
+    if crc:
+        options[OPTION_CRC] = "1"
+
+    cache = RDP_Chunking.ChunkCache(cache_directory)
+    with RDPSession(server_adr, options) as session:
+        content = session.get_deduplicated(filename, cache)
+    if content is None:
+        logging.error("Unable to retrieve '{}' from server.".format(filename))
+        return False
+    create_file(result_filename, content, binary=True)
+    return True
+
+
+def split_ranges(size, streams):
+    """ Splits `size` bytes into at most `streams` contiguous, non-empty
+    `(offset, length)` ranges.
+    """
+    streams = max(1, min(streams, size))
+    base, extra = divmod(size, streams)
+    ranges = []
+    offset = 0
+    for i in range(streams):
+        length = base + (1 if i < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return [r for r in ranges if r[1] > 0]
+
 
+def get_file_size(server_adr, filename):
+    """ Asks the server for the size of a file with a HEAD request.
 
-def connect_to_server(adr, sock):
+    :return: The size in bytes, or `None` if it could not be retrieved.
+    """
+    content = _request_over_new_connection(server_adr, filename,
+                                           {REQUEST_METHOD: METHOD_HEAD})
+    try:
+        return int(content) if content is not None else None
+    except ValueError:
+        logging.error("Bad HEAD response: {}".format(content))
+        return None
+
+
+def get_range_into_file(server_adr, filename, offset, length, fd,
+                        options=None, progress=None):
+    """ Retrieves a byte range of a file over its own connection, and writes
+    it to the file descriptor `fd` at the same offset. The range is requested
+    in pieces of at most `RANGE_PIECE_SIZE` bytes, so only one piece is held
+    in memory at a time.
+
+    :param progress: A `DownloadProgress` shared with the other streams of
+    the download, which is added to as pieces arrive
+    :return: True if the whole range was retrieved
+    """
+    end = offset + length
+    with RDPSession(server_adr, options, progress=progress) as session:
+        while offset < end:
+            piece_length = min(RANGE_PIECE_SIZE, end - offset)
+            content = session.get(filename, offset, piece_length)
+            if content is None or len(content) != piece_length:
+                logging.error("Failed to retrieve bytes {}+{} of '{}'"
+                              .format(offset, piece_length, filename))
+                return False
+            os.pwrite(fd, content, offset)
+            offset += piece_length
+            if progress:
+                progress.add(piece_length)
+    return True
+
+
+def _request_over_new_connection(server_adr, filename, fields, options=None):
+    """ Connects to the server from an ephemeral port, retrying while the
+    server is busy, and makes a single request.
+    """
+    with create_socket_for(server_adr) as sock:
+        for _ in range(STREAM_CONNECT_ATTEMPTS):
+            connection = connect_to_server(server_adr, sock, options,
+                                           linger=LINGER)
+            if connection:
+                return _get_with_fields(filename, connection, fields)
+    return None
+
+
+class RDPSession:
+    """ Fetches any number of files from a server over one connection.
+
+    The session offers the server a persistent connection. If the server
+    accepts, every `get` reuses the connection and `close` releases it.
+    Otherwise (or if the server drops the connection) the session transparently
+    reconnects for each request. When bound to an ephemeral port, a connection
+    closed by the server lingers in the background on the old socket while the
+    session carries on with a new one.
+
+        with RDPSession(server_adr) as session:
+            first = session.get("a.html")
+            second = session.get("b.html")
+    """
+
+    def __init__(self,
+                 server_adr,
+                 options=None,
+                 local_adr=EPHEMERAL_ADR,
+                 fast_open=False,
+                 sock=None,
+                 progress=None):
+        """
+        :param fast_open: If true, a request made while disconnected is sent in
+        the SYN message of the new connection.
+        :param sock: An already bound socket to use for every connection, such
+        as an `RDP_SimNet` socket. Closed connections then linger in the
+        foreground, as the socket cannot be replaced.
+        :param progress: The `DownloadProgress` of a parallel download this
+        session is a stream of. Attempts to connect while it grows do not
+        count towards `STREAM_CONNECT_ATTEMPTS`, as the server is busy with
+        another stream.
+        """
+        self.server_adr = server_adr
+        self.options = dict(options or {})
+        self.options[OPTION_PERSIST] = "1"
+        self.fast_open = fast_open
+        self.progress = progress
+        self.connection = None
+        self.local_adr = local_adr
+        # A fixed port cannot be rebound while the old socket lingers
+        self.linger = LINGER if local_adr[1] == 0 and sock is None else None
+        self.sock = self._create_socket() if sock is None else sock
+        # Of the files fetched by `get_deduplicated`
+        self.reused_bytes = 0
+        self.fetched_bytes = 0
+
+    def _create_socket(self):
+        return create_socket_for(self.server_adr, self.local_adr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_connected(self):
+        return self.connection is not None and not self.connection.closed
+
+    def connect(self):
+        """ Connects to the server, if not already connected.
+
+        :return: True if connected
+        """
+        if self.is_connected():
+            return True
+        self.connection = None
+        attempts = 0
+        while attempts < STREAM_CONNECT_ATTEMPTS:
+            received = self.progress.received if self.progress else None
+            self.connection = connect_to_server(self.server_adr, self.sock,
+                                                self.options,
+                                                linger=self.linger)
+            if self.connection:
+                return True
+            if not self.progress or self.progress.received == received:
+                attempts += 1
+        return False
+
+    def get(self, filename, offset=0, length=None):
+        """ Requests a file (or a byte range of it) from the server.
+
+        :return: The binary content, or `None` if it could not be retrieved
+        """
+        return self.request(filename, _range_fields(offset, length))
+
+    def get_deduplicated(self, filename, cache):
+        """ Fetches a file, reusing those of its chunks already in a chunk
+        cache and adding the chunks fetched to it (see `RDP_Chunking`). Only
+        the byte ranges of missing chunks are requested. The session must
+        offer the `dedup` option: if the server does not accept it, or has no
+        manifest of the file to send yet, the whole file is fetched instead.
+
+        :param cache An `RDP_Chunking.ChunkCache`
+        :return: The binary content, or `None` if it could not be retrieved
+        """
+        if not self.connect():
+            return None
+        if self.connection.options.get(OPTION_DEDUP) != "1":
+            logging.info("Server does not deduplicate. Fetching '{}' in full"
+                         .format(filename))
+            return self.get(filename)
+
+        manifest = self.request(filename, {REQUEST_METHOD: METHOD_MANIFEST})
+        if manifest is None:
+            # Such as while the server chunks a large file
+            logging.info("No manifest of '{}'. Fetching it in full".format(
+                filename))
+            return self.get(filename)
+        try:
+            manifest = RDP_Chunking.decode_manifest(manifest)
+        except ValueError as e:
+            logging.error("Bad manifest for '{}': {}".format(filename, e))
+            return None
+
+        chunks = [cache.get(chunk_digest) for _, chunk_digest in manifest]
+        ranges = RDP_Chunking.missing_ranges(
+            manifest, [chunk is not None for chunk in chunks])
+        for offset, length, first, end in ranges:
+            content = self.get(filename, offset, length)
+            if content is None or len(content) != length:
+                logging.error("Failed to retrieve bytes {}+{} of '{}'"
+                              .format(offset, length, filename))
+                return None
+            position = 0
+            for i in range(first, end):
+                size, chunk_digest = manifest[i]
+                chunk = content[position:position + size]
+                position += size
+                if RDP_Chunking.digest(chunk) != chunk_digest:
+                    logging.error("'{}' changed since its manifest was sent"
+                                  .format(filename))
+                    return None
+                cache.put(chunk)
+                chunks[i] = chunk
+
+        size = sum(chunk_size for chunk_size, _ in manifest)
+        fetched = sum(length for _, length, _, _ in ranges)
+        self.fetched_bytes += fetched
+        self.reused_bytes += size - fetched
+        logging.info("Reused {} of {} bytes from the chunk cache".format(
+            size - fetched, size))
+        cache.prune()
+        return b"".join(chunks)
+
+    def request(self, filename, fields):
+        """ Sends a request with the given fields (see
+        `RDP_Protocol.encode_request`), such as a HEAD request.
+
+        :return: The response body, or `None` if it could not be retrieved
+        """
+        for attempt in range(2):
+            if self.fast_open and not self.is_connected():
+                content = self._fast_open_request(filename, fields)
+                if not self.connection:
+                    return None
+            elif self.connect():
+                content = _get_with_fields(filename, self.connection, fields)
+            else:
+                return None
+
+            if self.connection.closed and self.linger is not None:
+                # The old socket now belongs to the linger
+                self.sock.close()
+                self.sock = self._create_socket()
+
+            if content is not None:
+                return content
+            if not self.connection.closed and \
+                    self.connection.first_data_at is None:
+                # The request went unanswered, so the server has probably
+                # timed the idle connection out. Retry on a new connection.
+                self.connection = None
+                continue
+            return None
+        return None
+
+    def _fast_open_request(self, filename, fields):
+        self.connection = None
+        for _ in range(STREAM_CONNECT_ATTEMPTS):
+            self.connection, content = fast_open_request(
+                self.server_adr, self.sock, filename, fields, self.options,
+                self.linger)
+            if self.connection:
+                return content
+        return None
+
+    def close(self):
+        """ Releases the connection, if any, and closes the socket.
+        """
+        connection = self.connection
+        if connection and not connection.closed and \
+                connection.is_persistent():
+            fin = create_fin_message(connection.increment_and_get_seq(),
+                                     connection.last_index_received,
+                                     connection.header_flags())
+            reply = send_until_ack_in(fin, self.sock, connection.remote_adr,
+                                      connection.metrics)
+            if reply and reply.is_fin():
+                logging.info("Disconnected")
+            else:
+                logging.warning("No reply to FIN. Assuming disconnected.")
+            connection.closed = True
+        self.connection = None
+        self.sock.close()
+
+
+def create_socket_for(server_adr, local_adr=EPHEMERAL_ADR):
+    """ Creates a socket bound to `local_adr` from which to reach the server.
+    A server on an `AF_UNIX` path is reached from an unused abstract address
+    instead, whatever `local_adr` is.
+
+    :return: An `RDP_Socket.DatagramSocket`
+    """
+    if address_family(server_adr) == socket.AF_UNIX:
+        local_adr = ""
+    return wrap_socket(bind_socket(local_adr))
+
+
+def connect_to_server(adr, sock, options=None, request=None, linger=None):
     """ Perform a 3-way handshake with the server at the given remote address
 
+    If a request is given it is carried in the SYN (fast open). A server which
+    answers it directly replies with the first APP message of the response,
+    which is kept in the connection's `first_response` rather than ACKed.
+
     :param adr: The address of the server
     :param sock: The socket to use
+    :param options: A dict of connection options to offer the server
+    :param request: An encoded GET request to send with the SYN
+    :param linger: An `RDP_Linger.Linger` to hand the socket to once the server
+    closes the connection, rather than blocking for `FIN_KEEP_ALIVE`
     :return: The connection object created if successful, None otherwise.
     """
-    seq_no = random.randint(0, MAX_SEQ_NUMBER)
+    seq_no = random.randrange(MAX_SEQ_NUMBER)
     logging.info("Initial Sequence Number: {}".format(seq_no))
 
-    syn = create_syn_message(seq_no)
+    syn = create_syn_message(seq_no, options=options, request=request)
 
     logging.info("Connecting to server {}".format(adr))
 
-    response = send_until_ack_in(syn, sock, adr)
+    metrics = ConnectionMetrics(sock)
+    response = send_until_ack_in(syn, sock, adr, metrics)
     if not response:
         logging.error("No response from server")
         return None
+    elif response.is_app() and request is not None:
+        metrics.record_handshake()
+        # The server only answers fast open if it accepts every option offered
+        connection = ClientConnection(adr, response.seq_no - 1, seq_no, sock)
+        connection.metrics = metrics
+        connection.linger = linger
+        connection.options = dict(options or {})
+        connection.first_response = response
+        logging.info("Server answered the request in the SYN")
+        return connection
     elif not response.is_syn():
         logging.warning("Ack for SYN was not a SYN.")
 
+    metrics.record_handshake()
     connection = ClientConnection(adr, response.seq_no, seq_no, sock)
+    connection.metrics = metrics
+    connection.linger = linger
+    connection.options = decode_options(response.payload)
+    if connection.options:
+        logging.info("Server accepted options {}".format(connection.options))
 
     send_ack(response, connection, sock)
     return connection
 
 
-def get_from_server(filename, connection):
+def get_from_server(filename, connection, offset=0, length=None):
     """ Sends a request to the server for the given file.
 
     :param filename: The file to request
     :param connection: The connection to the server
+    :param offset: The first byte of the file to request
+    :param length: The number of bytes to request, or `None` for the remainder
+    of the file
     :return: The binary content of the file, if successful. None otherwise.
     """
+    return _get_with_fields(filename, connection,
+                            _range_fields(offset, length))
+
+
+def fast_open_request(adr, sock, filename, fields=None, options=None,
+                      linger=None):
+    """ Connects to the server and requests a file in a single round trip by
+    carrying the request in the SYN. Falls back to sending a GET request once
+    connected if the server does not answer the SYN with the response.
+
+    :param fields: A dict of request fields
+    :param linger: See `connect_to_server`
+    :return: A `(connection, content)` pair. The connection is `None` if the
+    server could not be reached, and the content is `None` if the file could
+    not be retrieved.
+    """
+    fields = fields or {}
+    connection = connect_to_server(adr, sock, options,
+                                   encode_request(filename, fields), linger)
+    if not connection:
+        return None, None
+    if connection.first_response is None:
+        return connection, _get_with_fields(filename, connection, fields)
+
+    response = connection.first_response
+    connection.first_response = None
+    _prepare_for_response(connection, fields)
+    return connection, receive_file_content(connection, response)
+
+
+def _range_fields(offset=0, length=None):
+    fields = {}
+    if offset:
+        fields[REQUEST_OFFSET] = offset
+    if length is not None:
+        fields[REQUEST_LENGTH] = length
+    return fields
+
+
+def _prepare_for_response(connection, fields):
+    connection.first_data_at = None
+    # Each response body is compressed as a separate stream
+    codec = connection.options.get(OPTION_COMPRESS)
+    if codec and fields.get(REQUEST_METHOD) not in (METHOD_HEAD,
+                                                     METHOD_MANIFEST):
+        connection.decompressor = RDP_Compression.create_decompressor(codec)
+    else:
+        connection.decompressor = None
+    # The digest is checked incrementally, so the content is only read once
+    connection.server_digest = None
+    connection.response_size = None
+    connection.body_received = 0
+    if connection.options.get(OPTION_DIGEST) == DIGEST_MD5:
+        connection.content_hash = hashlib.md5()
+    else:
+        connection.content_hash = None
+
+
+def _get_with_fields(filename, connection, fields):
+    _prepare_for_response(connection, fields)
+
     request = create_app_message(connection.increment_and_get_seq(),
                                  connection.last_index_received,
-                                 filename.encode())
+                                 encode_request(filename, fields),
+                                 connection.header_flags())
 
     logging.info("Sending request for {} to server".format(filename))
 
-    ack = send_until_ack_in(request, connection.sock, connection.remote_adr)
+    ack = send_until_ack_in(request, connection.sock, connection.remote_adr,
+                            connection.metrics)
     if ack:
         if not (ack.is_app()):
             logging.error("ACK not an application message.")
@@ -93,7 +679,9 @@ def receive_file_content(connection, app):
     """ Receives the file content from the server.
 
     Read each APP message from the server, ACKing each one, until the connection
-    is terminated.
+    is terminated or, on a persistent connection, the end of the response is
+    reached. The messages are sequenced and ACKed by an
+    `RDP_Machine.ResponseReceiver`.
 
     :param connection: The connection to the server
     :param app: The first app message from the server
@@ -104,27 +692,44 @@ def receive_file_content(connection, app):
     """
     assert app.is_app(), "Programming error"
 
-    content = b""
+    clock = clock_of(connection.sock)
+    if connection.first_data_at is None:
+        connection.first_data_at = clock()
+
+    receiver = ResponseReceiver(connection, clock())
+    # A bytearray grows in place, where bytes would be copied on every chunk
+    content = bytearray()
     message_in = app
 
     while message_in.is_app():
         # Process the current message
-        content = process_app_message(message_in, connection, content)
+        end = False
+        for message in receiver.receive_message(message_in, clock()):
+            if content is not None:
+                content = apply_app_payload(message, connection, content)
+            end = end or message.is_end_of_response()
+        send_datagrams(connection.sock, receiver.datagrams_to_send(),
+                       connection.remote_adr)
+        if receiver.failed:
+            content = None
+
+        if end:
+            return finish_response(connection, content)
 
         # Get the next message
-        try:
-            timeout = DEFAULT_ACK_TIMEOUT_SECONDS * DEFAULT_RETRY_THRESHOLD
-            message_in = try_read_message(connection.sock, timeout)
-            if message_in.src_adr != connection.remote_adr:
-                logging.warning("Dropping packet from bad sender.")
-        except socket.timeout:
-            logging.error("Server stopped responding.")
+        message_in = _read_from_server(connection, receiver, clock)
+        if message_in is None:
+            if content and connection.decompressor:
+                content += connection.decompressor.flush()
+            connection.partial_content = content
             return None
 
         # Previous packet was 404 or bad response, expecting FIN afterwards
         if content is None:
             break
 
+    content = finish_response(connection, content)
+
     # Disconnect
     if message_in.is_fin():
         handle_fin(message_in, connection)
@@ -134,40 +739,68 @@ def receive_file_content(connection, app):
     return content
 
 
-def create_file(name, content, binary=False):
-    mode = "wb" if binary else "w"
-    with open(name, mode) as f:
-        f.write(content)
-    logging.info("Created '{}'".format(name))
+def _read_from_server(connection, receiver, clock):
+    """ Reads the next message from the server.
+
+    :return: The message, or `None` if the receiver times out first
+    """
+    while True:
+        remaining = receiver.deadline - clock()
+        if remaining > 0:
+            try:
+                message = try_read_message(connection.sock, remaining)
+                if message.src_adr == connection.remote_adr:
+                    return message
+                logging.warning("Dropping packet from bad sender.")
+                continue
+            except socket.timeout:
+                pass
+        receiver.handle_timer(clock())
+        if receiver.timed_out:
+            return None
 
 
-def process_app_message(msg, connection, current_content):
-    """ Processes the given APP message.
+def finish_response(connection, content):
+    """ Completes the content of a response, checking it against the size and
+    digest sent by the server, if any.
 
-    :param msg The APP message received from the server
-    :param connection The current connection
-    :param current_content A binary string containing all previously received
-    content from the server
+    :return: The binary content, or `None` if there is none or it does not
+    match the size or digest
     """
-    if msg.seq_no == connection.next_expected_index():
-        return process_next_app_message(msg, connection, current_content)
+    if content is None:
+        return None
 
-    elif msg.seq_no == connection.last_index_received:
-        # Client ACK was lost. We have already processed this message.
-        logging.debug("Re-ACKing seq {}".format(msg.seq_no))
-        send_ack(msg, connection, connection.sock)
-        return current_content
+    if connection.decompressor:
+        tail = connection.decompressor.flush()
+        content += tail
+        if connection.content_hash:
+            connection.content_hash.update(tail)
 
-    else:
-        # Unknown seq no
-        s = "Bad sequence number {} during file transfer. Expected {}." \
-            .format(msg.seq_no,
-                    connection.next_expected_index())
-        logging.error(s)
+    if connection.response_size is not None and \
+            connection.body_received != connection.response_size:
+        logging.error("Received {} bytes of a {} byte response".format(
+            connection.body_received, connection.response_size))
         return None
 
+    if connection.server_digest is not None and \
+            connection.content_hash.digest() != connection.server_digest:
+        logging.error("Content does not match the server's digest")
+        return None
+    return bytes(content)
+
+
+def create_file(name, content, binary=False, append=False):
+    mode = ("a" if append else "w") + ("b" if binary else "")
+    with open(name, mode) as f:
+        f.write(content)
+    logging.info("Created '{}'".format(name))
+
+
+def apply_app_payload(msg, connection, current_content):
+    """ Adds the body of an APP message to the content received so far.
 
-def process_next_app_message(msg, connection, current_content):
+    :return: The new content, or `None` if the response was not a success
+    """
     # Inspect HTTP header
     rdp_payload = msg.payload
     http_code = rdp_payload[:HTTP_CODE_LEN]
@@ -175,15 +808,30 @@ def process_next_app_message(msg, connection, current_content):
     if http_code == HTTP_OK_ENCODED:
         # Next chunk
         logging.debug("Received chunk of file from server")
-        send_ack(msg, connection, connection.sock)
-
-        connection.increment_next_expected_index()
-        current_content += rdp_payload[HTTP_CODE_LEN:]
+        body = rdp_payload[HTTP_CODE_LEN:]
+        if msg.flags & FLAG_SIZE:
+            connection.response_size = int.from_bytes(
+                body[:SIZE_FIELD_SIZE], "big")
+            body = body[SIZE_FIELD_SIZE:]
+            logging.info("Response is {} bytes".format(
+                connection.response_size))
+        if msg.flags & FLAG_DIGEST:
+            connection.server_digest = bytes(body[-DIGEST_SIZE:])
+            body = body[:-DIGEST_SIZE]
+        connection.body_received += len(body)
+        if connection.decompressor:
+            body = connection.decompressor.decompress(body)
+        if connection.content_hash:
+            connection.content_hash.update(body)
+        current_content += body
         return current_content
 
     elif http_code == HTTP_FILE_NOT_FOUND_ENCODED:
         logging.warning("HTTP 404 received. File not found.")
-        send_ack(msg, connection, connection.sock)
+        return None
+
+    elif http_code == HTTP_UNAVAILABLE_ENCODED:
+        logging.warning("HTTP 503 received. Not available yet.")
         return None
 
     else:
@@ -196,11 +844,16 @@ def handle_fin(fin_in, connection):
     logging.info("FIN received, disconnecting")
     ack_no = fin_in.seq_no
     seq_no = connection.increment_and_get_seq()
-    fin_out = create_fin_message(seq_no, ack_no)
+    fin_out = create_fin_message(seq_no, ack_no, connection.header_flags())
 
     send_message(connection.sock, fin_out, connection.remote_adr)
+    connection.closed = True
 
-    fin_keep_alive(fin_in, fin_out, connection)
+    if connection.linger is not None:
+        connection.linger.add(connection.sock, connection.remote_adr, fin_in,
+                              fin_out)
+    else:
+        fin_keep_alive(fin_in, fin_out, connection)
     logging.info("Disconnected")
 
 
@@ -214,8 +867,9 @@ def fin_keep_alive(fin_in, fin_out, connection):
     :param connection The ClientConnection object to provide the socket and
     remote address
     """
+    clock = clock_of(connection.sock)
     remaining = FIN_KEEP_ALIVE
-    stop_time = time.time() + remaining
+    stop_time = clock() + remaining
 
     logging.debug("Beginning keep alive period")
 
@@ -226,11 +880,19 @@ def fin_keep_alive(fin_in, fin_out, connection):
                 send_message(connection.sock, fin_out, connection.remote_adr)
         except socket.timeout:
             pass  # we will exit the loop on the next iteration
-        remaining = stop_time - time.time()
+        remaining = stop_time - clock()
 
     logging.debug("Keep alive period complete")
 
 
+def _file_md5(filename):
+    file_hash = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            file_hash.update(block)
+    return file_hash.digest()
+
+
 def checksum_matches(content, filename):
     """ Compares the md5 hash of the binary string given and the content of the
     file specified.
@@ -241,13 +903,82 @@ def checksum_matches(content, filename):
         return content_hash.digest() == file_hash.digest()
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.src.RDP_Client")
+    parser.add_argument("ip", metavar="<Server IP>",
+                        help="An IP address, or {}<path> for a server on an "
+                             "AF_UNIX datagram socket"
+                        .format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("port", metavar="<Server Port>", type=int, nargs="?",
+                        help="Omitted for {}<path>".format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("filename", metavar="<Filename>")
+    parser.add_argument("result_filename", metavar="<Result Filename>")
+    parser.add_argument("--compress", metavar="CODECS",
+                        help="Comma separated codecs to offer, in order of "
+                             "preference. Supported: {}".format(
+                                 ",".join(RDP_Compression.SUPPORTED_CODECS)))
+    parser.add_argument("--streams", type=int, default=1,
+                        help="Number of connections to download over in "
+                             "parallel, such as {} (default 1, a single "
+                             "connection). A server which serves one "
+                             "connection at a time serves them in turn"
+                        .format(DEFAULT_STREAMS))
+    parser.add_argument("--trace-file",
+                        help="Dump the recent packet trace to this file when "
+                             "finished")
+    parser.add_argument("--resume", action="store_true",
+                        help="Append to an existing partial result file "
+                             "instead of downloading the whole file again")
+    parser.add_argument("--fec", type=int, metavar="K",
+                        help="Ask the server to send a parity packet after "
+                             "every K data packets, so single losses are "
+                             "repaired without a retransmission")
+    parser.add_argument("--crc", action="store_true",
+                        help="Ask the server to add a CRC32 to every packet, "
+                             "so corrupted packets are dropped")
+    parser.add_argument("--chunk-cache", metavar="DIR",
+                        help="Keep the chunks of fetched files in DIR, and "
+                             "fetch only the chunks of a file not already "
+                             "there")
+    parser.add_argument("--fast-open", action="store_true",
+                        help="Send the request in the SYN message, saving a "
+                             "round trip if the server supports it")
+    args = parser.parse_args()
+    try:
+        args.server_adr = parse_address(args.ip, args.port)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.streams < 1:
+        parser.error("--streams must be at least 1")
+    # Resuming and fast open are only supported over a single connection
+    # fetching the whole file
+    mode = "--chunk-cache" if args.chunk_cache else \
+        "--streams" if args.streams > 1 else None
+    if args.chunk_cache and args.streams > 1:
+        parser.error("--chunk-cache cannot be combined with --streams")
+    for flag, given in [("--resume", args.resume),
+                        ("--fast-open", args.fast_open)]:
+        if mode and given:
+            parser.error("{} cannot be combined with {}".format(flag, mode))
+    return args
+
+
 if __name__ == '__main__':
-    if len(sys.argv) not in [4, 5]:
-        print("Usage: python3 -m a3.src.RDP_Client "
-              "<Server IP> <Server Port> <Filename> <Result Filename>")
+    args = _parse_args()
+    if args.chunk_cache:
+        cached_main(args.server_adr, args.filename, args.result_filename,
+                    args.chunk_cache, compression=args.compress, fec=args.fec,
+                    crc=args.crc)
+    elif args.streams > 1:
+        parallel_main(args.server_adr, args.filename,
+                      args.result_filename, streams=args.streams,
+                      compression=args.compress, fec=args.fec,
+                      crc=args.crc)
     else:
-        ip = sys.argv[1]
-        port = int(sys.argv[2])
-        filename = sys.argv[3]
-        result_filename = sys.argv[4]
-        main((ip, port), filename, result_filename)
+        main(args.server_adr, args.filename, args.result_filename,
+             compression=args.compress, resume=args.resume,
+             fast_open=args.fast_open, fec=args.fec, crc=args.crc)
+    LINGER.wait()
+    if args.trace_file:
+        TRACE.dump(args.trace_file)
@@ -0,0 +1,142 @@
+"""
+    Payload compression for RDP file transfers.
+
+    The client offers a comma separated list of codecs in the `compress` option
+    of its SYN message, in order of preference. The server picks the first one
+    it supports and echoes it in the SYN-ACK, after which every response body
+    on the connection is compressed as a single stream and split across APP
+    messages as usual. zlib is always available; lz4 is used if the `lz4`
+    package is installed.
+"""
+import collections
+import hashlib
+import os
+import threading
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODEC_ZLIB = "zlib"
+CODEC_LZ4 = "lz4"
+
+# In order of server preference
+SUPPORTED_CODECS = [CODEC_LZ4, CODEC_ZLIB] if lz4 else [CODEC_ZLIB]
+
+DEFAULT_CACHE_ENTRIES = 64
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def negotiate(offered):
+    """ Chooses a codec from a comma separated list of offered codecs.
+
+    :return: The name of the first supported codec offered, or `None`.
+    """
+    for codec in offered.split(","):
+        codec = codec.strip()
+        if codec in SUPPORTED_CODECS:
+            return codec
+    return None
+
+
+def compress(data, codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data)
+    elif codec == CODEC_LZ4 and lz4:
+        return lz4.frame.compress(data)
+    raise ValueError("Unsupported codec '{}'".format(codec))
+
+
+class _LZ4Decompressor:
+    """ Adapts `lz4.frame.LZ4FrameDecompressor` to the zlib interface.
+    """
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+def create_decompressor(codec):
+    """ Creates an incremental decompressor with `decompress(chunk)` and
+    `flush()` methods for the given codec.
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    elif codec == CODEC_LZ4 and lz4:
+        return _LZ4Decompressor()
+    raise ValueError("Unsupported codec '{}'".format(codec))
+
+
+class CompressionCache:
+    """ An LRU cache of compressed file contents.
+
+    Entries are keyed by path and codec and are invalidated when the file's
+    size or modification time changes, so unchanged files are only compressed
+    once. The md5 digest of the uncompressed file is cached alongside.
+    """
+
+    def __init__(self,
+                 max_entries=DEFAULT_CACHE_ENTRIES,
+                 max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, codec):
+        """ Returns the content of the file at `path` compressed with `codec`.
+        """
+        return self.get_with_digest(path, codec)[0]
+
+    def get_with_digest(self, path, codec, version=None):
+        """ Returns the content of the file at `path` compressed with `codec`,
+        and the md5 digest of its uncompressed content.
+
+        :param version The file's size and modification time in nanoseconds,
+        or `None` to `stat` the file for them
+        """
+        key = (os.path.abspath(path), codec)
+        if version is None:
+            stat = os.stat(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+
+        with open(path, 'rb') as file:
+            content = file.read()
+        compressed = compress(content, codec)
+        digest = hashlib.md5(content).digest()
+
+        with self._lock:
+            self.misses += 1
+            self._put(key, version, compressed, digest)
+        return compressed, digest
+
+    def _put(self, key, version, compressed, digest):
+        old = self._entries.pop(key, None)
+        if old:
+            self._size -= len(old[1])
+
+        if len(compressed) > self.max_bytes:
+            return
+
+        self._entries[key] = (version, compressed, digest)
+        self._size += len(compressed)
+        while len(self._entries) > self.max_entries or \
+                self._size > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
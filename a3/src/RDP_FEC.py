@@ -0,0 +1,125 @@
+"""
+    Forward error correction for RDP file transfers.
+
+    When the client offers the `fec` option (a group size K) and the server
+    accepts it, the server sends each response in groups of up to K APP
+    messages followed by a parity APP message (flagged `FLAG_PARITY`), and
+    waits for a single ACK of the parity message's sequence number before
+    sending the next group. The parity payload is the XOR of the group's data
+    messages, each encoded as its payload length, flags and payload, so the
+    client can rebuild any one missing message of a group without waiting for
+    a retransmission.
+"""
+import struct
+
+from .RDP_Protocol import MAX_SEQ_NUMBER, FLAG_PARITY, create_app_message
+
+MAX_GROUP_SIZE = 16
+
+# Payload length and flags of a data message, as held in the parity
+_BLOCK_HEADER = struct.Struct("!HB")
+
+# Data payloads must be this much shorter than the largest payload, to leave
+# room for the block header in the parity payload
+PARITY_OVERHEAD = _BLOCK_HEADER.size
+
+
+def negotiate(offered):
+    """ Chooses the group size to use from the size offered by a client.
+
+    :return: The group size, or `None` if the offer is not valid
+    """
+    try:
+        size = int(offered)
+    except ValueError:
+        return None
+    return min(size, MAX_GROUP_SIZE) if size > 0 else None
+
+
+def _block(message):
+    return _BLOCK_HEADER.pack(len(message.payload), message.flags) + \
+        bytes(message.payload)
+
+
+def _xor(blocks, length):
+    result = 0
+    for block in blocks:
+        result ^= int.from_bytes(block.ljust(length, b"\0"), "big")
+    return result.to_bytes(length, "big")
+
+
+def create_parity_message(seq_no, ack_no, messages, flags=0):
+    """ Creates the parity message for a group of data messages.
+
+    :param flags Header flags to set in addition to `FLAG_PARITY`
+    """
+    blocks = [_block(message) for message in messages]
+    payload = _xor(blocks, max(len(block) for block in blocks))
+    return create_app_message(seq_no, ack_no, payload, FLAG_PARITY | flags)
+
+
+class FECGroup:
+    """ Collects the messages of one group as they arrive, in any order.
+
+    The group holds up to `size` data messages starting at `first_seq`,
+    followed by the parity message. A group is known to be shorter once its
+    parity message, or a data message marking the end of a response, arrives.
+    """
+
+    def __init__(self, first_seq, size):
+        self.first_seq = first_seq
+        self.size = size
+        self.count = size  # Number of data messages in the group
+        self.data = {}  # Position in group -> data message
+        self.parity = None
+
+    def position(self, seq_no):
+        return (seq_no - self.first_seq) % MAX_SEQ_NUMBER
+
+    def contains(self, seq_no):
+        return self.position(seq_no) <= self.size
+
+    def add(self, message):
+        position = self.position(message.seq_no)
+        if message.is_parity():
+            self.parity = message
+            self.count = position
+        else:
+            self.data[position] = message
+            if message.is_end_of_response():
+                self.count = position + 1
+
+    def _received(self):
+        return sum(1 for position in self.data if position < self.count)
+
+    def is_complete(self):
+        """ True once every data message has arrived or can be recovered.
+        """
+        received = self._received()
+        return received == self.count or \
+            (self.parity is not None and received == self.count - 1)
+
+    def last_seq(self):
+        """ The sequence number of the parity message, which the group's ACK
+        acknowledges.
+        """
+        return (self.first_seq + self.count) % MAX_SEQ_NUMBER
+
+    def messages(self):
+        """ The group's data messages in order, with any missing message
+        rebuilt from the parity. Only valid once the group is complete.
+        """
+        missing = [i for i in range(self.count) if i not in self.data]
+        if missing:
+            self.data[missing[0]] = self._recover(missing[0])
+        return [self.data[i] for i in range(self.count)]
+
+    def _recover(self, position):
+        parity = bytes(self.parity.payload)
+        blocks = [parity] + [_block(self.data[i]) for i in range(self.count)
+                             if i != position]
+        block = _xor(blocks, len(parity))
+        length, flags = _BLOCK_HEADER.unpack_from(block)
+        payload = block[_BLOCK_HEADER.size:_BLOCK_HEADER.size + length]
+        seq_no = (self.first_seq + position) % MAX_SEQ_NUMBER
+        return create_app_message(seq_no, self.parity.ack_no, payload, flags)
@@ -0,0 +1,144 @@
+"""
+    An in-memory index of the files under a server's document root.
+
+    `FileIndex` maps the path of every regular file under its root, relative to
+    the root, to a `FileEntry` holding its size and modification time. Looking
+    up a requested filename is then a dictionary lookup, with no system calls,
+    and names which would resolve outside the root (absolute paths are taken
+    as relative to the root, `..` may not climb above it, symbolic links are
+    not followed) are simply not found.
+
+    The index is brought up to date by `refresh`, which the server calls every
+    `refresh_interval` seconds. A refresh stats every file under the root but
+    only replaces the entries of files whose size or modification time has
+    changed, so a file kept open by an unchanged entry stays open.
+"""
+import logging
+import os
+import posixpath
+
+DEFAULT_REFRESH_INTERVAL_SECONDS = 5
+
+
+class FileEntry:
+    """ The indexed metadata of one file.
+    """
+    __slots__ = ("path", "size", "mtime_ns", "fd")
+
+    def __init__(self, path, size, mtime_ns, fd=None):
+        self.path = path  # Absolute path of the file
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.fd = fd  # A descriptor kept open for the file, or None
+
+    def version(self):
+        return self.size, self.mtime_ns
+
+    def open(self):
+        """ Opens the file for binary reading. When a descriptor is kept open
+        the file object shares it, so reads should seek first and the file
+        object should not be used once the entry has been replaced.
+        """
+        if self.fd is None:
+            return open(self.path, 'rb')
+        return open(self.fd, 'rb', closefd=False)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FileIndex:
+    """ Indexes the regular files under `root`.
+    """
+
+    def __init__(self,
+                 root,
+                 keep_open=False,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL_SECONDS):
+        """
+        :param keep_open If true, each indexed file is kept open, so serving
+        it does not need to open it again
+        """
+        self.root = os.path.realpath(root)
+        self.keep_open = keep_open
+        self.refresh_interval = refresh_interval
+        self._entries = {}  # Path relative to the root -> FileEntry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, filename):
+        """ Finds the file a client asked for.
+
+        :return: The `FileEntry`, or `None` if there is no such file under the
+        root as of the last refresh
+        """
+        name = posixpath.normpath("/" + filename).lstrip("/")
+        return self._entries.get(name)
+
+    def refresh(self):
+        """ Rescans the root, updating the entries of files which have been
+        added, changed or removed.
+
+        :return: The number of entries added, changed or removed
+        """
+        entries = {}
+        changed = 0
+        for name, stat in self._scan(self.root, ""):
+            entry = self._entries.pop(name, None)
+            if entry is None or entry.version() != \
+                    (stat.st_size, stat.st_mtime_ns):
+                if entry:
+                    entry.close()
+                entry = self._create_entry(name, stat)
+                if not entry:
+                    continue
+                changed += 1
+            entries[name] = entry
+
+        for entry in self._entries.values():
+            entry.close()
+        changed += len(self._entries)
+        self._entries = entries
+        if changed:
+            logging.debug("Refreshed index of '{}': {} change(s), {} file(s)"
+                          .format(self.root, changed, len(entries)))
+        return changed
+
+    def close(self):
+        for entry in self._entries.values():
+            entry.close()
+        self._entries = {}
+
+    def _scan(self, directory, prefix):
+        """ Yields the relative name and stat result of each regular file under
+        `directory`.
+        """
+        try:
+            with os.scandir(directory) as it:
+                dir_entries = list(it)
+        except OSError as e:
+            logging.warning("Unable to index '{}': {}".format(directory, e))
+            return
+        for dir_entry in dir_entries:
+            name = prefix + dir_entry.name
+            try:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(dir_entry.path, name + "/")
+                elif dir_entry.is_file(follow_symlinks=False):
+                    yield name, dir_entry.stat(follow_symlinks=False)
+            except OSError:
+                pass  # Removed during the scan
+
+    def _create_entry(self, name, stat):
+        path = os.path.join(self.root, name)
+        fd = None
+        if self.keep_open:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError as e:
+                logging.warning("Unable to open '{}': {}".format(path, e))
+                return None
+        return FileEntry(path, stat.st_size, stat.st_mtime_ns, fd)
@@ -0,0 +1,137 @@
+"""
+    Background connection teardown (TIME_WAIT) for RDP clients.
+
+    After replying to the server's FIN, a client must stay reachable for
+    `FIN_KEEP_ALIVE` in case its reply was lost and the server retransmits the
+    FIN. Rather than blocking the caller for that period, a connection can be
+    handed to a `Linger`, whose single daemon thread watches every lingering
+    socket with a selector and expires them with a `TimerWheel`. Any number of
+    connections may linger at once.
+
+    `Linger.add` duplicates the socket it is given, so the caller may close its
+    own socket straight away. It must not read from it again, as the lingering
+    copy shares the same queue of incoming datagrams.
+"""
+import logging
+import os
+import selectors
+import socket
+import threading
+
+from .RDP_Protocol import FIN_KEEP_ALIVE, MAX_PACKET_SIZE, message_to_bytes
+from .RDP_Timers import TimerWheel
+from .RDP_Trace import RECEIVED, SENT, TRACE
+
+
+class _Lingerer:
+    """ A socket kept open to repeat a FIN reply. The FINs are held in their
+    binary form.
+    """
+
+    def __init__(self, sock, remote_adr, fin_in, fin_out):
+        self.sock = sock
+        self.remote_adr = remote_adr
+        self.fin_in = message_to_bytes(fin_in)
+        self.fin_out = message_to_bytes(fin_out)
+
+
+class Linger:
+    """ Keeps closed connections reachable for `duration` seconds from a
+    background thread, re-sending the FIN reply whenever the FIN it answered is
+    received again.
+    """
+
+    def __init__(self, duration=FIN_KEEP_ALIVE):
+        self.duration = duration
+        self._lock = threading.Condition()
+        self._added = []  # Lingerers not yet picked up by the thread
+        self._count = 0  # Lingerers added and not yet expired
+        self._thread = None
+        self._selector = selectors.DefaultSelector()
+        self._timers = TimerWheel()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def add(self, sock, remote_adr, fin_in, fin_out):
+        """ Lingers on a copy of `sock` after `fin_out` has been sent in reply
+        to `fin_in`.
+        """
+        lingerer = _Lingerer(_duplicate(sock), remote_adr, fin_in, fin_out)
+        with self._lock:
+            self._added.append(lingerer)
+            self._count += 1
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup_w.send(b"\0")
+
+    def wait(self, timeout=None):
+        """ Blocks until every connection has finished lingering.
+
+        :return: True if none are left lingering
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._count, timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                added, self._added = self._added, []
+            for lingerer in added:
+                self._start(lingerer)
+
+            for key, _ in self._selector.select(self._timers.time_until_next()):
+                if key.fileobj is self._wakeup_r:
+                    self._drain_wakeups()
+                else:
+                    self._read(key.data)
+            self._timers.advance()
+
+    def _start(self, lingerer):
+        self._selector.register(lingerer.sock, selectors.EVENT_READ, lingerer)
+        self._timers.schedule(self.duration, self._expire, lingerer)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_r.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _read(lingerer):
+        while True:
+            try:
+                data, _ = lingerer.sock.recvfrom(MAX_PACKET_SIZE)
+            except OSError:
+                return  # Drained, or an ICMP error from the departed server
+            TRACE.record(RECEIVED, data)
+            if data == lingerer.fin_in:
+                logging.debug("Repeating reply to duplicate FIN")
+                lingerer.sock.sendto(lingerer.fin_out, lingerer.remote_adr)
+                TRACE.record(SENT, lingerer.fin_out)
+
+    def _expire(self, lingerer):
+        self._selector.unregister(lingerer.sock)
+        lingerer.sock.close()
+        with self._lock:
+            self._count -= 1
+            self._lock.notify_all()
+
+
+def _duplicate(sock):
+    """ A non-blocking socket sharing the bound port of `sock`, which may be a
+    raw socket or a `DatagramSocket`.
+    """
+    duplicate = socket.socket(fileno=os.dup(sock.fileno()))
+    duplicate.setblocking(False)
+    return duplicate
+
+
+# The process wide linger used by RDP_Client
+LINGER = Linger()
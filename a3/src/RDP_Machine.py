@@ -0,0 +1,261 @@
+"""
+    The RDP transfer logic as state machines which perform no I/O.
+
+    A `Transmission` sends a group of messages and waits for the ACK of the
+    last, resending the group when the ACK does not come in time. A
+    `ResponseReceiver` takes in the APP messages of a response, in any order,
+    and hands back the messages to apply to the content in order, ACKing them
+    as the protocol requires.
+
+    Neither reads a socket or a clock. The code driving a machine passes in
+    each datagram or message received and the time it was received, calls
+    `handle_timer` once the machine's `deadline` has passed, and sends the
+    datagrams returned by `datagrams_to_send`. The blocking functions in
+    `RDP_Protocol` and `RDP_Client` drive the machines over a socket; other
+    drivers (an event loop, a batched socket, or a benchmark exchanging
+    datagrams between two machines in memory, see `a3.bench.RDP_MachineBench`)
+    drive them in the same way.
+"""
+import logging
+
+from .RDP_FEC import FECGroup
+from .RDP_Protocol import DEFAULT_ACK_TIMEOUT_SECONDS, \
+    DEFAULT_RETRY_THRESHOLD, OPTION_FEC, ChecksumError, create_ack_message, \
+    is_ack_for_message, message_from_bytes, message_to_bytes
+
+# A response is abandoned if the server sends nothing for this long
+RESPONSE_IDLE_TIMEOUT = DEFAULT_ACK_TIMEOUT_SECONDS * DEFAULT_RETRY_THRESHOLD
+
+
+class _Machine:
+    """ The output queue and datagram parsing shared by the machines.
+    """
+
+    def __init__(self, remote_adr):
+        self.remote_adr = remote_adr
+        self.deadline = None  # When `handle_timer` is next due, if ever
+        self._outbox = []
+
+    def datagrams_to_send(self):
+        """ Takes the datagrams queued for sending to `remote_adr`.
+
+        :return: A list of `bytes`
+        """
+        datagrams, self._outbox = self._outbox, []
+        return datagrams
+
+    def _send(self, message):
+        self._outbox.append(bytes(message_to_bytes(message)))
+
+    def receive_datagram(self, data, src_adr, now):
+        """ Parses a datagram and passes it to `receive_message`. Corrupt
+        datagrams are treated as lost.
+        """
+        try:
+            message = message_from_bytes(data, src_adr)
+        except ChecksumError as e:
+            logging.debug("Dropping corrupt packet: %s", e)
+            return self._nothing_received()
+        return self.receive_message(message, now)
+
+    def receive_message(self, message, now):
+        raise NotImplementedError
+
+    def _nothing_received(self):
+        return None
+
+
+class Transmission(_Machine):
+    """ Sends a group of messages and waits for an ACK of the last one, which
+    acknowledges the whole group. The group is resent each time the ACK does
+    not arrive within `ack_timeout` of the group being sent, up to `retries`
+    times.
+    """
+
+    def __init__(self,
+                 messages,
+                 remote_adr,
+                 metrics=None,
+                 ack_timeout=DEFAULT_ACK_TIMEOUT_SECONDS,
+                 retries=DEFAULT_RETRY_THRESHOLD):
+        """
+        :param metrics An optional `RDP_Metrics.ConnectionMetrics` to update
+        with retransmissions, timeouts and round trip times
+        """
+        super().__init__(remote_adr)
+        self.last = messages[-1]
+        # Encoded once, however many times they are sent
+        self.datagrams = [bytes(message_to_bytes(m)) for m in messages]
+        self.metrics = metrics
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.attempts = 0
+        self.ack = None  # The ACK, once received
+        self.failed = False  # True once every attempt has timed out
+        self.sent_at = None  # When the current attempt started
+        self.last_sent_at = None  # When its last datagram left
+
+    def is_done(self):
+        return self.ack is not None or self.failed
+
+    def start(self, now):
+        """ Queues the first attempt.
+        """
+        self._attempt(now)
+
+    def _attempt(self, now):
+        self.attempts += 1
+        self.sent_at = now
+        self._outbox.extend(self.datagrams)
+        self.sent(now)
+
+    def sent(self, now):
+        """ Records that the queued datagrams had all been sent by `now`, so
+        the wait for the ACK starts from then. A driver which paces the
+        datagrams out should call this once the last has gone.
+        """
+        self.last_sent_at = now
+        self.deadline = now + self.ack_timeout
+
+    def receive_message(self, message, now):
+        """ Takes a message from the network.
+
+        :return: True if it is the ACK
+        """
+        if message.src_adr != self.remote_adr and self.metrics and \
+                message.size is not None:
+            self.metrics.record_foreign_datagram(message.size)
+        if self.is_done() or message.src_adr != self.remote_adr or \
+                not is_ack_for_message(self.last, message):
+            logging.debug("Received message from %s, but not valid ACK.",
+                          message.src_adr)
+            return False
+
+        self.ack = message
+        self.deadline = None
+        if self.attempts > 1:
+            logging.debug("ACK received after %d attempts", self.attempts)
+        elif self.metrics:
+            # Only unambiguous samples are used (Karn's algorithm)
+            self.metrics.record_rtt(now - self.sent_at)
+        self._record_retransmissions()
+        return True
+
+    def _nothing_received(self):
+        return False
+
+    def handle_timer(self, now):
+        """ Resends the group, or gives up, if the ACK is overdue.
+        """
+        if self.is_done() or now < self.deadline:
+            return
+        if self.metrics:
+            self.metrics.timeouts += 1
+        if self.attempts <= self.retries:
+            self._attempt(now)
+            return
+
+        self.failed = True
+        self.deadline = None
+        self._record_retransmissions()
+        logging.warning("Failed to receive ACK after {} retries"
+                        .format(self.retries))
+
+    def _record_retransmissions(self):
+        if self.metrics:
+            self.metrics.retransmissions += \
+                (self.attempts - 1) * len(self.datagrams)
+
+
+class ResponseReceiver(_Machine):
+    """ Receives the APP messages of one response on a connection.
+
+    Messages are ACKed one at a time or, when FEC is in use, a group at a time
+    once every data message of the group has arrived or can be rebuilt from
+    its parity. The receiver updates the connection's sequence numbers as it
+    goes, and leaves the payloads, including their HTTP status, for the caller
+    to interpret.
+    """
+
+    def __init__(self, connection, now, idle_timeout=RESPONSE_IDLE_TIMEOUT):
+        """
+        :param connection The `RDP_Protocol.Connection` the response arrives
+        on. Its FEC group size is taken from its options.
+        """
+        super().__init__(connection.remote_adr)
+        self.connection = connection
+        self.group_size = int(connection.options.get(OPTION_FEC, 0))
+        self.idle_timeout = idle_timeout
+        self.deadline = now + idle_timeout
+        self.group = None  # The RDP_FEC.FECGroup being received
+        self.failed = False  # True once an unexpected message arrived
+        self.timed_out = False  # True once the server stopped sending
+
+    def receive_message(self, message, now):
+        """ Takes an APP message from the server.
+
+        :return: The messages whose payloads now follow the content received
+        so far, in order
+        """
+        if message.src_adr != self.remote_adr:
+            logging.warning("Dropping packet from bad sender.")
+            return []
+        self.deadline = now + self.idle_timeout
+        if self.group_size:
+            return self._receive_fec(message)
+        return self._receive(message)
+
+    def _nothing_received(self):
+        return []
+
+    def handle_timer(self, now):
+        if now >= self.deadline:
+            logging.error("Server stopped responding.")
+            self.timed_out = True
+            self.deadline = None
+
+    def _ack(self, ack_no):
+        conn = self.connection
+        self._send(create_ack_message(conn.seq_num, ack_no,
+                                      conn.header_flags()))
+
+    def _receive(self, message):
+        conn = self.connection
+        if message.seq_no == conn.next_expected_index():
+            self._ack(message.seq_no)
+            conn.increment_next_expected_index()
+            return [message]
+
+        elif message.seq_no == conn.last_index_received:
+            # Our ACK was lost. We have already processed this message.
+            logging.debug("Re-ACKing seq {}".format(message.seq_no))
+            self._ack(message.seq_no)
+            return []
+
+        logging.error("Bad sequence number {} during file transfer. "
+                      "Expected {}.".format(message.seq_no,
+                                            conn.next_expected_index()))
+        self.failed = True
+        return []
+
+    def _receive_fec(self, message):
+        conn = self.connection
+        group = self.group
+        if group is None:
+            group = self.group = FECGroup(conn.next_expected_index(),
+                                          self.group_size)
+
+        if not group.contains(message.seq_no):
+            # The ACK for the previous group was lost, so it was sent again
+            logging.debug("Re-ACKing seq {}".format(conn.last_index_received))
+            self._ack(conn.last_index_received)
+            return []
+
+        group.add(message)
+        if not group.is_complete():
+            return []
+
+        self.group = None
+        conn.last_index_received = group.last_seq()
+        self._ack(group.last_seq())
+        return group.messages()
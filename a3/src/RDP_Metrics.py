@@ -0,0 +1,274 @@
+"""
+    Counters and histograms describing RDP connections.
+
+    Each connection carries a `ConnectionMetrics` object which is updated in
+    place as packets are exchanged. Updates are plain attribute increments, so
+    collection is cheap enough to leave on. When a connection ends its metrics
+    are folded into a `MetricsRegistry`, which holds totals for the whole
+    process and can be exported as JSON or in the Prometheus text format,
+    either on demand or periodically by a `MetricsDumper`.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10]
+BYTES_PER_SECOND_BUCKETS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7,
+                            10 ** 8, 10 ** 9]
+
+COUNTER_NAMES = ["packets_sent", "packets_received", "bytes_sent",
+                 "bytes_received", "retransmissions", "timeouts"]
+
+DEFAULT_DUMP_INTERVAL_SECONDS = 10
+
+
+class Histogram:
+    """ A histogram with fixed bucket boundaries.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def merge_snapshot(self, data):
+        """ Adds the observations in a `snapshot()` of a histogram with the
+        same bounds.
+        """
+        for i, count in enumerate(data["buckets"].values()):
+            self.counts[i] += count
+        self.count += data["count"]
+        self.sum += data["sum"]
+
+    def percentile(self, p):
+        """ An upper bound for the `p`th percentile (0-100), taken from the
+        bucket boundaries. `None` if nothing has been observed.
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"],
+                                self.counts)),
+        }
+
+
+class ConnectionMetrics:
+    """ Metrics for a single connection.
+
+    Packet and byte counters are taken from the connection's socket when it
+    exposes them (see `RDP_Socket.DatagramSocket`), as the difference between
+    the socket's counters when the connection started and when it finished.
+    A server's socket is shared with every client, so datagrams it receives
+    from other addresses during the connection are reported with
+    `record_foreign_datagram` and left out. (It only sends to the connection's
+    peer while the connection lasts.)
+    """
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        # Sockets on a virtual clock (see RDP_SimNet) keep their own time
+        self._clock = getattr(sock, "clock", time.monotonic)
+        self.started = self._clock()
+        for name in COUNTER_NAMES:
+            setattr(self, name, 0)
+        self._socket_base = _socket_counters(sock)
+        self._foreign_packets = 0
+        self._foreign_bytes = 0
+
+        self.rtt = Histogram(SECONDS_BUCKETS)
+        self.handshake_latency = None
+        self.transfer_bytes = 0
+        self.transfer_seconds = 0.0
+
+    def record_rtt(self, seconds):
+        self.rtt.observe(seconds)
+
+    def record_foreign_datagram(self, nbytes):
+        """ Records a datagram received on the socket during the connection
+        from an address other than the connection's peer.
+        """
+        self._foreign_packets += 1
+        self._foreign_bytes += nbytes
+
+    def record_handshake(self):
+        self.handshake_latency = self._clock() - self.started
+
+    def record_transfer(self, nbytes, seconds):
+        self.transfer_bytes += nbytes
+        self.transfer_seconds += seconds
+
+    def goodput(self):
+        """ Application bytes delivered per second of transfer time.
+        """
+        if not self.transfer_seconds:
+            return None
+        return self.transfer_bytes / self.transfer_seconds
+
+    def finish(self):
+        """ Captures the socket counters accumulated during the connection.
+        """
+        current = _socket_counters(self.sock)
+        if current and self._socket_base:
+            for name, value in current.items():
+                setattr(self, name, value - self._socket_base[name])
+            self.packets_received -= self._foreign_packets
+            self.bytes_received -= self._foreign_bytes
+            self._socket_base = current
+        self._foreign_packets = 0
+        self._foreign_bytes = 0
+
+
+def _socket_counters(sock):
+    if sock is None or not hasattr(sock, "packets_sent"):
+        return None
+    return {name: getattr(sock, name) for name in COUNTER_NAMES[:4]}
+
+
+class MetricsRegistry:
+    """ Process wide totals, built up from finished connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {name: 0 for name in COUNTER_NAMES}
+        self.counters.update(connections=0, abandoned_connections=0)
+        self.rtt = Histogram(SECONDS_BUCKETS)
+        self.handshake_latency = Histogram(SECONDS_BUCKETS)
+        self.goodput = Histogram(BYTES_PER_SECOND_BUCKETS)
+
+    def record_connection(self, metrics, abandoned=False):
+        metrics.finish()
+        with self._lock:
+            for name in COUNTER_NAMES:
+                self.counters[name] += getattr(metrics, name)
+            self.counters["connections"] += 1
+            if abandoned:
+                self.counters["abandoned_connections"] += 1
+
+            self.rtt.merge(metrics.rtt)
+            if metrics.handshake_latency is not None:
+                self.handshake_latency.observe(metrics.handshake_latency)
+            goodput = metrics.goodput()
+            if goodput is not None:
+                self.goodput.observe(goodput)
+
+    def _histograms(self):
+        return {
+            "rtt_seconds": self.rtt,
+            "handshake_latency_seconds": self.handshake_latency,
+            "goodput_bytes_per_second": self.goodput,
+        }
+
+    def snapshot(self):
+        """ A point in time copy of all metrics as plain data.
+        """
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.snapshot() for name, histogram
+                               in self._histograms().items()},
+            }
+
+    def merge_snapshot(self, snapshot):
+        """ Adds the totals in a `snapshot()`, e.g. one taken by another
+        process, to this registry.
+        """
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in self._histograms().items():
+                histogram.merge_snapshot(snapshot["histograms"][name])
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="rdp_"):
+        """ Formats the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot["counters"].items():
+            metric = prefix + name + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+
+        for name, data in snapshot["histograms"].items():
+            metric = prefix + name
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, count in data["buckets"].items():
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'
+                             .format(metric, bound, cumulative))
+            lines.append("{}_sum {}".format(metric, data["sum"]))
+            lines.append("{}_count {}".format(metric, data["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsDumper(threading.Thread):
+    """ A daemon thread which periodically writes a registry to a file.
+
+    The file is replaced atomically, so readers never see a partial dump.
+    """
+
+    def __init__(self,
+                 registry,
+                 path,
+                 interval=DEFAULT_DUMP_INTERVAL_SECONDS,
+                 fmt="json"):
+        super().__init__(daemon=True)
+        if fmt not in ("json", "prometheus"):
+            raise ValueError("Unknown metrics format '{}'".format(fmt))
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt
+        self._stopped = threading.Event()
+
+    def dump(self):
+        text = self.registry.to_json() if self.fmt == "json" \
+            else self.registry.to_prometheus()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.dump()
+            except OSError as e:
+                logging.warning("Unable to write metrics: {}".format(e))
+
+    def stop(self):
+        self._stopped.set()
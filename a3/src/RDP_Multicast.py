@@ -0,0 +1,415 @@
+"""
+    One-to-many file distribution with NAK-based repair.
+
+    A `Distributor` sends a file once to a multicast group, or to each of a set
+    of receivers, as numbered DATA packets followed by an END packet which
+    announces the number of packets, the file's size and its md5 digest. Each
+    `MulticastReceiver` answers the END with a NAK listing the ranges of
+    packets it is missing, or with DONE (and a random id) once it has them
+    all and they match the digest. A receiver whose packets do not match
+    discards them and NAKs the whole file. The distributor collects the
+    feedback of every receiver for `feedback_window` seconds, sends each
+    packet missed by any receiver once, and announces the END again. It stops
+    once the expected number of receivers are DONE, after `quiet_rounds`
+    rounds in a row with no NAKs, or after `max_rounds` rounds.
+
+    Sent to a multicast group, data and repairs go out once however many
+    receivers there are, so the distributor's send volume depends on the loss
+    rate rather than on the number of receivers.
+
+    Packets have their own header rather than the RDP header, as an 8 bit
+    sequence number cannot index the packets of a file:
+
+        python3 -m a3.src.RDP_Multicast send <File> 239.255.42.99:5007
+        python3 -m a3.src.RDP_Multicast receive 239.255.42.99 5007 <Result File>
+"""
+import argparse
+import hashlib
+import ipaddress
+import logging
+import random
+import socket
+import struct
+import time
+
+from . import RDP_Pacing
+from .RDP_Protocol import MAX_PACKET_SIZE
+from .RDP_Socket import wrap_socket
+
+logging.basicConfig(level=logging.INFO)
+
+TYPE_DATA = 1
+TYPE_END = 2
+TYPE_NAK = 3
+TYPE_DONE = 4
+
+_HEADER = struct.Struct("!BIII")  # Type, session, index, count
+_END = struct.Struct("!Q16s")  # File size, md5 digest
+_RANGE = struct.Struct("!II")  # First missing index, index after the last
+
+MAX_CHUNK_SIZE = MAX_PACKET_SIZE - _HEADER.size
+MAX_NAK_RANGES = MAX_CHUNK_SIZE // _RANGE.size
+
+ANY_INTERFACE = "0.0.0.0"
+MULTICAST_TTL = 1  # Distributions stay on the local network
+
+DEFAULT_FEEDBACK_WINDOW_SECONDS = 0.2
+DEFAULT_QUIET_ROUNDS = 3
+DEFAULT_MAX_ROUNDS = 100
+DEFAULT_RECEIVE_TIMEOUT_SECONDS = 10
+
+
+def is_multicast(adr):
+    return ipaddress.ip_address(adr[0]).is_multicast
+
+
+def _pack(packet_type, session, index, count, payload=b""):
+    return _HEADER.pack(packet_type, session, index, count) + payload
+
+
+def _unpack(data):
+    """ :return: A `(type, session, index, count, payload)` tuple, or `None`
+    if the datagram is too short to be a packet
+    """
+    if len(data) < _HEADER.size:
+        return None
+    return _HEADER.unpack_from(data) + (bytes(data[_HEADER.size:]),)
+
+
+def missing_ranges(received, count):
+    """ The indexes below `count` which are not in `received`, as a list of
+    `(first, end)` ranges.
+    """
+    ranges = []
+    start = None
+    for i in range(count):
+        if i not in received:
+            if start is None:
+                start = i
+        elif start is not None:
+            ranges.append((start, i))
+            start = None
+    if start is not None:
+        ranges.append((start, count))
+    return ranges
+
+
+class Distributor:
+    """ Sends files to a multicast group or a set of receivers. See the module
+    docstring.
+    """
+
+    def __init__(self,
+                 destinations,
+                 interface=ANY_INTERFACE,
+                 receivers=None,
+                 pacing=None,
+                 feedback_window=DEFAULT_FEEDBACK_WINDOW_SECONDS,
+                 quiet_rounds=DEFAULT_QUIET_ROUNDS,
+                 max_rounds=DEFAULT_MAX_ROUNDS):
+        """
+        :param destinations `(ip, port)` addresses to send every packet to:
+        a multicast group, or the addresses of the receivers
+        :param interface The address of the interface to send from
+        :param receivers The number of receivers expected to report DONE, or
+        `None` to stop only once the receivers stop sending NAKs
+        :param pacing A fixed rate in bytes per second to pace packets at (see
+        `RDP_Pacing`), or `None` to send them back to back
+        """
+        self.destinations = list(destinations)
+        self.receivers = receivers
+        self.pacer = RDP_Pacing.create_pacer(pacing) if pacing else None
+        self.feedback_window = feedback_window
+        self.quiet_rounds = quiet_rounds
+        self.max_rounds = max_rounds
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if any(is_multicast(adr) for adr in self.destinations):
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                            MULTICAST_TTL)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if interface != ANY_INTERFACE:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                socket.inet_aton(interface))
+        sock.bind((interface, 0))
+        self.sock = wrap_socket(sock)
+        self.adr = self.sock.getsockname()  # Where feedback is sent
+
+        self.rounds = 0
+        self.packets_sent = 0  # Datagrams, counting each destination
+        self.repairs_sent = 0  # DATA packets sent again
+        self.naks_received = 0
+        self.done = set()  # (address, id) of receivers which reported DONE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def distribute(self, data):
+        """ Distributes the content of a file.
+
+        :return: True if every expected receiver reported DONE or, if no
+        number is expected, the receivers stopped sending NAKs
+        """
+        session = random.getrandbits(32)
+        chunks = [data[i:i + MAX_CHUNK_SIZE]
+                  for i in range(0, len(data), MAX_CHUNK_SIZE)] or [b""]
+        count = len(chunks)
+        end = _pack(TYPE_END, session, 0, count,
+                    _END.pack(len(data), hashlib.md5(data).digest()))
+        logging.info("Distributing {} bytes in {} packets to {}".format(
+            len(data), count, self.destinations))
+
+        self.done = set()
+        self._send([_pack(TYPE_DATA, session, i, count, chunk)
+                    for i, chunk in enumerate(chunks)])
+        quiet = 0
+        for self.rounds in range(1, self.max_rounds + 1):
+            self._send([end])
+            missing = self._collect_feedback(session, count)
+            if self.receivers and len(self.done) >= self.receivers:
+                logging.info("All {} receivers done after {} round(s)".format(
+                    self.receivers, self.rounds))
+                return True
+            if missing:
+                quiet = 0
+                logging.debug("Round {}: repairing {} packet(s)".format(
+                    self.rounds, len(missing)))
+                self.repairs_sent += len(missing)
+                self._send([_pack(TYPE_DATA, session, i, count, chunks[i])
+                            for i in sorted(missing)])
+                continue
+            quiet += 1
+            if quiet >= self.quiet_rounds:
+                if self.receivers:
+                    logging.warning("Only {} of {} receivers done".format(
+                        len(self.done), self.receivers))
+                    return False
+                logging.info("No NAKs for {} round(s). Done".format(quiet))
+                return True
+
+        logging.warning("Gave up after {} rounds".format(self.max_rounds))
+        return False
+
+    def _send(self, datagrams):
+        """ Sends each datagram to every destination, as the pacer allows.
+        """
+        if self.pacer:
+            self.pacer.start_train()
+        for datagram in datagrams:
+            for adr in self.destinations:
+                if self.pacer:
+                    delay = self.pacer.reserve(len(datagram))
+                    if delay > 0:
+                        self.sock.flush()
+                        time.sleep(delay)
+                    self.pacer.sent(len(datagram))
+                self.sock.queue(datagram, adr)
+                self.packets_sent += 1
+        self.sock.flush()
+
+    def _collect_feedback(self, session, count):
+        """ Reads feedback for `feedback_window` seconds.
+
+        :return: The set of indexes of packets any receiver is missing
+        """
+        missing = set()
+        stop_time = time.monotonic() + self.feedback_window
+        while True:
+            remaining = stop_time - time.monotonic()
+            if remaining <= 0:
+                return missing
+            self.sock.settimeout(remaining)
+            try:
+                data, src_adr = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                return missing
+            packet = _unpack(data)
+            if not packet or packet[1] != session:
+                continue
+            packet_type, _, index, ranges, payload = packet
+            if packet_type == TYPE_DONE:
+                # Receivers sharing a group's port share an address too
+                self.done.add((src_adr, index))
+            elif packet_type == TYPE_NAK:
+                self.naks_received += 1
+                for i in range(min(ranges, len(payload) // _RANGE.size)):
+                    first, end = _RANGE.unpack_from(payload, i * _RANGE.size)
+                    missing.update(range(first, min(end, count)))
+
+
+class MulticastReceiver:
+    """ Receives a file from a `Distributor`.
+    """
+
+    def __init__(self, adr, interface=ANY_INTERFACE, loss=0.0, seed=None):
+        """
+        :param adr A multicast group and port to join, or the local address
+        to receive on from a distributor sending to a set of receivers. A port
+        of 0 picks a free port, held by `adr` afterwards.
+        :param interface The address of the interface to join the group on
+        :param loss A fraction of incoming datagrams to drop, to simulate a
+        lossy network
+        """
+        self.loss = loss
+        self._random = random.Random(seed)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if is_multicast(adr):
+            # Several receivers on one host may share the group's port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", adr[1]))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(adr[0]) +
+                            socket.inet_aton(interface))
+            self.adr = adr[0], sock.getsockname()[1]
+        else:
+            sock.bind(adr)
+            self.adr = sock.getsockname()
+        self.sock = wrap_socket(sock)
+        self.id = random.getrandbits(32)  # Sent with DONE
+        self.naks_sent = 0
+        self.dropped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def receive(self, timeout=DEFAULT_RECEIVE_TIMEOUT_SECONDS):
+        """ Receives the next distribution, asking for any packets missed.
+
+        :param timeout Seconds to wait for a packet before giving up
+        :return: The content, or `None` if the distributor stopped sending
+        before it was received intact
+        """
+        chunks = {}
+        session = None
+        stop_time = time.monotonic() + timeout
+        while True:
+            remaining = stop_time - time.monotonic()
+            if remaining <= 0:
+                logging.error("Distributor stopped sending. Received {} "
+                              "packet(s)".format(len(chunks)))
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data, src_adr = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                continue
+            if self.loss and self._random.random() < self.loss:
+                self.dropped += 1
+                continue
+
+            packet = _unpack(data)
+            if not packet or packet[0] not in (TYPE_DATA, TYPE_END):
+                continue
+            packet_type, packet_session, index, count, payload = packet
+            if session is None:
+                session = packet_session
+                logging.info("Receiving distribution from {}".format(src_adr))
+            elif packet_session != session:
+                continue
+            stop_time = time.monotonic() + timeout
+
+            if packet_type == TYPE_DATA:
+                if index < count:
+                    chunks.setdefault(index, payload)
+                continue
+
+            missing = missing_ranges(chunks, count)
+            if missing:
+                self._send_nak(session, missing, src_adr)
+                continue
+
+            size, digest = _END.unpack_from(payload)
+            content = b"".join(chunks[i] for i in range(count))
+            if len(content) != size or \
+                    hashlib.md5(content).digest() != digest:
+                # There is no telling which packets are corrupt
+                logging.warning("Content does not match the distributor's "
+                                "digest. Asking for all of it again")
+                chunks.clear()
+                self._send_nak(session, [(0, count)], src_adr)
+                continue
+            self.sock.sendto(_pack(TYPE_DONE, session, self.id, count),
+                             src_adr)
+            logging.info("Received {} bytes after {} NAK(s)".format(
+                size, self.naks_sent))
+            return content
+
+    def _send_nak(self, session, missing, adr):
+        ranges = missing[:MAX_NAK_RANGES]
+        payload = b"".join(_RANGE.pack(*r) for r in ranges)
+        self.sock.sendto(_pack(TYPE_NAK, session, 0, len(ranges), payload),
+                         adr)
+        self.naks_sent += 1
+
+
+def _parse_destination(text):
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.src.RDP_Multicast")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="Distribute a file")
+    send.add_argument("filename", metavar="<File>")
+    send.add_argument("destinations", metavar="<IP>:<Port>", nargs="+",
+                      type=_parse_destination,
+                      help="A multicast group, or the address of each "
+                           "receiver")
+    send.add_argument("--receivers", type=int,
+                      help="Stop as soon as this many receivers have the "
+                           "whole file")
+    send.add_argument("--interface", default=ANY_INTERFACE,
+                      help="Address of the interface to send from")
+    send.add_argument("--pace", type=RDP_Pacing.parse_setting,
+                      metavar="RATE",
+                      help="Pace packets at RATE bytes per second (e.g. 20M)")
+
+    receive = commands.add_parser("receive", help="Receive a distribution")
+    receive.add_argument("ip", metavar="<IP>",
+                         help="A multicast group to join, or a local address")
+    receive.add_argument("port", metavar="<Port>", type=int)
+    receive.add_argument("result_filename", metavar="<Result File>")
+    receive.add_argument("--interface", default=ANY_INTERFACE,
+                         help="Address of the interface to join the group on")
+    receive.add_argument("--timeout", type=float,
+                         default=DEFAULT_RECEIVE_TIMEOUT_SECONDS,
+                         help="Seconds to wait for the distributor")
+    args = parser.parse_args()
+    if args.command == "send" and args.pace == RDP_Pacing.AUTO:
+        parser.error("Distributions are paced at a fixed rate")
+    return args
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    if args.command == "send":
+        with open(args.filename, "rb") as f:
+            content = f.read()
+        with Distributor(args.destinations, args.interface, args.receivers,
+                         args.pace) as distributor:
+            distributor.distribute(content)
+            logging.info("Sent {} datagram(s), {} repair(s), in {} round(s)"
+                         .format(distributor.packets_sent,
+                                 distributor.repairs_sent, distributor.rounds))
+    else:
+        with MulticastReceiver((args.ip, args.port),
+                               args.interface) as receiver:
+            content = receiver.receive(args.timeout)
+        if content is not None:
+            with open(args.result_filename, "wb") as f:
+                f.write(content)
+            logging.info("Created '{}'".format(args.result_filename))
@@ -0,0 +1,166 @@
+"""
+    Rate-based pacing for RDP senders.
+
+    When a sender has several packets in flight at once (an FEC group), sending
+    them back to back puts a burst on the wire that can overflow socket buffers
+    along the path and cause loss of its own making. A `Pacer` spreads the
+    packets out at a target rate instead, using a `TokenBucket` refilled from a
+    monotonic clock: each packet takes its size in tokens, and the sender
+    sleeps until the bucket is no longer in debt before the next packet goes.
+    Delays are computed from the monotonic clock in fractions of a second and
+    slept by the sender with `time.sleep`, which is accurate to well under a
+    millisecond on Linux.
+
+    The target rate is either fixed, or derived from the measured round trip
+    time as `gain * window / srtt`, where the window is the number of bytes
+    sent per round trip. Until a round trip has been measured, a derived pacer
+    does not delay packets. The rate achieved over paced groups is kept so it
+    can be compared with the target.
+"""
+import time
+
+# Bytes which may be sent back to back before pacing applies
+DEFAULT_BURST_BYTES = 1024  # Matches RDP_Protocol.MAX_PACKET_SIZE
+
+# A derived rate is this multiple of window / srtt, so a window is sent in
+# half a round trip and pacing never becomes the bottleneck
+DEFAULT_GAIN = 2.0
+
+# Pacing setting for a rate derived from the round trip time
+AUTO = "auto"
+
+# Weight of each new sample in the smoothed round trip time (RFC 6298)
+_RTT_ALPHA = 0.125
+
+
+class TokenBucket:
+    """ A bucket holding up to `burst` tokens, refilled at `rate` per second.
+
+    Reservations may take the bucket into debt; the caller then waits for the
+    debt to be repaid, so packets are never refused, only delayed.
+    """
+
+    def __init__(self, rate, burst=DEFAULT_BURST_BYTES, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, n):
+        """ Takes `n` tokens from the bucket.
+
+        :return: The number of seconds to wait before using them
+        """
+        self._refill()
+        self._tokens -= n
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class Pacer:
+    """ Paces the packets of a connection at a fixed or derived rate, in bytes
+    per second.
+    """
+
+    def __init__(self,
+                 rate=None,
+                 burst=DEFAULT_BURST_BYTES,
+                 gain=DEFAULT_GAIN,
+                 clock=time.monotonic):
+        """
+        :param rate A fixed target rate, or `None` to derive it from the
+        window and round trip time passed to `update`
+        """
+        self.fixed_rate = rate
+        self.gain = gain
+        self.clock = clock
+        self.srtt = None
+        self._bucket = TokenBucket(rate, burst, clock) if rate else None
+        self._burst = burst
+        self._train_bytes = 0  # Bytes sent after the first packet of a train
+        self._train_seconds = 0
+        self._train_last = None  # When the train's latest packet was sent
+        self.waited_seconds = 0
+
+    def target_rate(self):
+        """ The rate packets are currently paced at, or `None` if they are not
+        yet paced.
+        """
+        return self._bucket.rate if self._bucket else None
+
+    def achieved_rate(self):
+        """ The rate at which packets left within paced trains, or `None` if
+        no train has had more than one packet.
+        """
+        if not self._train_seconds:
+            return None
+        return self._train_bytes / self._train_seconds
+
+    def update(self, window, rtt):
+        """ Adds a round trip time sample, taken from the last packet of a
+        window of `window` bytes, and rederives the target rate.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += _RTT_ALPHA * (rtt - self.srtt)
+        if self.fixed_rate or self.srtt <= 0:
+            return
+        rate = self.gain * window / self.srtt
+        if self._bucket:
+            self._bucket.rate = rate
+        else:
+            self._bucket = TokenBucket(rate, self._burst, self.clock)
+
+    def start_train(self):
+        """ Marks the start of a group of packets sent together.
+        """
+        self._train_last = None
+
+    def reserve(self, n):
+        """ Reserves `n` bytes of the rate.
+
+        :return: The number of seconds to wait before sending them
+        """
+        if not self._bucket:
+            return 0
+        delay = self._bucket.reserve(n)
+        if delay > 0:
+            self.waited_seconds += delay
+        return delay
+
+    def sent(self, n):
+        """ Records that `n` bytes of the current train have been sent.
+        """
+        now = self.clock()
+        if self._train_last is not None:
+            self._train_bytes += n
+            self._train_seconds += now - self._train_last
+        self._train_last = now
+
+
+def create_pacer(setting, clock=time.monotonic):
+    """ Creates a pacer from a setting: `None` for no pacing, `AUTO` for a
+    derived rate, or a fixed rate in bytes per second.
+    """
+    if setting is None:
+        return None
+    return Pacer(None if setting == AUTO else float(setting), clock=clock)
+
+
+def parse_setting(text):
+    """ Parses a pacing setting given on the command line, e.g. `auto`, `5e6`
+    or `2M` (bytes per second).
+    """
+    if text == AUTO:
+        return AUTO
+    multiplier = {"K": 1e3, "M": 1e6, "G": 1e9}.get(text[-1:].upper(), 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return float(text) * multiplier
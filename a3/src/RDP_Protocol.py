@@ -6,11 +6,18 @@
 import logging
 import socket
 import time
+import zlib
+
+from .RDP_Trace import RECEIVED, SENT, TRACE
 
 # Packet Parameters
 MAX_PACKET_SIZE = 1024
 HEADER_SIZE = 6
 MAX_PAYLOAD_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
+# AF_UNIX datagrams are not fragmented, so may be larger (see RDP_Socket)
+UNIX_MAX_PACKET_SIZE = 65536
+# The largest payload length the header can hold
+MAX_ENCODED_PAYLOAD_SIZE = 0xFFFF
 MAX_SEQ_NUMBER = 255
 MAX_ACK_NUMBER = 255
 
@@ -22,6 +29,9 @@ FIN_KEEP_ALIVE = DEFAULT_ACK_TIMEOUT_SECONDS * 2
 # HTTP-Related
 HTTP_OK_ENCODED = b'200'
 HTTP_FILE_NOT_FOUND_ENCODED = b'404'
+HTTP_BAD_REQUEST_ENCODED = b'400'
+# Such as a file manifest which is not built yet. Ask again later.
+HTTP_UNAVAILABLE_ENCODED = b'503'
 HTTP_CODE_LEN = 3  # Bytes to encode 3 digit HTTP code
 
 # Ugly, but we need bidirectional mapping and this is unlikely to change.
@@ -33,6 +43,46 @@ PACKET_TYPES_IDS = {
 }
 PACKET_IDS_TYPES = ["ACK", "SYN", "FIN", "APP"]
 
+# Header flags, held in the second header byte
+FLAG_END_OF_RESPONSE = 0x01  # Last APP message of a persistent response
+FLAG_PARITY = 0x02  # APP message holding the parity of an FEC group
+FLAG_CRC = 0x04  # A CRC32 of the packet follows the header
+FLAG_DIGEST = 0x08  # Last APP message of a response, ending with its digest
+FLAG_SIZE = 0x10  # First APP message of a response, starting with its size
+
+CRC_SIZE = 4
+DIGEST_SIZE = 16  # md5
+SIZE_FIELD_SIZE = 8  # Total size of a response body, in bytes
+
+# Connection options are exchanged as NUL separated key=value pairs
+OPTION_SEPARATOR = b"\x00"
+OPTION_COMPRESS = "compress"
+OPTION_PERSIST = "persist"
+OPTION_FEC = "fec"
+OPTION_CRC = "crc"
+OPTION_DIGEST = "digest"
+OPTION_SIZE = "size"
+OPTION_DEDUP = "dedup"  # The server answers MANIFEST requests
+DIGEST_MD5 = "md5"
+
+# GET requests carry the filename, optionally followed by request fields
+# encoded in the same way as connection options.
+REQUEST_OFFSET = "offset"
+REQUEST_LENGTH = "length"
+REQUEST_METHOD = "method"
+METHOD_HEAD = "HEAD"  # Respond with the file size rather than its content
+# Respond with the file's chunk manifest (see `RDP_Chunking`)
+METHOD_MANIFEST = "MANIFEST"
+
+# A fast open SYN carries a GET request after its options, separated from them
+# by an empty entry.
+SYN_REQUEST_SEPARATOR = OPTION_SEPARATOR * 2
+
+
+class ChecksumError(ValueError):
+    """ Raised when a packet does not match its CRC.
+    """
+
 
 class Connection:
     """ Represents an RDP connection between the owner of an instance and some
@@ -42,6 +92,8 @@ class Connection:
         self.remote_adr = remote_adr
         self.last_index_received = remote_seq_num % MAX_SEQ_NUMBER
         self.seq_num = seq_num % MAX_SEQ_NUMBER
+        self.options = {}  # Negotiated during connection establishment
+        self.metrics = None  # An optional RDP_Metrics.ConnectionMetrics
 
     @staticmethod
     def _increment(n):
@@ -62,6 +114,11 @@ class Connection:
     def increment_next_expected_index(self):
         self.last_index_received = self.next_expected_index()
 
+    def header_flags(self):
+        """ The flags to set on every message sent on this connection.
+        """
+        return FLAG_CRC if self.options.get(OPTION_CRC) == "1" else 0
+
 
 class Message:
     """ Represents an RDP message with header fields and a payload.
@@ -73,7 +130,8 @@ class Message:
                  ack_no,
                  payload=bytearray(),
                  src_adr=None,
-                 dest_adr=None):
+                 dest_adr=None,
+                 flags=0):
         """ Not for external use. Use factory methods to ensure consistency.
         """
 
@@ -83,6 +141,8 @@ class Message:
         self.payload = payload
         self.src_adr = src_adr
         self.dest_adr = dest_adr
+        self.flags = flags  # Bitwise OR of FLAG_ constants
+        self.size = None  # Of the datagram it was received in, if any
 
     def __eq__(self, other):
         return message_to_bytes(self) == message_to_bytes(other)
@@ -103,40 +163,124 @@ class Message:
     def is_ack_only(self):
         return self.packet_type == "ACK"
 
+    def is_end_of_response(self):
+        return bool(self.flags & FLAG_END_OF_RESPONSE)
+
+    def is_parity(self):
+        return bool(self.flags & FLAG_PARITY)
+
     def get_payload_as_text(self):
         return self.payload.decode()
 
 
-def create_syn_message(seq_no, ack_no=None):
+def create_syn_message(seq_no,
+                       ack_no=None,
+                       options=None,
+                       request=None,
+                       flags=0):
     """ Utility to create an RDP SYN message
+
+    :param options A dict of connection options to carry in the payload
+    :param request An encoded GET request to carry in the payload (fast open)
+    :param flags Header flags to set
     """
-    return Message("SYN", seq_no, ack_no)
+    payload = encode_options(options or {})
+    if request is not None:
+        payload += SYN_REQUEST_SEPARATOR + request
+    return Message("SYN", seq_no, ack_no, payload, flags=flags)
 
 
-def create_ack_message(seq_no, ack_no):
+def create_ack_message(seq_no, ack_no, flags=0):
     """ Utility to create an RDP DATA message
     """
-    return Message("ACK", seq_no, ack_no)
+    return Message("ACK", seq_no, ack_no, flags=flags)
 
 
-def create_app_message(seq_no, ack_no, data):
+def create_app_message(seq_no, ack_no, data, flags=0):
     """ Utility to create an RDP APP message
 
     :param seq_no The sequence number to use
     :param ack_no The sequence number to use
     :param data The payload of the message, in binary form
+    :param flags Header flags to set
     """
-    return Message("APP", seq_no, ack_no, data)
+    return Message("APP", seq_no, ack_no, data, flags=flags)
 
 
-def create_fin_message(seq_no, ack_no):
+def create_fin_message(seq_no, ack_no, flags=0):
     """ Utility to create an RDP FIN message
     """
-    return Message("FIN", seq_no, ack_no)
+    return Message("FIN", seq_no, ack_no, flags=flags)
+
+
+def encode_options(options):
+    """ Encodes a dict of connection options as a message payload.
+    """
+    return OPTION_SEPARATOR.join("{}={}".format(key, value).encode()
+                                 for key, value in options.items())
+
+
+def decode_options(payload):
+    """ Decodes a message payload created by `encode_options`. Malformed
+    entries are ignored.
+    """
+    options = {}
+    for entry in bytes(payload).split(OPTION_SEPARATOR):
+        key, sep, value = entry.decode(errors="replace").partition("=")
+        if sep:
+            options[key] = value
+    return options
+
+
+def decode_syn_payload(payload):
+    """ Decodes the payload of a SYN message created by `create_syn_message`.
+
+    :return: An `(options, request)` pair, where `request` is the encoded GET
+    request or `None` if the SYN does not carry one
+    """
+    options, sep, request = bytes(payload).partition(SYN_REQUEST_SEPARATOR)
+    return decode_options(options), request if sep else None
+
+
+def encode_request(filename, fields=None):
+    """ Encodes a GET request payload for the given file.
+
+    :param fields A dict of request fields, e.g. a byte range
+    """
+    payload = filename.encode()
+    if fields:
+        payload += OPTION_SEPARATOR + encode_options(fields)
+    return payload
+
+
+def decode_request(payload):
+    """ Decodes a GET request payload created by `encode_request`.
+
+    :return: A `(filename, fields)` pair
+    """
+    filename, _, fields = bytes(payload).partition(OPTION_SEPARATOR)
+    return filename.decode(), decode_options(fields)
+
+
+def get_request_range(fields):
+    """ Reads the byte range from a dict of request fields.
+
+    :return: An `(offset, length)` pair. `length` is `None` if the range
+    extends to the end of the file.
+    :raises `ValueError` if the range is malformed
+    """
+    offset = int(fields.get(REQUEST_OFFSET, 0))
+    length = fields.get(REQUEST_LENGTH)
+    length = int(length) if length is not None else None
+    if offset < 0 or (length is not None and length < 0):
+        raise ValueError("Negative byte range")
+    return offset, length
 
 
 def message_from_bytes(binary_message, src_adr=None, dest_adr=None):
     """ Creates a message from the given bytearray representation.
+
+    :raises `ChecksumError` if the message carries a CRC which does not match
     """
     # First byte holds ack bit and packet type
     ack_bit_mask = 0x80  # 1000 0000
@@ -145,7 +289,8 @@ def message_from_bytes(binary_message, src_adr=None, dest_adr=None):
     packet_type_id = binary_message[0] & (~ack_bit_mask)
     packet_type = PACKET_IDS_TYPES[packet_type_id]
 
-    # Second byte is reserved
+    # Second byte holds flags
+    flags = binary_message[1]
 
     # Third byte holds sequence number
     seq_no = binary_message[2]
@@ -153,11 +298,21 @@ def message_from_bytes(binary_message, src_adr=None, dest_adr=None):
     # Fourth byte holds ACK number
     ack_no = binary_message[3] if ack_bit else None
 
-    # Remaining bytes are the payload
+    # Followed by the CRC, if flagged, then the payload
+    payload_start = HEADER_SIZE + (CRC_SIZE if flags & FLAG_CRC else 0)
     payload_len = get_payload_len(binary_message[:HEADER_SIZE])
-    payload = binary_message[HEADER_SIZE: payload_len + HEADER_SIZE]
+    payload = binary_message[payload_start: payload_len + payload_start]
 
-    return Message(packet_type, seq_no, ack_no, payload, src_adr, dest_adr)
+    if flags & FLAG_CRC:
+        crc = int.from_bytes(binary_message[HEADER_SIZE:payload_start], "big")
+        if crc != _crc(binary_message[:HEADER_SIZE], payload):
+            raise ChecksumError("Bad CRC for packet with seq {}"
+                                .format(seq_no))
+
+    message = Message(packet_type, seq_no, ack_no, payload, src_adr,
+                      dest_adr, flags)
+    message.size = len(binary_message)
+    return message
 
 
 def get_payload_len(header_bytes):
@@ -167,16 +322,23 @@ def get_payload_len(header_bytes):
     return (msb << 8) | lsb
 
 
+def _crc(header, payload):
+    return zlib.crc32(payload, zlib.crc32(header))
+
+
 def message_to_bytes(msg):
     """ Converts the given message into its binary representation
     """
-    payload_len = min(len(msg.payload), MAX_PAYLOAD_SIZE)
-    binary_msg = bytearray(HEADER_SIZE + payload_len)
+    crc_len = CRC_SIZE if msg.flags & FLAG_CRC else 0
+    payload_start = HEADER_SIZE + crc_len
+    payload_len = min(len(msg.payload), MAX_ENCODED_PAYLOAD_SIZE)
+    binary_msg = bytearray(payload_start + payload_len)
 
     packet_type = PACKET_TYPES_IDS[msg.packet_type]
     ack_bit_mask = 0x80
     first_byte = packet_type | ack_bit_mask if msg.is_ack() else packet_type
     binary_msg[0] = first_byte
+    binary_msg[1] = msg.flags
 
     binary_msg[2] = msg.seq_no
 
@@ -188,7 +350,11 @@ def message_to_bytes(msg):
     len_lsb = payload_len & 0xFF
     binary_msg[5] = len_lsb
 
-    binary_msg[6:] = msg.payload
+    binary_msg[payload_start:] = msg.payload
+
+    if crc_len:
+        crc = _crc(binary_msg[:HEADER_SIZE], binary_msg[payload_start:])
+        binary_msg[HEADER_SIZE:payload_start] = crc.to_bytes(CRC_SIZE, "big")
 
     return binary_msg
 
@@ -197,28 +363,93 @@ def is_ack_for_message(message, ack):
     return ack.is_ack() and message.seq_no == ack.ack_no
 
 
-def send_until_ack_in(message, sock, remote_adr):
+def send_until_ack_in(message, sock, remote_adr, metrics=None):
     """ Transmits the message given and waits for an ACK.
 
     Sends the message in binary form to the given address via the given
     socket. The message will be re-sent after each timeout until either an
     ACK is received or the maximum number of timeouts is reached.
 
+    :param metrics: An optional `RDP_Metrics.ConnectionMetrics` to update with
+    retransmissions, timeouts and round trip times
     :return: The ACK `Message` if received,  `None` otherwise
     """
+    return send_group_until_ack_in([message], sock, remote_adr, metrics)
 
-    attempts = 0
-    while attempts < DEFAULT_RETRY_THRESHOLD + 1:
-        send_message(sock, message, remote_adr)
-        ack = await_ack(message, sock, remote_adr)
-        attempts += 1
-        if ack:
-            logging.debug("ACK received after {} attempts".format(attempts))
-            return ack
 
-    logging.warning("Failed to receive ACK after {} retries"
-                    .format(DEFAULT_RETRY_THRESHOLD))
-    return None
+def send_group_until_ack_in(messages, sock, remote_adr, metrics=None,
+                            pacer=None):
+    """ Transmits the messages given back to back and waits for an ACK of the
+    last one, which acknowledges the whole group. The group is re-sent after
+    each timeout, as `send_until_ack_in` does for a single message.
+
+    Drives an `RDP_Machine.Transmission` over the socket.
+
+    :param pacer: An optional `RDP_Pacing.Pacer` to space the messages out
+    :return: The ACK `Message` if received,  `None` otherwise
+    """
+    # RDP_Machine builds on this module, so is imported when first needed
+    from .RDP_Machine import Transmission
+
+    clock = clock_of(sock)
+    transmission = Transmission(messages, remote_adr, metrics)
+    transmission.start(clock())
+    while not transmission.is_done():
+        datagrams = transmission.datagrams_to_send()
+        if datagrams:
+            send_datagrams(sock, datagrams, remote_adr, pacer)
+            transmission.sent(clock())
+
+        remaining = transmission.deadline - clock()
+        if remaining > 0:
+            try:
+                transmission.receive_message(try_read_message(sock, remaining),
+                                             clock())
+            except socket.timeout:
+                pass
+        transmission.handle_timer(clock())
+
+    if pacer and transmission.ack and transmission.attempts == 1:
+        # Measured from the last message, so that time spent pacing does not
+        # inflate the round trip time
+        pacer.update(sum(len(d) for d in transmission.datagrams),
+                     clock() - transmission.last_sent_at)
+    return transmission.ack
+
+
+def send_datagrams(sock, datagrams, dest_adr, pacer=None):
+    """ Sends encoded messages to the address, batching them when the socket
+    supports it.
+
+    :param pacer: An optional `RDP_Pacing.Pacer` to space them out
+    """
+    if pacer:
+        _send_paced(sock, datagrams, dest_adr, pacer)
+    elif len(datagrams) > 1 and hasattr(sock, "queue"):
+        for datagram in datagrams:
+            send_datagram(sock, datagram, dest_adr, queue=True)
+        sock.flush()
+    else:
+        for datagram in datagrams:
+            send_datagram(sock, datagram, dest_adr)
+
+
+def _send_paced(sock, datagrams, dest_adr, pacer):
+    """ Sends datagrams as the pacer allows, batching those which may be sent
+    back to back when the socket supports it.
+    """
+    batch = hasattr(sock, "queue")
+    pacer.start_train()
+    for datagram in datagrams:
+        delay = pacer.reserve(len(datagram))
+        if delay > 0:
+            if batch:
+                sock.flush()
+            sleep_on(sock, delay)
+        send_datagram(sock, datagram, dest_adr, queue=batch)
+        pacer.sent(len(datagram))
+    if batch:
+        sock.flush()
 
 
 def await_ack(msg_out, sock, remote_adr, timeout=DEFAULT_ACK_TIMEOUT_SECONDS):
@@ -233,19 +464,18 @@ def await_ack(msg_out, sock, remote_adr, timeout=DEFAULT_ACK_TIMEOUT_SECONDS):
     :param remote_adr: The address of the socket from which the ack must come.
     :return: The ACK message if one is received. `None` otherwise.
     """
-    logging.debug("Awaiting ACK")
-
-    stop_time = time.time() + timeout
+    clock = clock_of(sock)
+    stop_time = clock() + timeout
 
-    time_remaining = stop_time - time.time()
+    time_remaining = timeout
     while time_remaining > 0:
         ack = try_receive_ack(msg_out, time_remaining, sock, remote_adr)
         if ack:
             return ack
         else:
-            time_remaining = stop_time - time.time()
+            time_remaining = stop_time - clock()
 
-    logging.debug("No ACK received in {} seconds".format(timeout))
+    logging.debug("No ACK received in %s seconds", timeout)
     return None
 
 
@@ -255,59 +485,94 @@ def try_receive_ack(msg_out, timeout, sock, remote_adr):
     If the first message read from the socket is not the desired ack from the
     correct sender, it is discarded and the method returns `None`.
     """
-    logging.debug("Attempting to receive ACK")
     try:
         msg_in = try_read_message(sock, timeout)
         if msg_in.src_adr == remote_adr and is_ack_for_message(msg_out, msg_in):
-            logging.debug("ACK received successfully")
             return msg_in
         else:
-            logging.debug("Received message from {}, but not valid ACK."
-                          .format(msg_in.src_adr))
+            logging.debug("Received message from %s, but not valid ACK.",
+                          msg_in.src_adr)
     except socket.timeout:
         pass
 
-    logging.debug("Failed to receive ACK")
     return None
 
 
-def try_read_message(sock, timeout=None):
-    """ Tries to read a message from the socket.
+def clock_of(sock):
+    """ The monotonic clock timing I/O on a socket: `time.monotonic`, unless the
+    socket keeps its own time (such as an `RDP_SimNet` socket on a virtual
+    clock).
+    """
+    return getattr(sock, "clock", time.monotonic)
 
-        :raises `socket.timeout` if a time_out is given and a message cannot be
-        read before it
+
+def packet_size_of(sock):
+    """ The largest packet which may be sent or received on a socket:
+    `MAX_PACKET_SIZE`, unless the socket allows larger (such as an `AF_UNIX`
+    `RDP_Socket.DatagramSocket`).
     """
-    logging.debug("Attempting to read message")
+    return getattr(sock, "packet_size", MAX_PACKET_SIZE)
 
-    sock.settimeout(timeout)
-    (message_bytes, src_adr) = sock.recvfrom(MAX_PACKET_SIZE)
-    dest_adr = sock.getsockname()
-    message = message_from_bytes(message_bytes, src_adr, dest_adr)
 
-    logging.debug("Message (seq {}) read from {}"
-                  .format(message.seq_no, src_adr))
+def sleep_on(sock, seconds):
+    """ Sleeps by the clock of `sock` (see `clock_of`).
+    """
+    getattr(sock, "sleep", time.sleep)(seconds)
 
-    return message
 
+def try_read_message(sock, timeout=None):
+    """ Tries to read a message from the socket.
 
-def send_message(sock, message, dest_adr):
-    """ Sends the message to the provided address and updates message metadata.
+        :raises `socket.timeout` if a time_out is given and a message cannot be
+        read before it
     """
-    logging.debug("Sending message (seq {}) to {}"
-                  .format(message.seq_no, dest_adr))
+    clock = clock_of(sock)
+    stop_time = None if timeout is None else clock() + timeout
+    while True:
+        sock.settimeout(timeout)
+        (message_bytes, src_adr) = sock.recvfrom(packet_size_of(sock))
+        TRACE.record(RECEIVED, message_bytes)
+        dest_adr = sock.getsockname()
+        try:
+            return message_from_bytes(message_bytes, src_adr, dest_adr)
+        except ChecksumError as e:
+            # Treated as lost. The packet itself is in the trace
+            logging.debug("Dropping corrupt packet: %s", e)
+
+        if stop_time is not None:
+            timeout = stop_time - clock()
+            if timeout <= 0:
+                raise socket.timeout("timed out")
+
+
+def send_message(sock, message, dest_adr, queue=False):
+    """ Sends the message to the provided address and updates message metadata.
 
+    :param queue If true, the message is queued on the socket (which must be an
+    `RDP_Socket.DatagramSocket`) until it is next flushed
+    """
     message.dest_adr = dest_adr
     message.src_adr = sock.getsockname()
-    binary_message = message_to_bytes(message)
-    sock.sendto(binary_message, dest_adr)
+    send_datagram(sock, message_to_bytes(message), dest_adr, queue)
+
+
+def send_datagram(sock, datagram, dest_adr, queue=False):
+    """ Sends an encoded message to the provided address.
+
+    :param queue See `send_message`
+    """
+    if queue:
+        sock.queue(datagram, dest_adr)
+    else:
+        sock.sendto(datagram, dest_adr)
+    TRACE.record(SENT, datagram)
 
 
 def send_ack(msg_in, connection, sock):
     """ Creates and sends an ACK for the message. Does not update connection
     state.
     """
-    logging.debug("Sending ACK")
-
-    ack = create_ack_message(connection.seq_num, msg_in.seq_no)
+    ack = create_ack_message(connection.seq_num, msg_in.seq_no,
+                             connection.header_flags())
     send_message(sock, ack, connection.remote_adr)
 
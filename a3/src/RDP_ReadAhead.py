@@ -0,0 +1,111 @@
+"""
+    Disk reads for the RDP server, offloaded to a thread pool.
+
+    A `ReadAhead` reads a byte range of a file in chunks on an executor with
+    `os.pread`, keeping up to `depth` chunks in flight ahead of the chunk being
+    consumed. While the server waits for the ACK of one message, the next
+    messages' chunks are being read, so its socket is not left unserviced
+    while a slow or cold disk seeks. At most `depth` chunks of a transfer are
+    held in memory at once, however large the file.
+
+    Reads are positional, so several transfers can share one executor and one
+    descriptor (such as a descriptor kept open by an `RDP_FileIndex.FileEntry`)
+    without a shared file offset.
+"""
+import collections
+import os
+
+DEFAULT_READ_AHEAD_CHUNKS = 4
+DEFAULT_DISK_THREADS = 2
+
+
+class ReadAhead:
+    """ An iterable of the chunks of a byte range of a file, each preceded by
+    `prefix`. A file shorter than the range ends the chunks early. An empty
+    range yields a single empty chunk.
+    """
+
+    def __init__(self,
+                 executor,
+                 path,
+                 chunk_size,
+                 offset=0,
+                 length=None,
+                 first_chunk_size=None,
+                 depth=DEFAULT_READ_AHEAD_CHUNKS,
+                 fd=None,
+                 prefix=b"",
+                 content_hash=None):
+        """
+        :param executor The `concurrent.futures.Executor` to read on
+        :param length The number of bytes to read, or `None` to read to the
+        end of the file
+        :param first_chunk_size The size of the first chunk, if smaller than
+        `chunk_size`
+        :param fd A descriptor open on the file to read from, which is left
+        open. Without one, `path` is opened and closed by the reader.
+        :param content_hash An optional `hashlib` object updated with each
+        chunk as it is consumed
+        """
+        self.executor = executor
+        self.depth = max(1, depth)
+        self.prefix = prefix
+        self.content_hash = content_hash
+        self._owns_fd = fd is None
+        self.fd = os.open(path, os.O_RDONLY) if fd is None else fd
+
+        end = os.fstat(self.fd).st_size
+        if length is not None:
+            end = min(end, offset + length)
+        self.size = max(0, end - offset)  # Bytes in the range
+        self._end = offset + self.size
+        self._position = offset  # Of the next chunk to submit
+        self._chunk_size = chunk_size
+        self._next_chunk_size = first_chunk_size or chunk_size
+        self._pending = collections.deque()  # (future, size), in file order
+
+    def __iter__(self):
+        try:
+            if not self.size:
+                yield self._consume(b"")
+                return
+            self._fill()
+            while self._pending:
+                future, size = self._pending.popleft()
+                chunk = future.result()
+                if chunk:
+                    yield self._consume(chunk)
+                if len(chunk) < size:
+                    break  # The file has been truncated
+                self._fill()
+        finally:
+            self.close()
+
+    def _consume(self, chunk):
+        if self.content_hash:
+            self.content_hash.update(chunk)
+        return self.prefix + chunk
+
+    def _fill(self):
+        """ Submits reads until `depth` chunks are in flight or the whole
+        range has been submitted.
+        """
+        while len(self._pending) < self.depth and self._position < self._end:
+            size = min(self._next_chunk_size, self._end - self._position)
+            self._pending.append((self.executor.submit(
+                os.pread, self.fd, size, self._position), size))
+            self._position += size
+            self._next_chunk_size = self._chunk_size
+
+    def close(self):
+        """ Abandons any reads still in flight and releases the descriptor.
+        """
+        pending, self._pending = self._pending, collections.deque()
+        for future, _ in pending:
+            if not future.cancel():
+                # Still reading, so the descriptor must stay open until done
+                future.exception()
+        self._position = self._end
+        if self._owns_fd and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
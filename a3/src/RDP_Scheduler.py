@@ -0,0 +1,166 @@
+"""
+    Scheduling of the sends of concurrent transfers over one socket.
+
+    A `SendScheduler` holds a queue of pending sends (such as the message
+    groups of a response) for each flow, and decides which is sent next:
+
+    * `fifo` - In the order they were queued. A flow which queues a large
+      response ahead of the others holds them up until it is sent.
+    * `drr` - Deficit round robin. Flows with sends queued take turns, and on
+      each turn a flow may send up to `quantum * weight` bytes plus whatever
+      it could not use on its previous turns. A flow's share of the bytes sent
+      is in proportion to its weight, however much it has queued, so a large
+      transfer cannot starve small ones.
+    * `srf` - Shortest remaining first. The flow with the fewest bytes left to
+      send (as declared when it was added, or else queued) goes first, so
+      small responses complete ahead of large ones at the cost of the large
+      ones' completion time.
+
+    The time each send spends queued is recorded in its flow's
+    `queueing_delay` histogram.
+
+    The server serves one connection at a time, so it has no use for a
+    scheduler yet. `a3.bench.RDP_SchedulerBench` compares the policies on a
+    simulated link.
+"""
+import collections
+import time
+
+from .RDP_Metrics import SECONDS_BUCKETS, Histogram
+from .RDP_Protocol import MAX_PACKET_SIZE
+
+POLICY_FIFO = "fifo"
+POLICY_DRR = "drr"
+POLICY_SRF = "srf"
+POLICIES = [POLICY_FIFO, POLICY_DRR, POLICY_SRF]
+
+DEFAULT_QUANTUM = MAX_PACKET_SIZE  # Bytes per turn, per unit of weight
+
+
+class Flow:
+    """ The sends queued by one flow, such as one connection.
+    """
+
+    def __init__(self, key, weight=1, remaining=None):
+        """
+        :param remaining The number of bytes the flow will send in all, for
+        shortest remaining first, or `None` to use the bytes queued
+        """
+        if weight <= 0:
+            raise ValueError("Flow weight must be positive")
+        self.key = key
+        self.weight = weight
+        self.remaining = remaining
+        self.queueing_delay = Histogram(SECONDS_BUCKETS)
+        self.queue = collections.deque()  # (item, size, queued at)
+        self.queued_bytes = 0
+        self.deficit = 0
+        self.removed = False
+
+    def remaining_bytes(self):
+        return self.queued_bytes if self.remaining is None else self.remaining
+
+
+class SendScheduler:
+    """ Chooses which flow sends next. See the module docstring.
+    """
+
+    def __init__(self, policy=POLICY_DRR, quantum=DEFAULT_QUANTUM,
+                 clock=time.monotonic):
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy '{}'".format(policy))
+        self.policy = policy
+        self.quantum = quantum
+        self.clock = clock
+        self.flows = {}
+        self._active = collections.deque()  # Flows with sends queued
+        self._arrivals = collections.deque()  # Flow of each send, for fifo
+        self._turn = None  # The flow whose DRR turn it is
+        self._queued = 0
+
+    def __len__(self):
+        """ The number of sends queued.
+        """
+        return self._queued
+
+    def add_flow(self, key, weight=1, remaining=None):
+        """ Adds a flow. See `Flow`.
+
+        :return: The `Flow`
+        """
+        if key in self.flows:
+            raise ValueError("Flow {} already added".format(key))
+        flow = Flow(key, weight, remaining)
+        self.flows[key] = flow
+        return flow
+
+    def remove_flow(self, key):
+        """ Removes a flow, such as a connection which has been lost, and
+        discards any sends it has queued.
+        """
+        flow = self.flows.pop(key)
+        flow.removed = True
+        self._queued -= len(flow.queue)
+        flow.queue.clear()
+        if flow in self._active:
+            self._active.remove(flow)
+        if self._turn is flow:
+            self._turn = None
+
+    def enqueue(self, key, item, size):
+        """ Queues a send of `size` bytes for a flow.
+        """
+        flow = self.flows[key]
+        if not flow.queue:
+            self._active.append(flow)
+        flow.queue.append((item, size, self.clock()))
+        flow.queued_bytes += size
+        if self.policy == POLICY_FIFO:
+            self._arrivals.append(flow)
+        self._queued += 1
+
+    def next(self):
+        """ Takes the next send.
+
+        :return: A `(key, item)` pair, or `None` if nothing is queued
+        """
+        if not self._queued:
+            return None
+        if self.policy == POLICY_FIFO:
+            flow = self._arrivals.popleft()
+            while flow.removed:
+                flow = self._arrivals.popleft()
+        elif self.policy == POLICY_SRF:
+            flow = min(self._active, key=Flow.remaining_bytes)
+        else:
+            flow = self._next_drr()
+        return flow.key, self._take(flow)
+
+    def _next_drr(self):
+        while True:
+            flow = self._active[0]
+            if self._turn is not flow:
+                self._turn = flow
+                flow.deficit += self.quantum * flow.weight
+            if flow.queue[0][1] <= flow.deficit:
+                return flow
+            # Not enough credit for its next send, so its turn is over
+            self._active.rotate(-1)
+            self._turn = None
+
+    def _take(self, flow):
+        item, size, queued_at = flow.queue.popleft()
+        flow.queueing_delay.observe(self.clock() - queued_at)
+        flow.queued_bytes -= size
+        if flow.remaining is not None:
+            flow.remaining = max(0, flow.remaining - size)
+        self._queued -= 1
+        if self.policy == POLICY_DRR:
+            flow.deficit -= size
+        if not flow.queue:
+            # An idle flow does not save up credit
+            self._active.remove(flow)
+            flow.deficit = 0
+            if self._turn is flow:
+                self._turn = None
+        return item
@@ -1,73 +1,232 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
 import os
-import sys
+import threading
 from socket import *
 
+from . import RDP_Chunking, RDP_Compression, RDP_FEC, RDP_Pacing
+from .RDP_Capture import RequestCapture
+from .RDP_FileIndex import FileEntry, FileIndex
+from .RDP_Metrics import ConnectionMetrics, MetricsDumper, MetricsRegistry
 from .RDP_Protocol import *
+from .RDP_ReadAhead import DEFAULT_DISK_THREADS, DEFAULT_READ_AHEAD_CHUNKS, \
+    ReadAhead
+from .RDP_Socket import UNIX_ADDRESS_PREFIX, address_family, bind_socket, \
+    parse_address, wrap_socket
+from .RDP_Timers import TimerWheel
+from .RDP_Trace import TRACE
 
 logging.basicConfig(level=logging.INFO)
 
 CONNECTION_TIMEOUT = DEFAULT_RETRY_THRESHOLD * DEFAULT_ACK_TIMEOUT_SECONDS
+# Longest the serve loop waits for a message before checking for `stop`
+STOP_CHECK_INTERVAL = 0.1
 
 
 class Server:
 
-    def __init__(self, adr):
+    def __init__(self,
+                 adr,
+                 reuse_port=False,
+                 file_index=None,
+                 pacing=None,
+                 sock=None,
+                 read_ahead=DEFAULT_READ_AHEAD_CHUNKS,
+                 disk_threads=DEFAULT_DISK_THREADS):
+        """
+        :param adr The address to serve on: an `(ip, port)` pair, or a path to
+        serve on an `AF_UNIX` datagram socket, with larger packets
+        :param reuse_port If true, the socket is bound with `SO_REUSEPORT` so
+        several servers (see `RDP_Supervisor`) can share the address
+        :param file_index An `RDP_FileIndex.FileIndex` of the document root to
+        serve files from. Without one, requested filenames are opened as given,
+        relative to the working directory.
+        :param pacing How to pace the packets of each connection (see
+        `RDP_Pacing.create_pacer`), or `None` to send them back to back
+        :param sock An already bound socket to serve on instead of binding
+        `adr`, such as an `RDP_SimNet` socket. The server keeps time by its
+        clock (see `RDP_Protocol.clock_of`).
+        :param read_ahead While serving, uncompressed file content is read on a
+        pool of `disk_threads` threads, up to this many chunks ahead of the
+        message being sent (see `RDP_ReadAhead`). If 0, each response is read
+        in full on the serving thread before it is sent. The pool also chunks
+        large files for their manifests (see `RDP_Chunking.ManifestCache`).
+        """
         self.adr = adr
+        self.reuse_port = reuse_port
+        self.file_index = file_index
+        self.pacing = pacing
+        self.pacer = None  # Paces the current connection
+        self.read_ahead = read_ahead
+        self.disk_threads = disk_threads
+        self._disk_pool = None  # Reads and chunks files while serving
+        self._unix_path = None  # The AF_UNIX socket file bound, if any
         self.sock = None  # Socket is bound once serve is called
+        self._given_sock = sock
         self.conn = None
+        self.clock = clock_of(sock)
+        self.timers = TimerWheel(clock=self.clock)
+        self.compression_cache = RDP_Compression.CompressionCache()
+        self.manifest_cache = RDP_Chunking.ManifestCache()
+        self.metrics = MetricsRegistry()
+        self.metrics_dumper = None
+        self.trace_file = None  # Packet trace is dumped here on abandonment
+        self.capture = None  # Records each request served
+        self._idle_timer = None
+        # (client address, FIN seq, reply) of the last client initiated close,
+        # so the reply can be repeated if it was lost.
+        self._last_fin = None
+        # (client address, SYN seq) of the last fast open SYN answered, so
+        # retransmissions of it do not restart the response.
+        self._last_fast_open = None
+        self._fast_open_timer = None
+        self._stopped = threading.Event()
+
+    def dump_metrics_periodically(self, path, interval, fmt="json"):
+        """ Writes the server's metrics to a file every `interval` seconds while
+        serving.
+
+        :param fmt "json" or "prometheus"
+        """
+        self.metrics_dumper = MetricsDumper(self.metrics, path, interval, fmt)
 
-    def serve(self):
+    def capture_requests(self, path):
+        """ Appends each request served to a capture file (see `RDP_Capture`),
+        which is closed when the server stops.
+        """
+        self.capture = RequestCapture(path)
+
+    def serve(self, ready=None):
         """ Serve on the configured port.
+
+        :param ready An optional `threading.Event` (or equivalent) which is set
+        once the socket is bound and `adr` holds the bound address
         """
         try:
             self._create_and_bind_socket()
+            self._disk_pool = concurrent.futures.ThreadPoolExecutor(
+                self.disk_threads, thread_name_prefix="rdp-disk")
+            if self.file_index is not None:
+                self._refresh_file_index()
+            if ready:
+                ready.set()
+            if self.metrics_dumper:
+                self.metrics_dumper.start()
             self._serve_loop()
         except:
             # Catch and re-raise any unexpected exception (such as
             # user interrupt) after closing the socket
             raise
         finally:
+            if self.metrics_dumper:
+                self.metrics_dumper.stop()
+                self.metrics_dumper.dump()
+            if self.capture:
+                self.capture.close()
+            if self._disk_pool:
+                self._disk_pool.shutdown(wait=False)
+                self._disk_pool = None
             self.sock.close()
             self.sock = None
+            if self._unix_path:
+                os.unlink(self._unix_path)
+                self._unix_path = None
+
+    def stop(self):
+        """ Makes `serve` return, once any response being sent has been
+        sent, having closed the socket.
+        """
+        self._stopped.set()
+
+    def _refresh_file_index(self):
+        self.file_index.refresh()
+        self.timers.schedule(self.file_index.refresh_interval,
+                             self._refresh_file_index)
 
     def _create_and_bind_socket(self):
-        sock = socket.socket(AF_INET, SOCK_DGRAM)
-        sock.bind(self.adr)
-        self.sock = sock
+        sock = self._given_sock
+        if sock is None:
+            sock = bind_socket(self.adr, self.reuse_port)
+            if address_family(self.adr) == AF_UNIX:
+                self._unix_path = self.adr  # Removed once done serving
+        self.sock = wrap_socket(sock)
 
         # Allow clients to query the new address. Useful when the address given
         # at construction is a wildcard.
         self.adr = self.sock.getsockname()
 
-        logging.debug("Created and bound socket to port {}".format(self.adr[1]))
+        logging.debug("Created and bound socket to {}".format(self.adr))
 
     def _serve_loop(self):
-        while True:
+        waiting = False
+        while not self._stopped.is_set():
             try:
-                if not self.conn:
+                if not self.conn and not waiting:
                     logging.info("Serving on {}. Waiting for connection."
                                  .format(self.adr))
+                waiting = not self.conn
 
-                block = CONNECTION_TIMEOUT if self.conn else None
+                block = self.timers.time_until_next()
+                block = STOP_CHECK_INTERVAL if block is None \
+                    else min(block, STOP_CHECK_INTERVAL)
                 message = try_read_message(self.sock, block)
                 self._dispatch(message)
             except socket.timeout:
-                self._abandon_connection("Connection timeout expired")
+                pass
+            self.timers.advance()
+
+    def _set_connection(self, conn, abandoned=False):
+        """ Replaces the current connection, (re)starting or stopping the idle
+        timer as appropriate. The metrics of the previous connection, if any,
+        are added to the server's totals.
+        """
+        if self.conn and self.conn is not conn:
+            self.metrics.record_connection(self.conn.metrics, abandoned)
+        if conn is not self.conn:
+            self.pacer = RDP_Pacing.create_pacer(self.pacing, self.clock) \
+                if conn else None
+
+        self.conn = conn
+        self.timers.cancel(self._idle_timer)
+        self._idle_timer = None
+        if conn:
+            self._touch_connection()
+
+    def _touch_connection(self):
+        """ Restarts the idle timer for the current connection.
+        """
+        self.timers.cancel(self._idle_timer)
+        self._idle_timer = self.timers.schedule(CONNECTION_TIMEOUT,
+                                                self._abandon_connection,
+                                                "Connection timeout expired")
 
     def _abandon_connection(self, cause):
         logging.warning("Client connectivity lost ({}). Abandoning connection"
                         .format(cause))
-        self.conn = None
+        if self.trace_file:
+            TRACE.dump(self.trace_file)
+            logging.info("Packet trace written to '{}'".format(self.trace_file))
+        self._set_connection(None, abandoned=True)
 
     def _dispatch(self, message):
         """ Dispatch an inbound message to the appropriate handler.
         """
         logging.debug("Dispatching message")
 
+        if self.conn and self.conn.remote_adr == message.src_adr:
+            self._touch_connection()
+
         if self.conn and self.conn.remote_adr != message.src_adr:
             logging.warning("Existing connection with {}. "
                             "Dropping packet received from {}"
-                            .format(self.conn.adr, message.src_adr))
+                            .format(self.conn.remote_adr, message.src_adr))
+            self.conn.metrics.record_foreign_datagram(message.size)
+
+        elif message.is_syn() and \
+                self._last_fast_open == (message.src_adr, message.seq_no):
+            logging.debug("Dropping duplicate fast open SYN")
 
         elif message.is_syn():
             ack = self._receive_connection(message)
@@ -77,10 +236,19 @@ class Server:
                 # ACK the initial SYN message with the same sequence number.
                 self._dispatch(ack)
 
+        elif not self.conn and message.is_fin() and self._last_fin and \
+                self._last_fin[:2] == (message.src_adr, message.seq_no):
+            logging.debug("Repeating reply to duplicate FIN")
+            send_message(self.sock, self._last_fin[2], message.src_adr)
+
         elif not self.conn:
             logging.warning("Received non-SYN message without a connection. "
                             "Dropping.")
 
+        elif message.is_ack_only():
+            # A duplicate ACK for a response which has already been delivered
+            logging.debug("Dropping stale ACK")
+
         elif message.seq_no != self.conn.next_expected_index():
             error_message = "Bad sequence number: {}. Expected {}"\
                 .format(message.seq_no, self.conn.last_index_received + 1)
@@ -89,6 +257,9 @@ class Server:
         elif message.packet_type == "APP":
             self._process_get_request(message)
 
+        elif message.is_fin():
+            self._receive_fin(message)
+
         else:
             logging.warning("Failed to dispatch message. Dropping packet.")
 
@@ -98,6 +269,10 @@ class Server:
         If there is already a connection between the client and server,
         this packet will effectively reset the connection.
 
+        If the SYN carries a GET request and every option offered can be
+        accepted as is, the request is answered straight away (fast open): the
+        first APP message of the response doubles as the SYN-ACK.
+
         :return: The ACK message, if received.
         """
         assert syn.is_syn(), "Programming error. Requires SYN packet."
@@ -108,73 +283,402 @@ class Server:
         else:
             logging.info("Connection request (SYN) from {}".format(syn.src_adr))
 
-        self.conn = Connection(syn.src_adr, syn.seq_no)
+        conn = Connection(syn.src_adr, syn.seq_no)
+        conn.metrics = ConnectionMetrics(self.sock)
+        self._set_connection(conn)
+        offered, request = decode_syn_payload(syn.payload)
+        self.conn.options = self._negotiate_options(offered)
+
+        if request is not None and self.conn.options == offered:
+            logging.info("Fast open request from {}".format(syn.src_adr))
+            self._remember_fast_open(syn)
+            self.conn.metrics.record_handshake()
+            self._serve_request(request)
+            return None
 
         ack_no = self.conn.last_index_received
         seq_no = self.conn.get_seq_and_increment()
-        reply = create_syn_message(seq_no, ack_no)
+        reply = create_syn_message(seq_no, ack_no, self.conn.options,
+                                   flags=self.conn.header_flags())
 
         logging.info("Using base sequence number {}".format(seq_no))
 
         ack = self._send_until_ack_in(reply)
+        if ack:
+            self.conn.metrics.record_handshake()
         return ack
 
+    def _remember_fast_open(self, syn):
+        """ Records a fast open SYN for long enough that any retransmissions of
+        it will have arrived.
+        """
+        self._last_fast_open = (syn.src_adr, syn.seq_no)
+        self.timers.cancel(self._fast_open_timer)
+        self._fast_open_timer = self.timers.schedule(CONNECTION_TIMEOUT,
+                                                     self._forget_fast_open)
+
+    def _forget_fast_open(self):
+        self._last_fast_open = None
+        self._fast_open_timer = None
+
+    @staticmethod
+    def _negotiate_options(offered):
+        """ Chooses the connection options to use from those offered by the
+        client.
+
+        :return: A dict of the accepted options
+        """
+        accepted = {}
+
+        if offered.get(OPTION_PERSIST) == "1":
+            accepted[OPTION_PERSIST] = "1"
+
+        if OPTION_COMPRESS in offered:
+            codec = RDP_Compression.negotiate(offered[OPTION_COMPRESS])
+            if codec:
+                accepted[OPTION_COMPRESS] = codec
+
+        if offered.get(OPTION_CRC) == "1":
+            accepted[OPTION_CRC] = "1"
+
+        if offered.get(OPTION_DIGEST) == DIGEST_MD5:
+            accepted[OPTION_DIGEST] = DIGEST_MD5
+
+        if offered.get(OPTION_SIZE) == "1":
+            accepted[OPTION_SIZE] = "1"
+
+        if offered.get(OPTION_DEDUP) == "1":
+            accepted[OPTION_DEDUP] = "1"
+
+        if OPTION_FEC in offered:
+            group_size = RDP_FEC.negotiate(offered[OPTION_FEC])
+            if group_size:
+                accepted[OPTION_FEC] = str(group_size)
+
+        if accepted:
+            logging.info("Negotiated options {}".format(accepted))
+        return accepted
+
     def _process_get_request(self, message):
         assert self.conn, \
             "Programming Error. Cannot process APP packet without connection."
 
+        self.conn.increment_next_expected_index()
+        self._serve_request(message.payload)
+
+    def _serve_request(self, request):
+        """ Sends the response to an encoded GET request, then closes the
+        connection unless it is persistent.
+        """
         # Not directly following HTTP structure.
-        filename = message.get_payload_as_text()
+        received_at = self.clock()
+        filename, fields = decode_request(request)
 
         logging.info("Received request from client for '{}'".format(filename))
 
-        self.conn.increment_next_expected_index()
+        persistent = self.conn.options.get(OPTION_PERSIST) == "1"
+        group_size = int(self.conn.options.get(OPTION_FEC, 0))
+        header_flags = self.conn.header_flags()
+        payload_size = packet_size_of(self.sock) - HEADER_SIZE
+        if header_flags & FLAG_CRC:
+            payload_size -= CRC_SIZE
+        if group_size:
+            payload_size -= RDP_FEC.PARITY_OVERHEAD
+
+        send_size = self.conn.options.get(OPTION_SIZE) == "1" and \
+            fields.get(REQUEST_METHOD) != METHOD_HEAD
+        payloads, digest = self._get_response(
+            filename, fields, payload_size,
+            SIZE_FIELD_SIZE if send_size else 0)
+        body_size = payloads.size if isinstance(payloads, ReadAhead) else \
+            sum(len(payload) - HTTP_CODE_LEN for payload in payloads)
+        framed = self._frame_response(payloads, digest,
+                                      body_size if send_size else None,
+                                      persistent, payload_size)
+
+        # The connection is not idle while the response is sent, however long
+        # that takes: losing the client is detected by the retries instead.
+        # The idle timer is restarted once the response has been ACKed.
+        self.timers.cancel(self._idle_timer)
+        self._idle_timer = None
+        start = self.clock()
+        try:
+            ack = self._send_response(framed, group_size)
+        finally:
+            if isinstance(payloads, ReadAhead):
+                payloads.close()
+        if self.capture:
+            status = HTTP_OK_ENCODED if isinstance(payloads, ReadAhead) \
+                else payloads[0][:HTTP_CODE_LEN]
+            compressed = OPTION_COMPRESS in self.conn.options and \
+                status == HTTP_OK_ENCODED and \
+                fields.get(REQUEST_METHOD) not in (METHOD_HEAD,
+                                                   METHOD_MANIFEST)
+            self.capture.record(received_at, filename, fields, int(status),
+                                body_size, self.clock() - received_at,
+                                ack is not None, compressed)
+        if not ack:
+            return
 
-        if not os.path.isfile(filename):
-            logging.info("No such file '{}'".format(filename))
-            ack = self._send_data(HTTP_FILE_NOT_FOUND_ENCODED)
-            if not ack:
-                return
+        self._touch_connection()
+        self.conn.metrics.record_transfer(body_size, self.clock() - start)
+        if self.pacer and self.pacer.target_rate():
+            achieved = self.pacer.achieved_rate()
+            logging.info("Paced at {} B/s, target {:.0f} B/s".format(
+                "-" if achieved is None else "{:.0f}".format(achieved),
+                self.pacer.target_rate()))
+
+        if not persistent:
+            self._close_connection()
+        elif ack.is_app():
+            # The ACK for the end of the response was lost, but the client's
+            # next request acknowledges it too.
+            self._dispatch(ack)
+
+    def _frame_response(self, payloads, digest, body_size, persistent,
+                        payload_size):
+        """ Sets the header flags of each payload of a response, adding its
+        size to the first and its digest to the last, as negotiated. Each
+        payload is only taken once the next one is known.
+
+        :param digest See `_get_response`
+        :param body_size The size to announce, or `None`
+        :return: An iterator of `(payload, flags)` pairs
+        """
+        header_flags = self.conn.header_flags()
+        payloads = iter(payloads)
+        payload = next(payloads)
+        if body_size is not None and \
+                payload[:HTTP_CODE_LEN] == HTTP_OK_ENCODED:
+            payload = HTTP_OK_ENCODED + \
+                body_size.to_bytes(SIZE_FIELD_SIZE, "big") + \
+                payload[HTTP_CODE_LEN:]
+            flags = header_flags | FLAG_SIZE
         else:
-            chunk_size = MAX_PAYLOAD_SIZE - HTTP_CODE_LEN
-            chunks = self._get_data_from_file(filename, chunk_size)
-
-            logging.info("Sending data in {} chunk(s)".format(len(chunks)))
-            for chunk in chunks:
-                ack = self._send_data(HTTP_OK_ENCODED + chunk)
-                if not ack:
-                    return
+            flags = header_flags
+
+        for following in itertools.chain(payloads, [None]):
+            if following is not None:
+                yield payload, flags
+                payload, flags = following, header_flags
+                continue
+            # The last payload
+            if digest:
+                if len(payload) + DIGEST_SIZE > payload_size:
+                    yield payload, flags
+                    payload, flags = HTTP_OK_ENCODED, header_flags
+                payload += digest()
+                flags |= FLAG_DIGEST
+            if persistent:
+                flags |= FLAG_END_OF_RESPONSE
+            yield payload, flags
+
+    def _send_response(self, framed, group_size):
+        """ Sends the framed payloads of a response, one at a time or in FEC
+        groups.
+
+        :return: The ACK of the last message, or `None` if the connection was
+        lost
+        """
+        step = group_size or 1
+        ack = None
+        for batch in iter(lambda: list(itertools.islice(framed, step)), []):
+            if group_size:
+                ack = self._send_data_group([payload for payload, _ in batch],
+                                            [flags for _, flags in batch])
+            else:
+                ack = self._send_data(*batch[0])
+            if not ack:
+                return None
+        return ack
 
-        self._close_connection()
+    def _get_response(self,
+                      filename,
+                      fields,
+                      payload_size=MAX_PAYLOAD_SIZE,
+                      reserve=0):
+        """ Builds the response to a GET request.
+
+        :param payload_size The maximum size of each payload
+        :param reserve Bytes to leave free in the first payload of content
+        :return: The APP message payloads to send, as a list or, while
+        serving, an `RDP_ReadAhead.ReadAhead` of the file's content. Also a
+        function returning the md5 digest of the response body, valid once
+        the payloads have been taken, if the client asked for one and the
+        response is a file's content (otherwise `None`).
+        """
+        try:
+            offset, length = get_request_range(fields)
+        except ValueError:
+            logging.info("Malformed request fields {}".format(fields))
+            return [HTTP_BAD_REQUEST_ENCODED], None
 
-    def _send_data(self, data):
+        if self.file_index is not None:
+            file = self.file_index.lookup(filename)
+        else:
+            file = filename if os.path.isfile(filename) else None
+        if not file:
+            logging.info("No such file '{}'".format(filename))
+            return [HTTP_FILE_NOT_FOUND_ENCODED], None
+
+        if fields.get(REQUEST_METHOD) == METHOD_HEAD:
+            size = file.size if isinstance(file, FileEntry) \
+                else os.path.getsize(file)
+            logging.info("HEAD request. Size is {} bytes".format(size))
+            return [HTTP_OK_ENCODED + str(size).encode()], None
+
+        if offset or length is not None:
+            logging.info("Serving byte range {}+{}".format(offset, length))
+
+        chunk_size = payload_size - HTTP_CODE_LEN
+        first_chunk_size = chunk_size - reserve
+        codec = self.conn.options.get(OPTION_COMPRESS)
+        content_hash = hashlib.md5() \
+            if self.conn.options.get(OPTION_DIGEST) == DIGEST_MD5 else None
+        digest = None
+        if fields.get(REQUEST_METHOD) == METHOD_MANIFEST:
+            # Chunk digests do not compress, so the manifest is sent as is
+            path, version = _cache_key(file)
+            manifest = self.manifest_cache.get(path, version, self._disk_pool)
+            if manifest is None:
+                logging.info("Manifest of '{}' is being built".format(
+                    filename))
+                return [HTTP_UNAVAILABLE_ENCODED], None
+            logging.info("MANIFEST request. Sending {} bytes".format(
+                len(manifest)))
+            if content_hash:
+                content_hash.update(manifest)
+                digest = content_hash.digest()
+            chunks = self._split_into_chunks(manifest, chunk_size,
+                                             first_chunk_size)
+        elif codec:
+            if offset or length is not None:
+                content = self._read_file(file, offset, length)
+                data = RDP_Compression.compress(content, codec)
+                if content_hash:
+                    content_hash.update(content)
+                    digest = content_hash.digest()
+            else:
+                path, version = _cache_key(file)
+                data, digest = self.compression_cache.get_with_digest(
+                    path, codec, version)
+            logging.info("Compressed '{}' to {} bytes with {}"
+                         .format(filename, len(data), codec))
+            chunks = self._split_into_chunks(data, chunk_size,
+                                             first_chunk_size)
+        elif self._disk_pool and self.read_ahead:
+            fd = file.fd if isinstance(file, FileEntry) else None
+            path = file.path if isinstance(file, FileEntry) else file
+            reader = ReadAhead(self._disk_pool, path, chunk_size, offset,
+                               length, first_chunk_size, self.read_ahead, fd,
+                               HTTP_OK_ENCODED, content_hash)
+            logging.info("Reading {} bytes ahead in chunks of {}".format(
+                reader.size, chunk_size))
+            return reader, content_hash.digest if content_hash else None
+        else:
+            chunks = self._get_data_from_file(file, chunk_size, offset, length,
+                                              first_chunk_size)
+            if content_hash:
+                for chunk in chunks:
+                    content_hash.update(chunk)
+                digest = content_hash.digest()
+
+        logging.info("Sending data in {} chunk(s)".format(len(chunks)))
+        return [HTTP_OK_ENCODED + chunk for chunk in chunks], \
+            (lambda: digest) if content_hash else None
+
+    def _send_data(self, data, flags=0):
         """ Sends the given application data to the client.
 
         Wraps the given data in an APP message and sends it to the client. Waits
         until an ACK is received before returning.
 
         :param data The binary data to be sent
+        :param flags Header flags for the APP message
 
         :return `None` if the connection was lost. The ack message to the data
         message sent otherwise.
         """
 
-        assert len(data) <= MAX_PAYLOAD_SIZE, "Data chunk too large"
+        assert len(data) <= packet_size_of(self.sock) - HEADER_SIZE, \
+            "Data chunk too large"
 
         ack_no = self.conn.last_index_received
         seq_no = self.conn.get_seq_and_increment()
 
-        msg = create_app_message(seq_no, ack_no, data)
+        msg = create_app_message(seq_no, ack_no, data, flags)
         return self._send_until_ack_in(msg)
 
+    def _send_data_group(self, payloads, flags):
+        """ Sends application data as an FEC group: an APP message for each
+        payload followed by their parity message. Waits until the group is
+        ACKed before returning.
+
+        :param flags Header flags for each APP message
+
+        :return `None` if the connection was lost. The ACK of the group
+        otherwise.
+        """
+        ack_no = self.conn.last_index_received
+        messages = [create_app_message(self.conn.get_seq_and_increment(),
+                                       ack_no, payload, message_flags)
+                    for payload, message_flags in zip(payloads, flags)]
+        messages.append(RDP_FEC.create_parity_message(
+            self.conn.get_seq_and_increment(), ack_no, messages,
+            self.conn.header_flags()))
+        return self._send_group_until_ack_in(messages)
+
     @staticmethod
-    def _get_data_from_file(filename, chunk_size=MAX_PAYLOAD_SIZE):
+    def _read_file(filename, offset=0, length=None):
+        with _open(filename) as file:
+            file.seek(offset)
+            return file.read(-1 if length is None else length)
+
+    @staticmethod
+    def _get_data_from_file(filename,
+                            chunk_size=MAX_PAYLOAD_SIZE,
+                            offset=0,
+                            length=None,
+                            first_chunk_size=None):
+        """ Reads the given byte range of the file in chunks.
+
+        :param filename A path, or an `RDP_FileIndex.FileEntry`
+        :param length The number of bytes to read, or `None` to read to the
+        end of the file.
+        :param first_chunk_size The size of the first chunk, if smaller than
+        `chunk_size`
+        """
         chunks = []
-        with open(filename, 'rb') as file:
-            chunk = file.read(chunk_size)
-            while chunk:
+        remaining = length
+        with _open(filename) as file:
+            file.seek(offset)
+            while remaining is None or remaining > 0:
+                size = chunk_size if chunks or first_chunk_size is None \
+                    else first_chunk_size
+                if remaining is not None:
+                    size = min(size, remaining)
+                chunk = file.read(size)
+                if not chunk:
+                    break
                 chunks.append(chunk)
-                chunk = file.read(chunk_size)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+        if not chunks:
+            chunks = [bytes(0)]
+
+        return chunks
+
+    @staticmethod
+    def _split_into_chunks(data,
+                           chunk_size=MAX_PAYLOAD_SIZE,
+                           first_chunk_size=None):
+        chunks = []
+        if first_chunk_size is not None and data:
+            chunks.append(data[:first_chunk_size])
+            data = data[first_chunk_size:]
+        chunks += [data[i:i + chunk_size]
+                   for i in range(0, len(data), chunk_size)]
 
         if not chunks:
             chunks = [bytes(0)]
@@ -190,7 +694,7 @@ class Server:
 
         seq = self.conn.get_seq_and_increment()
         ack = self.conn.last_index_received
-        fin_msg = create_fin_message(seq, ack)
+        fin_msg = create_fin_message(seq, ack, self.conn.header_flags())
 
         fin_ack_msg = self._send_until_ack_in(fin_msg)
         if not fin_ack_msg:
@@ -199,27 +703,118 @@ class Server:
             logging.warning("FIN message ACK was not itself a FIN message.")
         else:
             logging.info("Received FIN_ACK message. Disconnecting.")
-        self.conn = None
+        self._set_connection(None)
+
+    def _receive_fin(self, fin):
+        """ Handles a client closing a persistent connection. The FIN is
+        answered with a FIN which acknowledges it.
+        """
+        logging.info("Client closed the connection")
+        self.conn.increment_next_expected_index()
+
+        seq = self.conn.get_seq_and_increment()
+        reply = create_fin_message(seq, fin.seq_no, self.conn.header_flags())
+        send_message(self.sock, reply, self.conn.remote_adr)
+
+        self._last_fin = (fin.src_adr, fin.seq_no, reply)
+        self._set_connection(None)
 
     def _send_until_ack_in(self, message):
         """ Transmits the message given and waits for an ACK. Abandons the
         connection if one is not received.
         :return: The ACK `Message` if received,  `None` otherwise
         """
-        ack = send_until_ack_in(message, self.sock, self.conn.remote_adr)
+        return self._send_group_until_ack_in([message])
+
+    def _send_group_until_ack_in(self, messages):
+        """ Transmits the messages given and waits for an ACK of the last.
+        Abandons the connection if one is not received.
+        :return: The ACK `Message` if received,  `None` otherwise
+        """
+        ack = send_group_until_ack_in(messages, self.sock,
+                                      self.conn.remote_adr, self.conn.metrics,
+                                      self.pacer)
         if not ack:
             self._abandon_connection("Maximum retries exceeded")
 
         return ack
 
 
+def _open(file):
+    """ Opens a path or an `RDP_FileIndex.FileEntry` for binary reading.
+    """
+    return file.open() if isinstance(file, FileEntry) else open(file, 'rb')
+
+
+def _cache_key(file):
+    """ The path and version with which to look a file up in the compression
+    cache. The version of an indexed file is known without a `stat`.
+    """
+    if isinstance(file, FileEntry):
+        return file.path, file.version()
+    return file, None
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.src.RDP_Server")
+    parser.add_argument("ip", metavar="<Server IP>",
+                        help="An IP address, or {}<path> to serve on an "
+                             "AF_UNIX datagram socket"
+                        .format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("port", metavar="<Server Port>", type=int, nargs="?",
+                        help="Omitted for {}<path>".format(UNIX_ADDRESS_PREFIX))
+    parser.add_argument("--metrics-file",
+                        help="Periodically write metrics to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="Seconds between metrics dumps (default 10)")
+    parser.add_argument("--metrics-format", default="json",
+                        choices=["json", "prometheus"])
+    parser.add_argument("--root",
+                        help="Serve the files under this directory, indexed "
+                             "in memory, rather than opening requested paths "
+                             "as given")
+    parser.add_argument("--keep-open", action="store_true",
+                        help="Keep indexed files open between requests")
+    parser.add_argument("--read-ahead", type=int,
+                        default=DEFAULT_READ_AHEAD_CHUNKS, metavar="CHUNKS",
+                        help="Chunks of a file to read ahead of the message "
+                             "being sent, or 0 to read files on the serving "
+                             "thread (default {})"
+                        .format(DEFAULT_READ_AHEAD_CHUNKS))
+    parser.add_argument("--disk-threads", type=int,
+                        default=DEFAULT_DISK_THREADS,
+                        help="Threads reading files ahead (default {})"
+                        .format(DEFAULT_DISK_THREADS))
+    parser.add_argument("--pace", type=RDP_Pacing.parse_setting,
+                        metavar="RATE",
+                        help="Pace each connection's packets at RATE bytes "
+                             "per second (e.g. 2M), or 'auto' to derive the "
+                             "rate from the round trip time")
+    parser.add_argument("--trace-file",
+                        help="Dump the recent packet trace to this file "
+                             "whenever a connection is abandoned")
+    parser.add_argument("--capture-file",
+                        help="Append each request served to this file, to "
+                             "replay with a3.bench.RDP_Replay")
+    args = parser.parse_args()
+    try:
+        args.adr = parse_address(args.ip, args.port)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: " 
-              "python3 -m a3.src.RDP_Server <Server IP> <Server Port>")
-    else:
-        ip = sys.argv[1]
-        port = int(sys.argv[2])
-        adr = (ip, port)
-        server = Server(adr)
-        server.serve()
+    args = _parse_args()
+    adr = args.adr
+    file_index = FileIndex(args.root, args.keep_open) if args.root else None
+    server = Server(adr, file_index=file_index, pacing=args.pace,
+                    read_ahead=args.read_ahead, disk_threads=args.disk_threads)
+    if args.metrics_file:
+        server.dump_metrics_periodically(args.metrics_file,
+                                         args.metrics_interval,
+                                         args.metrics_format)
+    server.trace_file = args.trace_file
+    if args.capture_file:
+        server.capture_requests(args.capture_file)
+    server.serve()
@@ -0,0 +1,278 @@
+"""
+    An in-process simulated datagram network on a virtual clock.
+
+    `SimNetwork` connects `SimSocket`s, which implement the subset of the
+    socket API used by `RDP_Protocol` (`bind`, `sendto`, `recvfrom`,
+    `settimeout`, `getsockname`, `close`) plus a `clock` and `sleep` which
+    `RDP_Protocol.clock_of` and `sleep_on` pick up. `Server` and `RDPSession`
+    accept such a socket in place of a real one, so timeouts, retransmissions
+    and the connection lifecycle all run unchanged against the simulation.
+
+    Time only passes when every thread taking part in the simulation is
+    blocked, waiting for a datagram or a timeout. The clock then jumps straight
+    to the next event: a datagram arriving, or the earliest timeout expiring.
+    A scenario which would take seconds of timeouts on a real network runs in
+    as long as its code takes to execute. Threads take part by being started
+    with `spawn`, or by calling `attach` (or using the network as a context
+    manager) for the current thread.
+
+    Each datagram is dropped with probability `loss`, and otherwise delivered
+    after `delay` plus a uniformly random `jitter`, from a seeded random number
+    generator, so every run of a scenario with the same seed is identical as
+    long as the threads taking part are deterministic.
+"""
+import collections
+import heapq
+import itertools
+import random
+import socket
+import threading
+
+SIM_IP = "10.0.0.1"
+FIRST_EPHEMERAL_PORT = 49152
+
+
+class NetworkClosed(OSError):
+    """ Raised in threads blocked on a network when it is closed.
+    """
+
+
+class _Waiter:
+    """ A blocked thread: it is woken once `ready()` holds or its deadline
+    passes.
+    """
+    __slots__ = ("ready", "deadline", "woken")
+
+    def __init__(self, ready, deadline):
+        self.ready = ready
+        self.deadline = deadline
+        self.woken = False
+
+
+class SimNetwork:
+    """ A simulated network with seeded loss and delay. See the module
+    docstring.
+    """
+
+    def __init__(self, seed=None, loss=0.0, delay=0.0, jitter=0.0):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.now = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._sockets = {}  # Bound address -> SimSocket
+        self._in_flight = []  # Heap of (arrival time, order, datagram)
+        self._order = itertools.count()
+        self._ports = itertools.count(FIRST_EPHEMERAL_PORT)
+        self._participants = set()  # Idents of threads taking part
+        self._waiters = []
+        self._closed = False
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def clock(self):
+        return self.now
+
+    def socket(self):
+        """ Creates an unbound socket on the network.
+        """
+        return SimSocket(self)
+
+    def bound_socket(self, adr=(SIM_IP, 0)):
+        sock = SimSocket(self)
+        sock.bind(adr)
+        return sock
+
+    def attach(self):
+        """ Makes the current thread take part in the simulation.
+        """
+        with self._cond:
+            self._participants.add(threading.get_ident())
+
+    def detach(self):
+        with self._cond:
+            self._participants.discard(threading.get_ident())
+            self._cond.notify_all()
+
+    def spawn(self, target, *args):
+        """ Starts a daemon thread taking part in the simulation.
+
+        :return: The `threading.Thread`
+        """
+        started = threading.Event()
+
+        def run():
+            self.attach()
+            started.set()
+            try:
+                target(*args)
+            except NetworkClosed:
+                pass
+            finally:
+                self.detach()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        # The thread must take part before the caller next blocks, or time
+        # could pass without it
+        started.wait()
+        return thread
+
+    def close(self):
+        """ Stops the simulation. Threads blocked on it raise `NetworkClosed`.
+        """
+        with self._cond:
+            self._closed = True
+            self._participants.clear()
+            self._cond.notify_all()
+
+    def sleep(self, seconds):
+        with self._cond:
+            self._block(lambda: False, self.now + seconds)
+
+    # Used by SimSocket, with the lock held
+
+    def _bind(self, sock, adr):
+        host, port = adr
+        if not port:
+            port = next(self._ports)
+            while (host, port) in self._sockets:
+                port = next(self._ports)
+        elif (host, port) in self._sockets:
+            raise OSError("Address already in use: {}".format(adr))
+        self._sockets[(host, port)] = sock
+        return host, port
+
+    def _unbind(self, adr):
+        self._sockets.pop(adr, None)
+
+    def _send(self, data, src_adr, dest_adr):
+        self.sent += 1
+        if self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        arrival = self.now + self.delay + self._random.uniform(0, self.jitter)
+        heapq.heappush(self._in_flight, (arrival, next(self._order),
+                                         (bytes(data), src_adr, dest_adr)))
+
+    def _block(self, ready, deadline):
+        """ Blocks the current thread until `ready()` holds or the clock
+        reaches `deadline` (which may be `None`), letting time pass once every
+        thread taking part is blocked.
+        """
+        if self._closed:
+            raise NetworkClosed("Network closed")
+        if threading.get_ident() not in self._participants:
+            raise RuntimeError("Thread is not taking part in the simulation")
+        if ready() or (deadline is not None and self.now >= deadline):
+            return
+
+        waiter = _Waiter(ready, deadline)
+        self._waiters.append(waiter)
+        try:
+            while not waiter.woken:
+                if self._closed:
+                    raise NetworkClosed("Network closed")
+                if len(self._waiters) >= len(self._participants):
+                    self._advance()
+                else:
+                    self._cond.wait()
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _advance(self):
+        """ Moves the clock to the next event and wakes the threads it
+        unblocks. Called once every thread taking part is blocked.
+        """
+        deadlines = [w.deadline for w in self._waiters
+                     if w.deadline is not None]
+        if self._in_flight:
+            deadlines.append(self._in_flight[0][0])
+        if not deadlines:
+            # Nothing will ever happen unless another thread joins
+            self._cond.wait()
+            return
+
+        self.now = max(self.now, min(deadlines))
+        while self._in_flight and self._in_flight[0][0] <= self.now:
+            _, _, (data, src_adr, dest_adr) = heapq.heappop(self._in_flight)
+            sock = self._sockets.get(dest_adr)
+            if sock:
+                sock._inbox.append((data, src_adr))
+
+        for waiter in list(self._waiters):
+            if waiter.ready() or (waiter.deadline is not None and
+                                  self.now >= waiter.deadline):
+                waiter.woken = True
+                self._waiters.remove(waiter)
+        self._cond.notify_all()
+
+
+class SimSocket:
+    """ A datagram socket on a `SimNetwork`.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.clock = network.clock
+        self.sleep = network.sleep
+        self.family = socket.AF_INET
+        self._adr = None
+        self._timeout = None
+        self._inbox = collections.deque()  # Delivered but not yet read
+
+    def bind(self, adr):
+        with self.network._cond:
+            self._adr = self.network._bind(self, adr)
+
+    def getsockname(self):
+        return self._adr
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def sendto(self, data, adr):
+        with self.network._cond:
+            if self._adr is None:
+                self._adr = self.network._bind(self, (SIM_IP, 0))
+            self.network._send(data, self._adr, adr)
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        """ Returns the next datagram as a `(bytes, address)` pair.
+
+        :raises `socket.timeout` if no datagram arrives within the timeout, in
+        virtual time
+        """
+        network = self.network
+        with network._cond:
+            deadline = None if self._timeout is None \
+                else network.now + self._timeout
+            network._block(lambda: self._inbox, deadline)
+            if not self._inbox:
+                raise socket.timeout("timed out")
+            data, adr = self._inbox.popleft()
+            return data[:bufsize], adr
+
+    def close(self):
+        with self.network._cond:
+            if self._adr is not None:
+                self.network._unbind(self._adr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
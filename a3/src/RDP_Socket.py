@@ -0,0 +1,450 @@
+"""
+    A batching datagram socket layer for RDP.
+
+    `DatagramSocket` wraps a bound UDP socket and exposes the subset of the
+    socket API used by `RDP_Protocol` (`recvfrom`, `sendto`, `settimeout`,
+    `getsockname`). Unlike a raw socket it:
+
+    * caches the local address so `getsockname` costs no syscall,
+    * puts the socket into non-blocking mode once and implements timeouts with
+      a selector, so `settimeout` costs no syscall,
+    * drains every datagram that is ready on each wakeup into a preallocated
+      ring of receive buffers, and
+    * lets outbound datagrams be queued and flushed as a batch.
+
+    On Linux the drain and flush use `recvmmsg`/`sendmmsg` through ctypes, so a
+    full ring costs a single syscall. Elsewhere (or for address families the
+    ctypes path does not understand) it falls back to `recvfrom_into`/`sendto`
+    loops with the same semantics.
+
+    Peers on the same host can use `AF_UNIX` datagram sockets instead of UDP,
+    addressed by a filesystem path (`unix:<path>` on the command line). Such
+    datagrams never leave the kernel or get fragmented, so their sockets take
+    packets of up to `UNIX_BUFFER_SIZE` bytes.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
+import socket
+import stat
+import struct
+import sys
+
+DEFAULT_RING_SIZE = 32
+DEFAULT_BUFFER_SIZE = 1024  # Matches RDP_Protocol.MAX_PACKET_SIZE
+UNIX_BUFFER_SIZE = 65536  # Matches RDP_Protocol.UNIX_MAX_PACKET_SIZE
+
+UNIX_ADDRESS_PREFIX = "unix:"
+
+_SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_mmsg_functions():
+    """ Looks up `recvmmsg` and `sendmmsg` in libc.
+
+    :return: A `(recvmmsg, sendmmsg)` pair, or `None` if unavailable.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                         ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                         ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_MMSG_FUNCTIONS = _load_mmsg_functions()
+
+
+def mmsg_available():
+    """ True if batched syscalls can be used on this platform.
+    """
+    return _MMSG_FUNCTIONS is not None
+
+
+def _encode_sockaddr(family, adr):
+    """ Packs an address tuple into a `struct sockaddr_in`/`sockaddr_in6`.
+
+    :return: The packed address, or `None` if it cannot be packed (e.g. the
+    host is a name rather than a numeric address).
+    """
+    try:
+        if family == socket.AF_INET:
+            host, port = adr
+            return struct.pack("=H", socket.AF_INET) + \
+                struct.pack("!H4s8x", port,
+                            socket.inet_pton(socket.AF_INET, host))
+        elif family == socket.AF_INET6:
+            host, port = adr[0], adr[1]
+            flowinfo = adr[2] if len(adr) > 2 else 0
+            scope_id = adr[3] if len(adr) > 3 else 0
+            return struct.pack("=H", socket.AF_INET6) + \
+                struct.pack("!HI16s", port, flowinfo,
+                            socket.inet_pton(socket.AF_INET6, host)) + \
+                struct.pack("=I", scope_id)
+    except (OSError, ValueError, TypeError, struct.error):
+        pass
+    return None
+
+
+def _decode_sockaddr(raw):
+    """ Unpacks a `struct sockaddr_in`/`sockaddr_in6` into an address tuple in
+    the same form `socket.recvfrom` would return.
+    """
+    family = struct.unpack_from("=H", raw)[0]
+    if family == socket.AF_INET:
+        port, host = struct.unpack_from("!H4s", raw, 2)
+        return socket.inet_ntop(socket.AF_INET, host), port
+    elif family == socket.AF_INET6:
+        port, flowinfo, host = struct.unpack_from("!HI16s", raw, 2)
+        scope_id = struct.unpack_from("=I", raw, 24)[0]
+        return socket.inet_ntop(socket.AF_INET6, host), port, flowinfo, scope_id
+    return None
+
+
+class DatagramSocket:
+    """ A socket wrapper which batches datagram I/O. See the module docstring.
+
+    The wrapped socket must already be bound. The wrapper takes ownership of
+    it; closing the wrapper closes the socket.
+    """
+
+    def __init__(self,
+                 sock,
+                 ring_size=DEFAULT_RING_SIZE,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 use_mmsg=True):
+        self.sock = sock
+        self.family = sock.family
+        self.buffer_size = buffer_size
+        self.packet_size = buffer_size  # Largest datagram sent or received
+        self.ring_size = ring_size
+        self._local_adr = sock.getsockname()
+        self._timeout = None
+
+        # Set the socket mode once. Timeouts are handled by the selector.
+        sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+
+        # Preallocated receive ring. Slots [_next, _ready) hold datagrams that
+        # have been read from the kernel but not yet handed to the caller.
+        self._ring = [bytearray(buffer_size) for _ in range(ring_size)]
+        self._ring_views = [memoryview(buf) for buf in self._ring]
+        self._ring_lengths = [0] * ring_size
+        self._ring_adrs = [None] * ring_size
+        self._next = 0
+        self._ready = 0
+
+        self._outbound = []
+
+        # Traffic counters, read by RDP_Metrics
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+
+        self._mmsg = None
+        if use_mmsg and _MMSG_FUNCTIONS and \
+                self.family in (socket.AF_INET, socket.AF_INET6):
+            self._mmsg = _MMSG_FUNCTIONS
+            self._init_mmsg_vectors()
+
+    def _init_mmsg_vectors(self):
+        n = self.ring_size
+        self._recv_iovs = (_IOVec * n)()
+        self._recv_names = [ctypes.create_string_buffer(_SOCKADDR_SIZE)
+                            for _ in range(n)]
+        self._recv_hdrs = (_MMsgHdr * n)()
+        for i in range(n):
+            buf = (ctypes.c_char * self.buffer_size).from_buffer(self._ring[i])
+            self._recv_iovs[i].iov_base = ctypes.addressof(buf)
+            self._recv_iovs[i].iov_len = self.buffer_size
+            hdr = self._recv_hdrs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._recv_names[i])
+            hdr.msg_iov = ctypes.pointer(self._recv_iovs[i])
+            hdr.msg_iovlen = 1
+
+        self._send_bufs = [ctypes.create_string_buffer(self.buffer_size)
+                           for _ in range(n)]
+        self._send_names = [ctypes.create_string_buffer(_SOCKADDR_SIZE)
+                            for _ in range(n)]
+        self._send_iovs = (_IOVec * n)()
+        self._send_hdrs = (_MMsgHdr * n)()
+        for i in range(n):
+            self._send_iovs[i].iov_base = ctypes.addressof(self._send_bufs[i])
+            hdr = self._send_hdrs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._send_names[i])
+            hdr.msg_iov = ctypes.pointer(self._send_iovs[i])
+            hdr.msg_iovlen = 1
+
+    # Socket API subset used by RDP_Protocol
+
+    def getsockname(self):
+        return self._local_adr
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self._selector:
+            self._selector.close()
+            self._selector = None
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def recvfrom(self, bufsize=None):
+        """ Returns the next datagram as a `(bytes, address)` pair.
+
+        :raises `socket.timeout` if no datagram arrives within the timeout set
+        by `settimeout`.
+        """
+        if self._next == self._ready:
+            self._wait_and_drain()
+
+        i = self._next
+        self._next += 1
+        length = self._ring_lengths[i]
+        if bufsize is not None:
+            length = min(length, bufsize)
+        self.packets_received += 1
+        self.bytes_received += length
+        return bytes(self._ring_views[i][:length]), self._ring_adrs[i]
+
+    def pending(self):
+        """ The number of datagrams already drained but not yet returned.
+        """
+        return self._ready - self._next
+
+    def sendto(self, data, adr):
+        """ Sends a single datagram immediately. Any queued datagrams are
+        flushed first so that ordering is preserved.
+        """
+        if self._outbound:
+            self.flush()
+        self._sendto(data, adr)
+        return len(data)
+
+    def queue(self, data, adr):
+        """ Queues a datagram to be sent by the next `flush`.
+        """
+        self._outbound.append((data, adr))
+        if len(self._outbound) >= self.ring_size:
+            self.flush()
+
+    def flush(self):
+        """ Sends all queued datagrams, in batches where possible.
+        """
+        outbound = self._outbound
+        self._outbound = []
+        if self._mmsg:
+            self._flush_mmsg(outbound)
+        else:
+            for data, adr in outbound:
+                self._sendto(data, adr)
+
+    # Internals
+
+    def _wait_and_drain(self):
+        self._next = 0
+        self._ready = 0
+        while True:
+            self._drain()
+            if self._ready:
+                return
+
+            if self._timeout == 0 or \
+                    not self._selector.select(self._timeout):
+                raise socket.timeout("timed out")
+
+    def _drain(self):
+        if self._mmsg:
+            self._drain_mmsg()
+        else:
+            self._drain_fallback()
+
+    def _drain_fallback(self):
+        for i in range(self.ring_size):
+            try:
+                n, adr = self.sock.recvfrom_into(self._ring[i])
+            except (BlockingIOError, InterruptedError):
+                break
+            self._ring_lengths[i] = n
+            self._ring_adrs[i] = adr
+            self._ready = i + 1
+
+    def _drain_mmsg(self):
+        recvmmsg = self._mmsg[0]
+        for i in range(self.ring_size):
+            self._recv_hdrs[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+
+        n = recvmmsg(self.sock.fileno(), self._recv_hdrs, self.ring_size,
+                     socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise OSError(err, "recvmmsg: " + errno.errorcode.get(err, "?"))
+
+        for i in range(n):
+            self._ring_lengths[i] = self._recv_hdrs[i].msg_len
+            self._ring_adrs[i] = _decode_sockaddr(self._recv_names[i].raw)
+        self._ready = n
+
+    def _sendto(self, data, adr):
+        while True:
+            try:
+                self.sock.sendto(data, adr)
+                self.packets_sent += 1
+                self.bytes_sent += len(data)
+                return
+            except (BlockingIOError, InterruptedError):
+                self._wait_writable()
+
+    def _wait_writable(self):
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.sock, selectors.EVENT_WRITE)
+            sel.select()
+
+    def _flush_mmsg(self, outbound):
+        sendmmsg = self._mmsg[1]
+        start = 0
+        while start < len(outbound):
+            count = 0
+            for data, adr in outbound[start:start + self.ring_size]:
+                name = _encode_sockaddr(self.family, adr)
+                if name is None or len(data) > self.buffer_size:
+                    break
+                ctypes.memmove(self._send_bufs[count], bytes(data), len(data))
+                self._send_iovs[count].iov_len = len(data)
+                ctypes.memmove(self._send_names[count], name, len(name))
+                self._send_hdrs[count].msg_hdr.msg_namelen = len(name)
+                count += 1
+
+            if count == 0:
+                # Cannot be batched; send it the slow way.
+                self._sendto(*outbound[start])
+                start += 1
+                continue
+
+            sent = sendmmsg(self.sock.fileno(), self._send_hdrs, count, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._wait_writable()
+                    continue
+                raise OSError(err, "sendmmsg: " + errno.errorcode.get(err, "?"))
+            self.packets_sent += sent
+            self.bytes_sent += sum(len(data) for data, _ in
+                                   outbound[start:start + sent])
+            start += sent
+
+
+def wrap_socket(sock, **kwargs):
+    """ Wraps a bound socket in a `DatagramSocket`. Objects which are not
+    sockets (e.g. an existing `DatagramSocket`) are returned unchanged.
+    """
+    if isinstance(sock, socket.socket):
+        if sock.family == socket.AF_UNIX:
+            kwargs.setdefault("buffer_size", UNIX_BUFFER_SIZE)
+        return DatagramSocket(sock, **kwargs)
+    return sock
+
+
+def parse_address(host, port=None):
+    """ Parses an address given on the command line: `unix:<path>` for an
+    `AF_UNIX` socket, otherwise an IP address and port.
+
+    :return: The path, or an `(ip, port)` pair
+    :raises `ValueError` if an IP address is given without a port
+    """
+    if host.startswith(UNIX_ADDRESS_PREFIX):
+        return host[len(UNIX_ADDRESS_PREFIX):]
+    if port is None:
+        raise ValueError("A port is required for IP address {}".format(host))
+    return host, port
+
+
+def address_family(adr):
+    """ `AF_UNIX` for a path, `AF_INET` for an `(ip, port)` pair.
+    """
+    return socket.AF_UNIX if isinstance(adr, (str, bytes)) else socket.AF_INET
+
+
+def bind_socket(adr, reuse_port=False):
+    """ Creates a datagram socket bound to `adr`, in the family of the address.
+
+    A path of `""` binds an `AF_UNIX` socket to an unused abstract address
+    (Linux), which is how clients of an `AF_UNIX` server are bound. A socket
+    file left at the path by a server which is no longer running is replaced.
+
+    :param reuse_port If true, an IP socket is bound with `SO_REUSEPORT`
+    """
+    family = address_family(adr)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        if family == socket.AF_UNIX:
+            if adr:
+                _remove_stale_socket(adr)
+        elif reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(adr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _remove_stale_socket(path):
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)  # Nothing is bound to it any more
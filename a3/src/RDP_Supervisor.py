@@ -0,0 +1,241 @@
+"""
+    A multi-process RDP server.
+
+    `Supervisor` runs several `RDP_Server.Server` worker processes bound to the
+    same address with `SO_REUSEPORT`. The kernel hashes each datagram's address
+    pair to pick the worker which receives it, so every client stays with one
+    worker for as long as the set of workers is unchanged, and each worker
+    serves its own clients on its own core.
+
+    The set of workers changes while a worker is replaced: its socket leaves
+    the group when it dies and the replacement's joins it once the replacement
+    is `ready`. Each change re-hashes clients across the workers, so clients
+    part way through a transfer may have their datagrams moved to a worker
+    which does not know them. Such a client retries and, if its retries run
+    out, has to connect again.
+
+    Each worker reports a snapshot of its metrics to the supervisor every
+    `stats_interval` seconds. The supervisor restarts workers which die and
+    aggregates the latest snapshot of every worker, including the final totals
+    of workers which have been replaced:
+
+        python3 -m a3.src.RDP_Supervisor <Server IP> <Server Port> --workers 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+
+from .RDP_FileIndex import FileIndex
+from .RDP_Metrics import MetricsDumper, MetricsRegistry
+from .RDP_Server import Server
+
+DEFAULT_STATS_INTERVAL_SECONDS = 1
+WORKER_START_TIMEOUT = 5
+# Restarts of one worker are delayed by at least this long, so a worker which
+# fails straight away does not spin
+RESTART_BACKOFF_SECONDS = 1
+
+
+def _run_worker(adr, root, stats, interval, ready):
+    """ The body of a worker process: serves on `adr` while putting a snapshot
+    of its metrics on the `stats` queue every `interval` seconds.
+    """
+    pid = os.getpid()
+    server = Server(adr, reuse_port=True,
+                    file_index=FileIndex(root) if root else None)
+
+    def report():
+        while True:
+            time.sleep(interval)
+            stats.put((pid, server.metrics.snapshot()))
+
+    threading.Thread(target=report, daemon=True).start()
+    server.serve(ready)
+
+
+class _Worker:
+    """ The supervisor's record of one worker slot.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.process = None
+        self.started_at = None
+        self.ready = None  # Set once the current process is serving
+        self.snapshot = None  # Latest snapshot from the current process
+
+
+class Supervisor:
+    """ Runs `workers` server processes on `adr` and restarts them if they die.
+    """
+
+    def __init__(self,
+                 adr,
+                 workers=None,
+                 stats_interval=DEFAULT_STATS_INTERVAL_SECONDS,
+                 root=None):
+        """
+        :param adr The address to serve on. If its port is 0, a free port is
+        chosen and `adr` holds it once `serve` has been called.
+        :param workers The number of worker processes (default one per CPU)
+        :param root A document root for each worker to index and serve from
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+        self.adr = adr
+        self.workers = [_Worker("rdp-worker-{}".format(i))
+                        for i in range(workers or os.cpu_count() or 1)]
+        self.stats_interval = stats_interval
+        self.root = root
+        self.restarts = 0
+        self.metrics_dumper = None
+        self._retired = MetricsRegistry()  # Totals of replaced processes
+        self._stats = multiprocessing.Queue()
+        self._stopped = threading.Event()
+
+    def dump_metrics_periodically(self, path, interval, fmt="json"):
+        """ Writes the aggregated metrics to a file every `interval` seconds
+        while serving.
+
+        :param fmt "json" or "prometheus"
+        """
+        self.metrics_dumper = MetricsDumper(MetricsRegistry(), path, interval,
+                                            fmt)
+
+    def serve(self, ready=None):
+        """ Starts the workers and supervises them until `stop` is called.
+
+        :param ready An optional `threading.Event` which is set once every
+        worker is serving
+        """
+        self._resolve_port()
+        try:
+            for worker in self.workers:
+                self._start(worker)
+            for worker in self.workers:
+                if not worker.ready.wait(WORKER_START_TIMEOUT):
+                    raise RuntimeError("Worker did not start")
+            if ready:
+                ready.set()
+            last_dump = time.monotonic()
+            while not self._stopped.is_set():
+                self._collect_stats(self.stats_interval)
+                self._restart_dead_workers()
+                if self.metrics_dumper and time.monotonic() - last_dump >= \
+                        self.metrics_dumper.interval:
+                    self._dump_metrics()
+                    last_dump = time.monotonic()
+        finally:
+            for worker in self.workers:
+                if worker.process:
+                    worker.process.terminate()
+                    worker.process.join()
+            if self.metrics_dumper:
+                self._dump_metrics()
+
+    def stop(self):
+        self._stopped.set()
+
+    def metrics(self):
+        """ The metrics of all workers, current and replaced, as of their last
+        report.
+
+        :return: A `MetricsRegistry`
+        """
+        registry = MetricsRegistry()
+        registry.merge_snapshot(self._retired.snapshot())
+        for worker in self.workers:
+            if worker.snapshot:
+                registry.merge_snapshot(worker.snapshot)
+        registry.counters["worker_restarts"] = self.restarts
+        return registry
+
+    def _resolve_port(self):
+        if self.adr[1]:
+            return
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(self.adr)
+            self.adr = sock.getsockname()
+
+    def _start(self, worker):
+        """ Starts a process for the worker slot. `worker.ready` is set once
+        it is serving.
+        """
+        worker.ready = multiprocessing.Event()
+        worker.process = multiprocessing.Process(
+            target=_run_worker, name=worker.name,
+            args=(self.adr, self.root, self._stats, self.stats_interval,
+                  worker.ready),
+            daemon=True)
+        worker.started_at = time.monotonic()
+        worker.snapshot = None
+        worker.process.start()
+
+    def _collect_stats(self, timeout):
+        """ Records the snapshots reported within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                pid, snapshot = self._stats.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            for worker in self.workers:
+                if worker.process.pid == pid:
+                    worker.snapshot = snapshot
+
+    def _restart_dead_workers(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                continue
+            if time.monotonic() - worker.started_at < RESTART_BACKOFF_SECONDS:
+                continue
+            logging.warning("Worker {} exited with code {}, restarting".format(
+                worker.name, worker.process.exitcode))
+            if worker.snapshot:
+                self._retired.merge_snapshot(worker.snapshot)
+            self.restarts += 1
+            self._start(worker)
+
+    def _dump_metrics(self):
+        self.metrics_dumper.registry = self.metrics()
+        try:
+            self.metrics_dumper.dump()
+        except OSError as e:
+            logging.warning("Unable to write metrics: {}".format(e))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m a3.src.RDP_Supervisor")
+    parser.add_argument("ip", metavar="<Server IP>")
+    parser.add_argument("port", metavar="<Server Port>", type=int)
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes (default one per CPU)")
+    parser.add_argument("--root",
+                        help="Serve the files under this directory, indexed "
+                             "in memory by each worker")
+    parser.add_argument("--metrics-file",
+                        help="Periodically write aggregated metrics to this "
+                             "file")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="Seconds between metrics dumps (default 10)")
+    parser.add_argument("--metrics-format", default="json",
+                        choices=["json", "prometheus"])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    supervisor = Supervisor((args.ip, args.port), args.workers,
+                            root=args.root)
+    if args.metrics_file:
+        supervisor.dump_metrics_periodically(args.metrics_file,
+                                             args.metrics_interval,
+                                             args.metrics_format)
+    supervisor.serve()
@@ -0,0 +1,155 @@
+"""
+    A hashed timer wheel for scheduling RDP timeouts.
+
+    Timers are hashed into a fixed number of slots by the tick on which they
+    expire, so scheduling and cancelling a timer are both O(1) regardless of
+    how many timers are outstanding. Expired timers are fired by calling
+    `advance`, typically from an I/O loop that blocks for at most
+    `time_until_next()` seconds between calls.
+
+    All times come from a monotonic clock, so timers are unaffected by changes
+    to the wall clock.
+"""
+import math
+import time
+
+DEFAULT_TICK_SECONDS = 0.01
+DEFAULT_SLOT_COUNT = 512
+
+# Tolerance, in ticks, for floating point error when converting times to ticks
+_TICK_EPSILON = 1e-6
+
+
+class Timer:
+    """ A handle to a scheduled callback. Returned by `TimerWheel.schedule`.
+    """
+    __slots__ = ("deadline", "callback", "args", "expiry_tick", "slot")
+
+    def __init__(self, deadline, callback, args, expiry_tick, slot):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.expiry_tick = expiry_tick
+        self.slot = slot  # None once fired or cancelled
+
+    def is_active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    """ Schedules callbacks to be run after a delay. Not thread safe; a wheel
+    should be owned by the loop which calls `advance`.
+    """
+
+    def __init__(self,
+                 tick=DEFAULT_TICK_SECONDS,
+                 slot_count=DEFAULT_SLOT_COUNT,
+                 clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots = [dict() for _ in range(slot_count)]
+        self._current_tick = self._tick_of(clock())
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _tick_of(self, t):
+        return math.floor(t / self.tick + _TICK_EPSILON)
+
+    def schedule(self, delay, callback, *args):
+        """ Schedules `callback(*args)` to run once `delay` seconds have passed.
+
+        :return: A `Timer` which may be passed to `cancel`.
+        """
+        deadline = self.clock() + delay
+
+        # Round up so that a timer never fires early, and never into a tick
+        # that has already been processed.
+        expiry_tick = max(math.ceil(deadline / self.tick - _TICK_EPSILON),
+                          self._current_tick + 1)
+        slot = self._slots[expiry_tick % len(self._slots)]
+
+        timer = Timer(deadline, callback, args, expiry_tick, slot)
+        slot[timer] = None
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """ Cancels the timer if it has not already fired. O(1).
+        """
+        if timer is not None and timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self._count -= 1
+
+    def reschedule(self, timer, delay):
+        """ Cancels the given timer (if any) and schedules its callback again.
+
+        :return: The new `Timer`.
+        """
+        self.cancel(timer)
+        return self.schedule(delay, timer.callback, *timer.args)
+
+    def advance(self, now=None):
+        """ Fires every timer whose deadline has passed.
+
+        :return: The number of timers fired.
+        """
+        if now is None:
+            now = self.clock()
+        target_tick = self._tick_of(now)
+
+        expired = []
+        # After a long pause every slot may need visiting, but never twice.
+        first_tick = self._current_tick + 1
+        last_tick = min(target_tick, self._current_tick + len(self._slots))
+        for tick in range(first_tick, last_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                expired.extend(t for t in slot if t.expiry_tick <= target_tick)
+
+        self._current_tick = max(self._current_tick, target_tick)
+
+        for timer in expired:
+            self.cancel(timer)
+        for timer in expired:
+            timer.callback(*timer.args)
+        return len(expired)
+
+    def _earliest(self):
+        if not self._count:
+            return None
+
+        # Scan forward one revolution. The first slot containing a timer due
+        # within that revolution holds the earliest timer.
+        slot_count = len(self._slots)
+        for offset in range(1, slot_count + 1):
+            tick = self._current_tick + offset
+            slot = self._slots[tick % slot_count]
+            due = [t for t in slot if t.expiry_tick == tick]
+            if due:
+                return min(due, key=lambda t: t.deadline)
+
+        # Every timer is more than one revolution away.
+        return min((t for slot in self._slots for t in slot),
+                   key=lambda t: t.deadline)
+
+    def next_deadline(self):
+        """ The deadline of the earliest pending timer, or `None` if there are
+        no timers.
+        """
+        timer = self._earliest()
+        return timer.deadline if timer else None
+
+    def time_until_next(self):
+        """ Seconds until the earliest pending timer will be fired by `advance`,
+        suitable for use as a socket timeout. `None` if there are no timers.
+        """
+        timer = self._earliest()
+        if timer is None:
+            return None
+
+        # Timers fire on tick boundaries
+        fire_time = timer.expiry_tick * self.tick
+        return max(fire_time - self.clock(), 0)
@@ -0,0 +1,133 @@
+"""
+    An always-on, fixed-size trace of the RDP packets sent and received.
+
+    Every packet passing through `RDP_Protocol.send_message` or
+    `RDP_Protocol.try_read_message` is recorded in `TRACE`, a preallocated ring
+    buffer of fixed size binary records (timestamp, direction, header fields
+    and payload length). Recording a packet is a single `struct.pack_into`, so
+    the trace costs almost nothing until it is dumped.
+
+    A dump is a small binary file which can be decoded into a timeline with:
+
+        python3 -m a3.src.RDP_Trace <Trace File>
+"""
+import itertools
+import struct
+import sys
+import time
+from collections import namedtuple
+
+DEFAULT_CAPACITY = 4096
+
+SENT = 0
+RECEIVED = 1
+
+# Timestamp, direction, header bytes 0-3, payload length
+_RECORD = struct.Struct("<dBBBBBxH")
+_FILE_HEADER = struct.Struct("<4sBI")
+_MAGIC = b"RDPT"
+_VERSION = 1
+
+_PACKET_TYPES = ["ACK", "SYN", "FIN", "APP"]
+
+TraceEvent = namedtuple("TraceEvent", ["timestamp", "direction", "packet_type",
+                                       "is_ack", "flags", "seq_no", "ack_no",
+                                       "payload_len"])
+
+
+class PacketTrace:
+    """ A ring buffer holding the most recent `capacity` packet events.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity * _RECORD.size)
+        self._counter = itertools.count()  # next() is atomic under the GIL
+        self._recorded = 0
+
+    def record(self, direction, packet, _pack=_RECORD.pack_into,
+               _size=_RECORD.size, _now=time.time):
+        """ Records a packet given in its binary form.
+        """
+        i = next(self._counter)
+        self._recorded = i + 1
+        _pack(self._buffer, (i % self.capacity) * _size, _now(), direction,
+              packet[0], packet[1], packet[2], packet[3],
+              (packet[4] << 8) | packet[5])
+
+    def __len__(self):
+        return min(self._recorded, self.capacity)
+
+    def _raw_records(self):
+        """ The recorded events in chronological order, in binary form.
+        """
+        count = len(self)
+        start = self._recorded - count
+        size = _RECORD.size
+        records = bytearray()
+        for i in range(start, start + count):
+            offset = (i % self.capacity) * size
+            records += self._buffer[offset:offset + size]
+        return records
+
+    def events(self):
+        return list(_decode_records(self._raw_records()))
+
+    def dump(self, path):
+        """ Writes the trace to a file which `load` can read.
+        """
+        records = self._raw_records()
+        with open(path, "wb") as f:
+            f.write(_FILE_HEADER.pack(_MAGIC, _VERSION,
+                                      len(records) // _RECORD.size))
+            f.write(records)
+
+
+def _decode_records(records):
+    for (timestamp, direction, type_byte, flags, seq_no, ack_no,
+         payload_len) in _RECORD.iter_unpack(records):
+        type_id = type_byte & 0x7F
+        packet_type = _PACKET_TYPES[type_id] if type_id < len(_PACKET_TYPES) \
+            else str(type_id)
+        is_ack = bool(type_byte & 0x80)
+        yield TraceEvent(timestamp, direction, packet_type, is_ack, flags,
+                         seq_no, ack_no if is_ack else None, payload_len)
+
+
+def load(path):
+    """ Reads a trace written by `PacketTrace.dump`.
+
+    :return: A list of `TraceEvent`s in chronological order
+    """
+    with open(path, "rb") as f:
+        magic, version, count = _FILE_HEADER.unpack(
+            f.read(_FILE_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("Not an RDP trace file: {}".format(path))
+        return list(_decode_records(f.read(count * _RECORD.size)))
+
+
+def format_timeline(events):
+    """ Formats events as one line each, with times relative to the first.
+    """
+    lines = []
+    start = events[0].timestamp if events else 0
+    for event in events:
+        arrow = "->" if event.direction == SENT else "<-"
+        ack = "" if event.ack_no is None else "ack={}".format(event.ack_no)
+        lines.append("{:>10.3f}ms {} {:<3} seq={:<3} {:<7} flags={:#04x} "
+                     "len={}".format((event.timestamp - start) * 1000, arrow,
+                                     event.packet_type, event.seq_no, ack,
+                                     event.flags, event.payload_len))
+    return "\n".join(lines)
+
+
+# The process wide trace used by RDP_Protocol
+TRACE = PacketTrace()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python3 -m a3.src.RDP_Trace <Trace File>")
+    else:
+        print(format_timeline(load(sys.argv[1])))
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from a3.bench.RDP_Benchmark import compare_to_baseline, parse_size
+from a3.bench.RDP_MachineBench import transfer
+from a3.bench.RDP_Replay import percentile, replay
+from a3.bench.RDP_SchedulerBench import simulate
+from a3.src.RDP_FileIndex import FileIndex
+from a3.src.RDP_Server import Server
+
+
+def _result(size=1024, concurrency=1, failures=0, throughput=1000.0,
+            completion=1.0):
+    return {"size": size, "concurrency": concurrency, "failures": failures,
+            "throughput_bytes_per_second": throughput,
+            "completion_seconds_median": completion}
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(0, parse_size("0"))
+        self.assertEqual(512, parse_size("512"))
+        self.assertEqual(64 * 1024, parse_size("64K"))
+        self.assertEqual(1 << 30, parse_size("1g"))
+
+    def test_compare_to_baseline(self):
+        baseline = {"results": [_result(), _result(concurrency=2)]}
+
+        within_tolerance = {"results": [_result(throughput=900)]}
+        self.assertEqual([], compare_to_baseline(within_tolerance, baseline))
+
+        regressed = {"results": [_result(throughput=500, completion=2.0),
+                                 _result(concurrency=2, failures=1),
+                                 _result(size=0)]}  # No baseline
+        unix = _result(throughput=1)
+        unix["transport"] = "unix"  # No baseline for this transport
+        regressed["results"].append(unix)
+        regressions = compare_to_baseline(regressed, baseline)
+        self.assertEqual(3, len(regressions))
+        self.assertTrue(any("throughput" in r for r in regressions))
+        self.assertTrue(any("completion" in r for r in regressions))
+        self.assertTrue(any("failures" in r for r in regressions))
+
+    def test_machine_transfer(self):
+        for group_size in (0, 4):
+            result = transfer(200, group_size, loss=0.1, seed=3)
+            self.assertEqual(200, result["delivered"])
+            self.assertEqual(0, result["failures"])
+            self.assertGreater(result["dropped"], 0)
+            self.assertGreater(result["virtual_seconds"], 0)
+
+    def test_scheduler_simulation(self):
+        results = {policy: simulate(policy, 1 << 20, small_count=20,
+                                    interval=0.005, seed=1)
+                   for policy in ("fifo", "drr", "srf")}
+        for result in results.values():
+            self.assertAlmostEqual(results["fifo"]["virtual_seconds"],
+                                   result["virtual_seconds"])
+        # Small transfers wait behind the large one only under fifo
+        self.assertLess(10 * results["drr"]["small_completion_seconds_p99"],
+                        results["fifo"]["small_completion_seconds_p99"])
+        self.assertLessEqual(results["srf"]["small_completion_seconds_p99"],
+                             results["drr"]["small_completion_seconds_p99"])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile([1], 99))
+        self.assertIsNone(percentile([], 50))
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "file"), 'wb') as file:
+                file.write(os.urandom(2000))
+            server = Server(("127.0.0.1", 0), file_index=FileIndex(directory))
+            ready = threading.Event()
+            thread = threading.Thread(target=server.serve, args=(ready,),
+                                      daemon=True)
+            thread.start()
+            self.assertTrue(ready.wait(5))
+
+            requests = [
+                {"time": 10.0, "filename": "file", "fields": {},
+                 "status": 200},
+                {"time": 10.5, "filename": "file",
+                 "fields": {"offset": "100", "length": "50"}, "status": 200},
+                {"time": 11.0, "filename": "missing", "fields": {},
+                 "status": 404},
+                # The file was served when captured, but is not now
+                {"time": 12.0, "filename": "gone", "fields": {},
+                 "status": 200},
+                # The connection was lost when captured
+                {"time": 12.5, "filename": "gone", "fields": {},
+                 "status": 200, "completed": False},
+                # The file has changed size since
+                {"time": 13.0, "filename": "file", "fields": {},
+                 "status": 200, "bytes": 1000, "completed": True},
+                # Sent compressed when captured
+                {"time": 13.0, "filename": "file", "fields": {},
+                 "status": 200, "bytes": 1000, "compressed": True}]
+            try:
+                result = replay(server.adr, requests, speedup=10,
+                                max_clients=1)
+            finally:
+                server.stop()
+                thread.join(5)
+
+        self.assertEqual(7, result["requests"])
+        self.assertEqual(1, result["failures"])
+        self.assertEqual(1, result["expected_failures"])
+        self.assertEqual(1, result["byte_mismatches"])
+        self.assertEqual(6050, result["bytes"])
+        self.assertEqual(3.0, result["captured_seconds"])
+        # The last request is due 0.3 s after the first
+        self.assertGreaterEqual(result["wall_seconds"], 0.3)
+        latency = result["latency_seconds"]
+        self.assertTrue(0 < latency["p50"] <= latency["p99"] <= latency["max"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import concurrent.futures
+import io
+import logging
+import os
+import random
+import tempfile
+import unittest
+
+from a3.src.RDP_Chunking import *
+from a3.src.RDP_Client import RDPSession
+from a3.src.RDP_Protocol import *
+from a3.src.RDP_Server import Server
+from a3.src.RDP_SimNet import SIM_IP, SimNetwork
+
+SERVER_ADR = (SIM_IP, 5000)
+
+
+def _random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+class ChunkingTest(unittest.TestCase):
+
+    def test_chunk_sizes(self):
+        data = _random_bytes(500000)
+        ends = chunk_ends(data)
+        self.assertEqual(len(data), ends[-1])
+        sizes = [end - start for start, end in zip([0] + ends, ends)]
+        self.assertTrue(all(MIN_CHUNK_SIZE <= size <= MAX_CHUNK_SIZE
+                            for size in sizes[:-1]))
+        self.assertEqual([], chunk_ends(b""))
+        # Content without boundaries is cut at the maximum size
+        self.assertEqual([MAX_CHUNK_SIZE, MAX_CHUNK_SIZE + 5],
+                         chunk_ends(bytes(MAX_CHUNK_SIZE + 5)))
+
+    def test_edit_changes_few_chunks(self):
+        data = _random_bytes(500000)
+        edited = data[:200000] + b"inserted" + data[200010:]
+        before = set(create_manifest(data))
+        after = create_manifest(edited)
+        changed = [entry for entry in after if entry not in before]
+        self.assertLessEqual(len(changed), 2)
+        self.assertGreater(len(after), 20)
+
+    def test_read_manifest(self):
+        data = _random_bytes(500000)
+        manifest = create_manifest(data)
+        # Blocks smaller and larger than a chunk give the same chunks as the
+        # content read whole
+        for block_size in [1000, MAX_CHUNK_SIZE, 100000]:
+            self.assertEqual(manifest,
+                             read_manifest(io.BytesIO(data), block_size))
+        self.assertEqual(create_manifest(bytes(200000)),
+                         read_manifest(io.BytesIO(bytes(200000)), 1000))
+        self.assertEqual([], read_manifest(io.BytesIO(b"")))
+
+    def test_manifest_encoding(self):
+        manifest = create_manifest(_random_bytes(50000))
+        self.assertEqual(manifest, decode_manifest(encode_manifest(manifest)))
+        self.assertEqual([], decode_manifest(b""))
+        self.assertRaises(ValueError, decode_manifest, b"\x00" * 35)
+
+    def test_missing_ranges(self):
+        manifest = [(10, b""), (20, b""), (30, b""), (40, b"")]
+        self.assertEqual([], missing_ranges(manifest, [True] * 4))
+        self.assertEqual([(0, 100, 0, 4)],
+                         missing_ranges(manifest, [False] * 4))
+        self.assertEqual([(10, 50, 1, 3)],
+                         missing_ranges(manifest, [True, False, False, True]))
+        self.assertEqual([(0, 10, 0, 1), (30, 30, 2, 3)],
+                         missing_ranges(manifest, [False, True, False, True]))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_manifest_cache(self):
+        path = os.path.join(self.directory.name, "file")
+        with open(path, "wb") as f:
+            f.write(_random_bytes(20000))
+        cache = ManifestCache()
+        manifest = cache.get(path)
+        self.assertEqual(manifest, cache.get(path))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        with open(path, "ab") as f:
+            f.write(b"more")
+        self.assertNotEqual(manifest, cache.get(path))
+        self.assertEqual(2, cache.misses)
+
+    def test_manifest_cache_builds_large_files_on_executor(self):
+        path = os.path.join(self.directory.name, "file")
+        data = _random_bytes(20000)
+        with open(path, "wb") as f:
+            f.write(data)
+        cache = ManifestCache(inline_bytes=10000)
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            # Not available until built, and only built once
+            self.assertIsNone(cache.get(path, executor=executor))
+            self.assertIsNone(cache.get(path, executor=executor))
+        finally:
+            executor.shutdown()
+        expected = encode_manifest(create_manifest(data))
+        self.assertEqual(expected, cache.get(path, executor=executor))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        # Smaller files are chunked straight away
+        cache = ManifestCache(inline_bytes=len(data))
+        self.assertEqual(expected, cache.get(path, executor=executor))
+
+    def test_chunk_cache(self):
+        cache = ChunkCache(os.path.join(self.directory.name, "chunks"),
+                           max_bytes=250)
+        chunks = [bytes([i]) * 100 for i in range(3)]
+        for i, chunk in enumerate(chunks):
+            cache.put(chunk)
+            os.utime(cache._path(digest(chunk)), ns=(i, i))
+        self.assertEqual(chunks[0], cache.get(digest(chunks[0])))
+        self.assertIsNone(cache.get(digest(b"absent")))
+
+        # The least recently used chunk goes first
+        self.assertEqual(1, cache.prune())
+        self.assertIsNone(cache.get(digest(chunks[1])))
+        self.assertEqual(chunks[2], cache.get(digest(chunks[2])))
+
+
+class DeduplicatedTransferTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "file")
+        self.cache = ChunkCache(os.path.join(self.directory.name, "chunks"))
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def _fetch(self, data, options):
+        with open(self.path, "wb") as f:
+            f.write(data)
+        with SimNetwork(delay=0.001) as network:
+            server = Server(None, sock=network.bound_socket(SERVER_ADR))
+            network.spawn(server.serve)
+            with RDPSession(SERVER_ADR, options,
+                            sock=network.bound_socket()) as session:
+                self.assertEqual(data, session.get_deduplicated(self.path,
+                                                                self.cache))
+                return session
+
+    def test_fetches_only_changed_chunks(self):
+        options = {OPTION_DEDUP: "1", OPTION_COMPRESS: "zlib",
+                   OPTION_DIGEST: DIGEST_MD5, OPTION_SIZE: "1"}
+        data = _random_bytes(200000)
+        session = self._fetch(data, options)
+        self.assertEqual((0, len(data)),
+                         (session.reused_bytes, session.fetched_bytes))
+
+        edited = data[:100000] + b"edit" + data[100000:]
+        session = self._fetch(edited, options)
+        self.assertGreater(session.reused_bytes, len(data) * 0.8)
+        self.assertLessEqual(session.fetched_bytes, 2 * MAX_CHUNK_SIZE)
+
+        session = self._fetch(b"", options)
+        self.assertEqual((0, 0),
+                         (session.reused_bytes, session.fetched_bytes))
+
+    def test_manifest_not_ready(self):
+        data = _random_bytes(5000)
+        with open(self.path, "wb") as f:
+            f.write(data)
+        with SimNetwork(delay=0.001) as network:
+            server = Server(None, sock=network.bound_socket(SERVER_ADR))
+            server.manifest_cache = ManifestCache(inline_bytes=0)
+            network.spawn(server.serve)
+            with RDPSession(SERVER_ADR, {OPTION_DEDUP: "1"},
+                            sock=network.bound_socket()) as session:
+                # Fetched in full while the server chunks the file
+                self.assertEqual(data, session.get_deduplicated(self.path,
+                                                                self.cache))
+                self.assertEqual(0, session.reused_bytes +
+                                 session.fetched_bytes)
+
+    def test_without_dedup(self):
+        session = self._fetch(_random_bytes(5000), {})
+        self.assertEqual(0, session.reused_bytes + session.fetched_bytes)
+        self.assertEqual([], os.listdir(self.cache.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
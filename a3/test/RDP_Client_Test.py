@@ -0,0 +1,178 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+
+from a3.bench.RDP_Impairment import LossyProxy
+from a3.src import RDP_Client
+from a3.src.RDP_Client import RDPSession, fast_open_request, parallel_main, \
+    split_ranges
+from a3.src.RDP_Protocol import *
+from a3.src.RDP_Server import Server
+
+LOOPBACK_ADR = ("127.0.0.1", 0)
+TIMEOUT = 5
+
+
+class ClientTest(unittest.TestCase):
+
+    def test_split_ranges(self):
+        for size in [0, 1, 5, 1000, 1001]:
+            for streams in [1, 2, 3, 8]:
+                ranges = split_ranges(size, streams)
+                self.assertLessEqual(len(ranges), streams)
+
+                # Contiguous, non-empty and covering the whole file
+                offset = 0
+                for range_offset, length in ranges:
+                    self.assertEqual(offset, range_offset)
+                    self.assertGreater(length, 0)
+                    offset += length
+                self.assertEqual(size, offset)
+
+    def test_split_ranges_balanced(self):
+        lengths = [length for _, length in split_ranges(10, 3)]
+        self.assertEqual([4, 3, 3], lengths)
+
+
+class RDPSessionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.log_level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.WARNING)
+        cls.server = Server(LOOPBACK_ADR)
+        ready = threading.Event()
+        cls.thread = threading.Thread(target=cls.server.serve, args=(ready,),
+                                      daemon=True)
+        cls.thread.start()
+        ready.wait(TIMEOUT)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.thread.join(TIMEOUT)
+        logging.getLogger().setLevel(cls.log_level)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = {}
+        for i, size in enumerate([0, 1, 3000, 10000]):
+            path = os.path.join(self.directory.name, str(i))
+            self.files[path] = os.urandom(size)
+            with open(path, "wb") as f:
+                f.write(self.files[path])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_many_requests_over_one_connection(self):
+        for options in [None, {"compress": "zlib"}]:
+            with RDPSession(self.server.adr, options) as session:
+                for path, content in self.files.items():
+                    self.assertEqual(content, session.get(path))
+                connection = session.connection
+
+                missing = os.path.join(self.directory.name, "missing")
+                self.assertIsNone(session.get(missing))
+
+                path = list(self.files)[-1]
+                self.assertEqual(self.files[path][100:300],
+                                 session.get(path, 100, 200))
+
+                # Everything was fetched without reconnecting
+                self.assertIs(connection, session.connection)
+                self.assertTrue(connection.is_persistent())
+            self.assertTrue(connection.closed)
+
+    def test_fast_open(self):
+        path = list(self.files)[-1]
+        with RDPSession(self.server.adr, fast_open=True) as session:
+            self.assertEqual(self.files[path], session.get(path))
+            connection = session.connection
+            self.assertEqual(self.files[path][5:], session.get(path, 5))
+            self.assertIs(connection, session.connection)
+
+    def test_fast_open_falls_back_to_handshake(self):
+        # The server picks zlib, so it cannot accept the options as offered
+        path = list(self.files)[-1]
+        options = {OPTION_COMPRESS: "unknown,zlib"}
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(LOOPBACK_ADR)
+            connection, content = fast_open_request(self.server.adr, sock,
+                                                    path, options=options)
+        self.assertEqual(self.files[path], content)
+        self.assertEqual("zlib", connection.options[OPTION_COMPRESS])
+
+    def test_duplicate_fast_open_syn_ignored(self):
+        path = list(self.files)[1]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(LOOPBACK_ADR)
+            connection, content = fast_open_request(self.server.adr, sock,
+                                                    path)
+            self.assertEqual(self.files[path], content)
+
+            # A late retransmission of the SYN must not start a new response
+            syn_seq = (connection.seq_num - 1) % MAX_SEQ_NUMBER
+            syn = create_syn_message(syn_seq, request=encode_request(path))
+            send_message(sock, syn, self.server.adr)
+            self.assertRaises(socket.timeout, try_read_message, sock, 0.5)
+
+    def test_crc_and_digest(self):
+        for codec in [None, "zlib"]:
+            options = {OPTION_CRC: "1", OPTION_DIGEST: DIGEST_MD5}
+            if codec:
+                options[OPTION_COMPRESS] = codec
+            with RDPSession(self.server.adr, options) as session:
+                for path, content in self.files.items():
+                    self.assertEqual(content, session.get(path))
+                    self.assertIsNotNone(session.connection.server_digest)
+
+                path = list(self.files)[-1]
+                self.assertEqual(self.files[path][100:300],
+                                 session.get(path, 100, 200))
+
+    def test_response_size(self):
+        for extra in [{}, {OPTION_COMPRESS: "zlib"}, {OPTION_FEC: 4},
+                      {OPTION_CRC: "1", OPTION_DIGEST: DIGEST_MD5}]:
+            options = dict(extra, **{OPTION_SIZE: "1"})
+            with RDPSession(self.server.adr, options) as session:
+                for path, content in self.files.items():
+                    self.assertEqual(content, session.get(path))
+                    self.assertIsNotNone(session.connection.response_size)
+                    if not extra:
+                        self.assertEqual(len(content),
+                                         session.connection.response_size)
+
+                path = list(self.files)[-1]
+                self.assertEqual(self.files[path][100:300],
+                                 session.get(path, 100, 200))
+
+                missing = os.path.join(self.directory.name, "missing")
+                self.assertIsNone(session.get(missing))
+                self.assertIsNone(session.connection.response_size)
+
+    def test_parallel_download(self):
+        self.addCleanup(setattr, RDP_Client, "RANGE_PIECE_SIZE",
+                        RDP_Client.RANGE_PIECE_SIZE)
+        RDP_Client.RANGE_PIECE_SIZE = 1000
+        path = list(self.files)[-1]
+        result = os.path.join(self.directory.name, "result")
+        # The server serves the streams in turn, each range in 4 pieces
+        self.assertTrue(parallel_main(self.server.adr, path, result,
+                                      streams=3))
+        with open(result, "rb") as f:
+            self.assertEqual(self.files[path], f.read())
+
+    def test_fec_over_lossy_link(self):
+        with LossyProxy(self.server.adr, loss=0.05, seed=3) as proxy:
+            with RDPSession(proxy.adr, {OPTION_FEC: 4}) as session:
+                for path, content in self.files.items():
+                    self.assertEqual(content, session.get(path))
+                self.assertEqual("4", session.connection.options[OPTION_FEC])
+        self.assertGreater(proxy.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from a3.src import RDP_Compression
+from a3.src.RDP_Compression import CompressionCache
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual("zlib", RDP_Compression.negotiate("zlib"))
+        self.assertEqual("zlib", RDP_Compression.negotiate("bogus, zlib"))
+        self.assertIsNone(RDP_Compression.negotiate("bogus"))
+        self.assertIsNone(RDP_Compression.negotiate(""))
+
+    def test_incremental_round_trip(self):
+        data = b"<html>hello world</html>\n" * 500
+        for codec in RDP_Compression.SUPPORTED_CODECS:
+            compressed = RDP_Compression.compress(data, codec)
+            self.assertLess(len(compressed), len(data))
+
+            decompressor = RDP_Compression.create_decompressor(codec)
+            result = b""
+            for i in range(0, len(compressed), 100):
+                result += decompressor.decompress(compressed[i:i + 100])
+            result += decompressor.flush()
+            self.assertEqual(data, result)
+
+    def test_unsupported_codec(self):
+        self.assertRaises(ValueError, RDP_Compression.compress, b"", "bogus")
+
+
+class CompressionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self._write(b"first version " * 100)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _write(self, data, mtime_ns=None):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_hit_and_invalidation(self):
+        cache = CompressionCache()
+        first = cache.get(self.path, "zlib")
+        self.assertEqual(first, cache.get(self.path, "zlib"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        # A modified file is recompressed
+        self._write(b"second version " * 100, mtime_ns=10 ** 9)
+        second = cache.get(self.path, "zlib")
+        self.assertNotEqual(first, second)
+        self.assertEqual(2, cache.misses)
+
+    def test_eviction(self):
+        cache = CompressionCache(max_entries=1)
+        cache.get(self.path, "zlib")
+        cache._put(("other", "zlib"), (0, 0), b"x", b"")
+        cache.get(self.path, "zlib")
+        self.assertEqual(2, cache.misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
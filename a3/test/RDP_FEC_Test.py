@@ -0,0 +1,66 @@
+import unittest
+
+from a3.src.RDP_FEC import FECGroup, create_parity_message, negotiate
+from a3.src.RDP_Protocol import *
+
+
+def _group_messages(first_seq, payloads, flags=None):
+    """ The data messages of a group, followed by their parity message.
+    """
+    flags = flags or [0] * len(payloads)
+    messages = [create_app_message((first_seq + i) % MAX_SEQ_NUMBER, 9,
+                                   payload, flag)
+                for i, (payload, flag) in enumerate(zip(payloads, flags))]
+    parity_seq = (first_seq + len(payloads)) % MAX_SEQ_NUMBER
+    return messages + [create_parity_message(parity_seq, 9, messages)]
+
+
+class FECTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual(4, negotiate("4"))
+        self.assertEqual(16, negotiate("1000"))
+        self.assertIsNone(negotiate("0"))
+        self.assertIsNone(negotiate("x"))
+
+    def test_recovers_any_single_missing_message(self):
+        payloads = [b"200first", b"200", b"200a longer third payload"]
+        messages = _group_messages(253, payloads, [0, 0, FLAG_END_OF_RESPONSE])
+        for missing in range(len(payloads)):
+            group = FECGroup(253, 4)
+            for i, message in enumerate(messages):
+                self.assertFalse(group.is_complete())
+                if i != missing:
+                    group.add(message)
+
+            self.assertTrue(group.is_complete())
+            self.assertEqual(messages[:-1], group.messages())
+            self.assertEqual(messages[-1].seq_no, group.last_seq())
+
+    def test_complete_without_parity(self):
+        messages = _group_messages(10, [b"200a", b"200b"])
+        group = FECGroup(10, 2)
+        for message in reversed(messages[:-1]):
+            group.add(message)
+        self.assertTrue(group.is_complete())
+        self.assertEqual(messages[:-1], group.messages())
+        self.assertEqual(12, group.last_seq())
+
+    def test_short_group_needs_its_length(self):
+        messages = _group_messages(10, [b"200a", b"200b"])
+        group = FECGroup(10, 4)
+        group.add(messages[0])
+        group.add(messages[1])
+        self.assertFalse(group.is_complete())
+        group.add(messages[2])
+        self.assertTrue(group.is_complete())
+
+    def test_contains(self):
+        group = FECGroup(250, 8)
+        self.assertTrue(group.contains(250))
+        self.assertTrue(group.contains(3))  # The parity, after wrapping
+        self.assertFalse(group.contains(249))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from a3.src.RDP_FileIndex import FileIndex
+
+
+class FileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        os.mkdir(os.path.join(self.root, "sub"))
+        self._write("a", b"hello")
+        self._write("sub/b", b"world!")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, name, data, mtime_ns=None):
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def _read(self, entry):
+        with entry.open() as f:
+            f.seek(0)
+            return f.read()
+
+    def test_lookup(self):
+        index = FileIndex(self.root)
+        self.assertIsNone(index.lookup("a"))
+        self.assertEqual(2, index.refresh())
+        self.assertEqual(2, len(index))
+
+        entry = index.lookup("sub/b")
+        self.assertEqual(6, entry.size)
+        self.assertEqual(b"world!", self._read(entry))
+        self.assertIs(entry, index.lookup("/sub/./b"))
+        self.assertIs(entry, index.lookup("a/../sub/b"))
+
+        # Names cannot climb above the root
+        self.assertIs(index.lookup("a"), index.lookup("../a"))
+        self.assertIs(index.lookup("a"), index.lookup("sub/../../a"))
+
+        for name in ["", "sub", "missing", os.path.join(self.root, "a")]:
+            self.assertIsNone(index.lookup(name), name)
+
+    def test_symlinks_not_followed(self):
+        with tempfile.TemporaryDirectory() as outside:
+            with open(os.path.join(outside, "secret"), "wb") as f:
+                f.write(b"secret")
+            os.symlink(os.path.join(outside, "secret"),
+                       os.path.join(self.root, "link"))
+            os.symlink(outside, os.path.join(self.root, "linked_dir"))
+            index = FileIndex(self.root)
+            index.refresh()
+            self.assertIsNone(index.lookup("link"))
+            self.assertIsNone(index.lookup("linked_dir/secret"))
+
+    def test_incremental_refresh(self):
+        index = FileIndex(self.root, keep_open=True)
+        index.refresh()
+        a = index.lookup("a")
+        b = index.lookup("sub/b")
+        self.assertIsNotNone(a.fd)
+        self.assertEqual(0, index.refresh())
+
+        self._write("a", b"changed", mtime_ns=a.mtime_ns + 10 ** 9)
+        self._write("c", b"new")
+        os.remove(os.path.join(self.root, "sub", "b"))
+        self.assertEqual(3, index.refresh())
+
+        # Unchanged entries keep their open file, replaced ones are closed
+        self.assertIsNone(a.fd)
+        self.assertIsNone(b.fd)
+        self.assertIsNone(index.lookup("sub/b"))
+        self.assertEqual(b"changed", self._read(index.lookup("a")))
+        c = index.lookup("c")
+        self.assertEqual(b"new", self._read(c))
+        self.assertEqual(0, index.refresh())
+        self.assertIs(c, index.lookup("c"))
+
+        index.close()
+        self.assertIsNone(c.fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import socket
+import unittest
+
+from a3.src.RDP_Linger import Linger
+from a3.src.RDP_Protocol import *
+
+LOOPBACK_ADR = ("127.0.0.1", 0)
+
+
+class LingerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_sock.bind(LOOPBACK_ADR)
+        self.server_sock.settimeout(1)
+        self.linger = Linger(duration=0.3)
+
+    def tearDown(self):
+        self.server_sock.close()
+
+    def _linger_on_new_socket(self, fin_in, fin_out):
+        """ Hands a new client socket to the linger and closes the original.
+
+        :return: The client's address
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(LOOPBACK_ADR)
+            self.linger.add(sock, self.server_sock.getsockname(), fin_in,
+                            fin_out)
+            return sock.getsockname()
+
+    def test_repeats_reply_to_duplicate_fin(self):
+        fin_in = create_fin_message(7, 3)
+        fin_out = create_fin_message(4, 7)
+        client_adrs = [self._linger_on_new_socket(fin_in, fin_out)
+                       for _ in range(3)]
+        self.assertEqual(3, len(self.linger))
+
+        for client_adr in client_adrs:
+            # Anything other than the FIN answered is ignored
+            send_message(self.server_sock, create_ack_message(5, 1),
+                         client_adr)
+            send_message(self.server_sock, fin_in, client_adr)
+            reply = try_read_message(self.server_sock, 1)
+            self.assertEqual(fin_out, reply)
+
+    def test_expires(self):
+        fin_in = create_fin_message(7, 3)
+        client_adr = self._linger_on_new_socket(fin_in,
+                                                create_fin_message(4, 7))
+        self.assertTrue(self.linger.wait(2))
+        self.assertEqual(0, len(self.linger))
+
+        # The port has been released
+        send_message(self.server_sock, fin_in, client_adr)
+        self.assertRaises(OSError, try_read_message, self.server_sock, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
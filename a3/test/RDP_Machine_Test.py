@@ -0,0 +1,168 @@
+import unittest
+
+from a3.src.RDP_FEC import create_parity_message
+from a3.src.RDP_Machine import RESPONSE_IDLE_TIMEOUT, ResponseReceiver, \
+    Transmission
+from a3.src.RDP_Metrics import ConnectionMetrics
+from a3.src.RDP_Protocol import *
+
+SERVER_ADR = ("server", 1)
+CLIENT_ADR = ("client", 2)
+OTHER_ADR = ("other", 3)
+
+
+def _ack(ack_no, src_adr=CLIENT_ADR):
+    ack = create_ack_message(0, ack_no)
+    ack.src_adr = src_adr
+    return ack
+
+
+def _app(seq_no, payload=b"200data", flags=0):
+    message = create_app_message(seq_no, 9, payload, flags)
+    message.src_adr = SERVER_ADR
+    return message
+
+
+class TransmissionTest(unittest.TestCase):
+
+    def test_acked_first_time(self):
+        metrics = ConnectionMetrics()
+        messages = [create_app_message(4, 9, b"200a"),
+                    create_app_message(5, 9, b"200b")]
+        transmission = Transmission(messages, CLIENT_ADR, metrics)
+        transmission.start(10.0)
+        self.assertEqual([message_to_bytes(m) for m in messages],
+                         transmission.datagrams_to_send())
+        self.assertEqual([], transmission.datagrams_to_send())
+        self.assertEqual(10.0 + DEFAULT_ACK_TIMEOUT_SECONDS,
+                         transmission.deadline)
+
+        # Only an ACK of the last message, from the peer, completes it
+        self.assertFalse(transmission.receive_message(_ack(4), 10.1))
+        self.assertFalse(transmission.receive_message(_ack(5, OTHER_ADR),
+                                                      10.1))
+        self.assertTrue(transmission.receive_datagram(
+            message_to_bytes(_ack(5)), CLIENT_ADR, 10.2))
+        self.assertTrue(transmission.is_done())
+        self.assertEqual(5, transmission.ack.ack_no)
+        self.assertIsNone(transmission.deadline)
+        self.assertEqual(0, metrics.retransmissions)
+        self.assertEqual(1, metrics.rtt.count)
+
+    def test_retransmits_until_acked(self):
+        metrics = ConnectionMetrics()
+        transmission = Transmission([create_app_message(4, 9, b"200a")],
+                                    CLIENT_ADR, metrics)
+        transmission.start(0.0)
+        transmission.datagrams_to_send()
+
+        transmission.handle_timer(0.1)  # Not yet due
+        self.assertEqual([], transmission.datagrams_to_send())
+        transmission.handle_timer(transmission.deadline)
+        self.assertEqual(1, len(transmission.datagrams_to_send()))
+
+        transmission.receive_message(_ack(4), 0.7)
+        self.assertTrue(transmission.is_done())
+        self.assertEqual(2, transmission.attempts)
+        self.assertEqual(1, metrics.timeouts)
+        self.assertEqual(1, metrics.retransmissions)
+        self.assertEqual(0, metrics.rtt.count)  # Ambiguous sample
+
+    def test_fails_after_retries(self):
+        transmission = Transmission([create_app_message(4, 9, b"200a")],
+                                    CLIENT_ADR, retries=2)
+        transmission.start(0.0)
+        sent = 0
+        while not transmission.is_done():
+            sent += len(transmission.datagrams_to_send())
+            transmission.handle_timer(transmission.deadline)
+        self.assertTrue(transmission.failed)
+        self.assertIsNone(transmission.ack)
+        self.assertEqual(3, sent)
+
+    def test_deadline_follows_paced_send(self):
+        transmission = Transmission([create_app_message(4, 9, b"200a")],
+                                    CLIENT_ADR)
+        transmission.start(0.0)
+        transmission.sent(0.3)
+        self.assertEqual(0.3 + DEFAULT_ACK_TIMEOUT_SECONDS,
+                         transmission.deadline)
+
+
+class ResponseReceiverTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.connection = Connection(SERVER_ADR, 9, 20)
+
+    def _receiver(self, group_size=0):
+        if group_size:
+            self.connection.options[OPTION_FEC] = str(group_size)
+        return ResponseReceiver(self.connection, 0.0)
+
+    def _acks(self, receiver):
+        return [message_from_bytes(d).ack_no
+                for d in receiver.datagrams_to_send()]
+
+    def test_in_order(self):
+        receiver = self._receiver()
+        first, second = _app(10), _app(11, flags=FLAG_END_OF_RESPONSE)
+        self.assertEqual([first], receiver.receive_message(first, 0.1))
+        self.assertEqual([10], self._acks(receiver))
+
+        # A duplicate is re-ACKed but not delivered again
+        self.assertEqual([], receiver.receive_message(first, 0.2))
+        self.assertEqual([10], self._acks(receiver))
+
+        self.assertEqual([second], receiver.receive_message(second, 0.3))
+        self.assertEqual([11], self._acks(receiver))
+        self.assertEqual(11, self.connection.last_index_received)
+        self.assertFalse(receiver.failed)
+
+    def test_acks_any_status(self):
+        receiver = self._receiver()
+        message = _app(10, HTTP_BAD_REQUEST_ENCODED,
+                       flags=FLAG_END_OF_RESPONSE)
+        self.assertEqual([message], receiver.receive_message(message, 0.1))
+        self.assertEqual([10], self._acks(receiver))
+
+    def test_bad_sequence_number(self):
+        receiver = self._receiver()
+        self.assertEqual([], receiver.receive_message(_app(50), 0.1))
+        self.assertTrue(receiver.failed)
+        self.assertEqual([], receiver.datagrams_to_send())
+
+    def test_ignores_other_senders(self):
+        receiver = self._receiver()
+        message = _app(10)
+        message.src_adr = OTHER_ADR
+        self.assertEqual([], receiver.receive_message(message, 0.1))
+        self.assertEqual(9, self.connection.last_index_received)
+
+    def test_times_out_when_idle(self):
+        receiver = self._receiver()
+        receiver.receive_message(_app(10), 1.0)
+        receiver.handle_timer(1.0 + RESPONSE_IDLE_TIMEOUT / 2)
+        self.assertFalse(receiver.timed_out)
+        receiver.handle_timer(receiver.deadline)
+        self.assertTrue(receiver.timed_out)
+
+    def test_fec_group_with_lost_message(self):
+        receiver = self._receiver(group_size=3)
+        data = [_app(10, b"200a"), _app(11, b"200b"), _app(12, b"200c")]
+        parity = create_parity_message(13, 9, data)
+        parity.src_adr = SERVER_ADR
+
+        self.assertEqual([], receiver.receive_message(data[0], 0.1))
+        self.assertEqual([], receiver.receive_message(data[2], 0.1))
+        delivered = receiver.receive_message(parity, 0.1)
+        self.assertEqual([m.payload for m in data],
+                         [bytes(m.payload) for m in delivered])
+        self.assertEqual([13], self._acks(receiver))
+
+        # The group is re-ACKed if the server resends it
+        self.assertEqual([], receiver.receive_message(data[1], 0.2))
+        self.assertEqual([13], self._acks(receiver))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import unittest
+
+from a3.src.RDP_Metrics import *
+
+
+class FakeSocket:
+    def __init__(self):
+        self.packets_sent = 10
+        self.packets_received = 20
+        self.bytes_sent = 1000
+        self.bytes_received = 2000
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_observe_and_percentile(self):
+        histogram = Histogram([1, 2, 5])
+        self.assertIsNone(histogram.percentile(50))
+        for value in [0.5, 1.5, 1.5, 3, 10]:
+            histogram.observe(value)
+
+        self.assertEqual([1, 2, 1, 1], histogram.counts)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual(16.5, histogram.sum)
+        self.assertEqual(2, histogram.percentile(50))
+        self.assertEqual(float("inf"), histogram.percentile(99))
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = FakeSocket()
+        self.registry = MetricsRegistry()
+
+    def _connection(self):
+        metrics = ConnectionMetrics(self.sock)
+        self.sock.packets_sent += 3
+        self.sock.bytes_received += 6
+        metrics.retransmissions += 1
+        metrics.record_rtt(0.002)
+        metrics.record_handshake()
+        metrics.record_transfer(1000, 0.5)
+        return metrics
+
+    def test_record_connection(self):
+        self.registry.record_connection(self._connection())
+        self.registry.record_connection(self._connection(), abandoned=True)
+
+        counters = self.registry.snapshot()["counters"]
+        self.assertEqual(6, counters["packets_sent"])
+        self.assertEqual(12, counters["bytes_received"])
+        self.assertEqual(0, counters["packets_received"])
+        self.assertEqual(2, counters["retransmissions"])
+        self.assertEqual(2, counters["connections"])
+        self.assertEqual(1, counters["abandoned_connections"])
+        self.assertEqual(2, self.registry.rtt.count)
+        self.assertEqual(4000, self.registry.goodput.sum)
+
+    def test_foreign_datagrams(self):
+        metrics = ConnectionMetrics(self.sock)
+        self.sock.packets_received += 3
+        self.sock.bytes_received += 300
+        metrics.record_foreign_datagram(100)
+        metrics.finish()
+        self.assertEqual(2, metrics.packets_received)
+        self.assertEqual(200, metrics.bytes_received)
+
+    def test_merge_snapshot(self):
+        self.registry.record_connection(self._connection())
+        other = MetricsRegistry()
+        other.record_connection(self._connection(), abandoned=True)
+
+        self.registry.merge_snapshot(other.snapshot())
+        self.registry.merge_snapshot(json.loads(other.to_json()))
+        counters = self.registry.snapshot()["counters"]
+        self.assertEqual(3, counters["connections"])
+        self.assertEqual(2, counters["abandoned_connections"])
+        self.assertEqual(9, counters["packets_sent"])
+        self.assertEqual(3, self.registry.rtt.count)
+        self.assertEqual(other.rtt.counts[0] * 3, self.registry.rtt.counts[0])
+        self.assertEqual(6000, self.registry.goodput.sum)
+
+    def test_exports(self):
+        self.registry.record_connection(self._connection())
+
+        snapshot = json.loads(self.registry.to_json())
+        self.assertEqual(1, snapshot["counters"]["connections"])
+
+        text = self.registry.to_prometheus()
+        self.assertIn("rdp_connections_total 1\n", text)
+        self.assertIn('rdp_rtt_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn("rdp_rtt_seconds_count 1\n", text)
+
+    def test_dumper(self):
+        self.registry.record_connection(self._connection())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            MetricsDumper(self.registry, path).dump()
+            with open(path) as f:
+                self.assertEqual(1, json.load(f)["counters"]["connections"])
+
+        self.assertRaises(ValueError, MetricsDumper, self.registry, path,
+                          fmt="xml")
+
+
+if __name__ == '__main__':
+    unittest.main()
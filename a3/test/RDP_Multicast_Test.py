@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+import unittest
+
+from a3.src.RDP_Multicast import MAX_CHUNK_SIZE, Distributor, \
+    MulticastReceiver, missing_ranges
+
+GROUP = "239.255.42.99"
+LOOPBACK = "127.0.0.1"
+
+
+class _CorruptingDistributor(Distributor):
+    """ Flips a bit in the first DATA packet it sends.
+    """
+    corrupted = False
+
+    def _send(self, datagrams):
+        if not self.corrupted:
+            self.corrupted = True
+            first = bytearray(datagrams[0])
+            first[-1] ^= 1
+            datagrams = [bytes(first)] + datagrams[1:]
+        super()._send(datagrams)
+
+
+class MissingRangesTest(unittest.TestCase):
+
+    def test_missing_ranges(self):
+        self.assertEqual([], missing_ranges({0, 1, 2}, 3))
+        self.assertEqual([(0, 3)], missing_ranges(set(), 3))
+        self.assertEqual([(0, 1), (3, 5), (6, 7)],
+                         missing_ranges({1, 2, 5}, 7))
+
+
+class DistributionTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = os.urandom(200 * MAX_CHUNK_SIZE + 123)
+        self.count = 201
+        self.receivers = []
+
+    def tearDown(self) -> None:
+        for receiver in self.receivers:
+            receiver.close()
+
+    def _distribute(self, distributor):
+        results = [None] * len(self.receivers)
+
+        def receive(i):
+            results[i] = self.receivers[i].receive(timeout=5)
+
+        threads = [threading.Thread(target=receive, args=(i,))
+                   for i in range(len(self.receivers))]
+        for thread in threads:
+            thread.start()
+        with distributor:
+            self.assertTrue(distributor.distribute(self.data))
+        for thread in threads:
+            thread.join()
+        for result in results:
+            self.assertEqual(self.data, result)
+
+    def _join_group(self, count, loss):
+        port = 0
+        try:
+            for i in range(count):
+                receiver = MulticastReceiver((GROUP, port), LOOPBACK, loss,
+                                             seed=i)
+                self.receivers.append(receiver)
+                port = receiver.adr[1]
+        except OSError as e:
+            self.skipTest("No multicast on loopback: {}".format(e))
+        return GROUP, port
+
+    def test_multicast_with_loss(self):
+        group = self._join_group(3, loss=0.05)
+        distributor = Distributor([group], LOOPBACK, receivers=3,
+                                  pacing=20e6, feedback_window=0.1)
+        self._distribute(distributor)
+
+        self.assertEqual({r.adr[1] for r in self.receivers},
+                         {group[1]})
+        self.assertTrue(all(r.dropped for r in self.receivers))
+        self.assertGreater(distributor.naks_received, 0)
+        # Repairs of one receiver's losses also repair the others', so the
+        # whole distribution is sent well under once per receiver
+        self.assertGreater(distributor.repairs_sent, 0)
+        self.assertLess(distributor.repairs_sent, self.count)
+        self.assertLess(distributor.packets_sent, 2 * self.count)
+
+    def test_unicast_receivers(self):
+        for _ in range(2):
+            self.receivers.append(MulticastReceiver((LOOPBACK, 0)))
+        distributor = Distributor([r.adr for r in self.receivers], LOOPBACK,
+                                  receivers=2, pacing=20e6,
+                                  feedback_window=0.1)
+        self._distribute(distributor)
+        self.assertEqual(0, distributor.repairs_sent)
+        self.assertEqual(1, distributor.rounds)
+        self.assertEqual(2 * (self.count + 1), distributor.packets_sent)
+        self.assertEqual({(r.adr, r.id) for r in self.receivers},
+                         distributor.done)
+
+    def test_corrupt_packet(self):
+        self.receivers.append(MulticastReceiver((LOOPBACK, 0)))
+        distributor = _CorruptingDistributor([self.receivers[0].adr],
+                                             LOOPBACK, receivers=1,
+                                             pacing=20e6, feedback_window=0.1)
+        self._distribute(distributor)
+        # The receiver cannot tell which packet was corrupt, so asks for all
+        # of them again, and is only DONE once they match the digest
+        self.assertEqual(1, distributor.naks_received)
+        self.assertEqual(self.count, distributor.repairs_sent)
+        self.assertEqual(2, distributor.rounds)
+        self.assertEqual({(r.adr, r.id) for r in self.receivers},
+                         distributor.done)
+
+    def test_without_expected_receivers(self):
+        self.receivers.append(MulticastReceiver((LOOPBACK, 0)))
+        distributor = Distributor([self.receivers[0].adr], LOOPBACK,
+                                  quiet_rounds=2, feedback_window=0.05)
+        self.data = b""
+        self._distribute(distributor)
+        self.assertEqual(2, distributor.rounds)
+
+    def test_receiver_times_out(self):
+        receiver = MulticastReceiver((LOOPBACK, 0))
+        self.receivers.append(receiver)
+        self.assertIsNone(receiver.receive(timeout=0.05))
+        # A distribution to someone else is not mistaken for one
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"x", receiver.adr)
+        self.assertIsNone(receiver.receive(timeout=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
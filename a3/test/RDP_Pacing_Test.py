@@ -0,0 +1,120 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from a3.src.RDP_Client import RDPSession
+from a3.src.RDP_Pacing import *
+from a3.src.RDP_Protocol import OPTION_FEC
+from a3.src.RDP_Server import Server
+
+LOOPBACK_ADR = ("127.0.0.1", 0)
+TIMEOUT = 5
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_reserve(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, burst=500, clock=clock)
+        self.assertEqual(0, bucket.reserve(500))
+        self.assertAlmostEqual(0.1, bucket.reserve(100))
+        self.assertAlmostEqual(0.3, bucket.reserve(200))
+
+        # Debt is repaid, and tokens accumulate up to the burst size
+        clock.now += 10
+        self.assertEqual(0, bucket.reserve(500))
+        self.assertAlmostEqual(0.001, bucket.reserve(1))
+
+
+class PacerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _send_train(self, pacer, packets, size):
+        pacer.start_train()
+        for _ in range(packets):
+            self.clock.sleep(pacer.reserve(size))
+            pacer.sent(size)
+
+    def test_fixed_rate(self):
+        pacer = Pacer(10000, burst=1000, clock=self.clock)
+        self._send_train(pacer, 11, 1000)
+        self.assertAlmostEqual(1.0, self.clock.now - 100)
+        self.assertAlmostEqual(10000, pacer.achieved_rate())
+
+        # A fixed rate ignores round trip times
+        pacer.update(5000, 0.01)
+        self.assertEqual(10000, pacer.target_rate())
+
+    def test_derived_rate(self):
+        pacer = Pacer(clock=self.clock, gain=2)
+        self.assertIsNone(pacer.target_rate())
+        self._send_train(pacer, 5, 1000)
+        self.assertEqual(100, self.clock.now)  # Not paced yet
+
+        pacer.update(4000, 0.1)
+        self.assertAlmostEqual(80000, pacer.target_rate())
+        pacer.update(4000, 0.9)
+        self.assertAlmostEqual(0.2, pacer.srtt)
+        self.assertAlmostEqual(40000, pacer.target_rate())
+
+    def test_create_pacer(self):
+        self.assertIsNone(create_pacer(None))
+        self.assertIsNone(create_pacer(AUTO).target_rate())
+        self.assertEqual(2e6, create_pacer(parse_setting("2M")).target_rate())
+        self.assertEqual(AUTO, parse_setting("auto"))
+        self.assertEqual(1500, parse_setting("1.5k"))
+
+
+class PacedTransferTest(unittest.TestCase):
+
+    def test_paced_fec_transfer(self):
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        rate = 200000
+        server = Server(LOOPBACK_ADR, pacing=rate)
+        ready = threading.Event()
+        thread = threading.Thread(target=server.serve, args=(ready,),
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, TIMEOUT)
+        self.addCleanup(server.stop)
+        self.assertTrue(ready.wait(TIMEOUT))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "file")
+            data = os.urandom(20000)
+            with open(path, "wb") as f:
+                f.write(data)
+
+            with RDPSession(server.adr, {OPTION_FEC: 8}) as session:
+                start = time.monotonic()
+                self.assertEqual(data, session.get(path))
+                elapsed = time.monotonic() - start
+                pacer = server.pacer
+
+        # At least the bytes after the burst of each group are paced
+        self.assertGreater(elapsed, 0.05)
+        self.assertEqual(rate, pacer.target_rate())
+        self.assertLess(pacer.achieved_rate(), rate * 1.1)
+        self.assertGreater(pacer.waited_seconds, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
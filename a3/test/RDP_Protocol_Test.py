@@ -1,10 +1,9 @@
 import os
-import queue
 import random
-import threading
 import unittest
 
 from a3.src.RDP_Protocol import *
+from a3.src.RDP_SimNet import SimNetwork
 
 LOOPBACK_IP = '127.0.0.1'
 TEST_PORT = 56565
@@ -58,11 +57,14 @@ def _get_msg_pair():
 
 class ProtocolTest(unittest.TestCase):
     def setUp(self) -> None:
-        self.loopback_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.loopback_sock.bind(LOOPBACK_ADR)
+        # Timeouts pass in virtual time, so they cost nothing
+        self.network = SimNetwork()
+        self.network.attach()
+        self.loopback_sock = self.network.bound_socket(LOOPBACK_ADR)
 
     def tearDown(self) -> None:
         self.loopback_sock.close()
+        self.network.close()
 
     def test_message_to_from_bytes(self):
         # This is a sanity check
@@ -70,6 +72,7 @@ class ProtocolTest(unittest.TestCase):
         bin_msg = message_to_bytes(msg)
         converted_msg = message_from_bytes(bin_msg)
         self.assertEqual(msg, converted_msg)
+        self.assertEqual(len(bin_msg), converted_msg.size)
 
     def test_message_to_bytes(self):
         message, binary_message = _get_msg_pair()
@@ -79,6 +82,50 @@ class ProtocolTest(unittest.TestCase):
         message, binary_message = _get_msg_pair()
         self.assertEqual(message, message_from_bytes(binary_message))
 
+    def test_flags(self):
+        message = create_app_message(1, 2, b"x", FLAG_END_OF_RESPONSE)
+        binary_message = message_to_bytes(message)
+        self.assertEqual(FLAG_END_OF_RESPONSE, binary_message[1])
+
+        result = message_from_bytes(binary_message)
+        self.assertTrue(result.is_end_of_response())
+        self.assertFalse(create_app_message(1, 2, b"x").is_end_of_response())
+
+    def test_encode_decode_options(self):
+        options = {"compress": "lz4,zlib", "other": "a=b"}
+        encoded = encode_options(options)
+        self.assertEqual(options, decode_options(encoded))
+        self.assertEqual({}, decode_options(b""))
+
+        syn = message_from_bytes(message_to_bytes(
+            create_syn_message(1, options=options)))
+        self.assertEqual(options, decode_options(syn.payload))
+
+    def test_syn_payload(self):
+        options = {"persist": "1"}
+        request = encode_request("a.txt", {REQUEST_OFFSET: 10})
+        for syn_options in [options, {}]:
+            syn = message_from_bytes(message_to_bytes(create_syn_message(
+                1, options=syn_options, request=request)))
+            self.assertEqual((syn_options, request),
+                             decode_syn_payload(syn.payload))
+
+        syn = create_syn_message(1, options=options)
+        self.assertEqual((options, None), decode_syn_payload(syn.payload))
+
+    def test_encode_decode_request(self):
+        self.assertEqual(b"a.txt", encode_request("a.txt"))
+        self.assertEqual(("a.txt", {}), decode_request(b"a.txt"))
+
+        payload = encode_request("a.txt", {REQUEST_OFFSET: 10})
+        filename, fields = decode_request(payload)
+        self.assertEqual("a.txt", filename)
+        self.assertEqual((10, None), get_request_range(fields))
+
+        self.assertEqual((0, None), get_request_range({}))
+        self.assertRaises(ValueError, get_request_range, {REQUEST_OFFSET: "-1"})
+        self.assertRaises(ValueError, get_request_range, {REQUEST_LENGTH: "z"})
+
     def test_send_message_via_socket_sanity_check(self):
         seq = 10
         ack = 20
@@ -126,6 +173,26 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(message1, result1)
         self.assertEqual(message2, result2)
 
+    def test_crc(self):
+        message = create_app_message(3, 4, b"200data", FLAG_CRC)
+        binary_message = message_to_bytes(message)
+        self.assertEqual(HEADER_SIZE + CRC_SIZE + 7, len(binary_message))
+        self.assertEqual(message, message_from_bytes(binary_message))
+
+        corrupt = bytearray(binary_message)
+        corrupt[-1] ^= 0x01
+        self.assertRaises(ChecksumError, message_from_bytes, corrupt)
+
+        # Corrupt packets are dropped as if lost
+        self.loopback_sock.sendto(corrupt, LOOPBACK_ADR)
+        send_message(self.loopback_sock, message, LOOPBACK_ADR)
+        self.assertEqual(message,
+                         try_read_message(self.loopback_sock, TEST_TIMEOUT))
+
+        self.loopback_sock.sendto(corrupt, LOOPBACK_ADR)
+        self.assertRaises(socket.timeout, try_read_message, self.loopback_sock,
+                          0.1)
+
     def test_try_receive_ack(self):
         connection = Connection(LOOPBACK_ADR,
                                 get_rand_seq_no(),
@@ -174,34 +241,14 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(ack, result)
 
         # None should be returned if no ack is received before the timeout
-        class Worker(threading.Thread):
-            """ A worker thread that sleeps for a timeout and calls
-            """
-            def __init__(self, q, msg, sock, adr, wait_time):
-                super().__init__()
-                self.q = q
-                self.msg = msg
-                self.sock = sock
-                self.adr = adr
-                self.wait_time = wait_time
-
-            def run(self):
-                result = await_ack(self.msg,
-                                   self.sock,
-                                   self.adr,
-                                   self.wait_time)
-                q.put(result, block=False)
-
         send_message(self.loopback_sock, non_ack, LOOPBACK_ADR)
 
-        q = queue.Queue()
+        start = self.network.now
         await_time = TEST_TIMEOUT / 10
-        worker = Worker(q, msg_out, self.loopback_sock, LOOPBACK_ADR, await_time)
-        worker.start()
-        worker.join(TEST_TIMEOUT / 2)
-
-        result = q.get(block=False)
+        result = await_ack(msg_out, self.loopback_sock, LOOPBACK_ADR,
+                           await_time)
         self.assertIsNone(result)
+        self.assertAlmostEqual(await_time, self.network.now - start)
 
 
 class ConnectionTest(unittest.TestCase):
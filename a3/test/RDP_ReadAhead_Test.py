@@ -0,0 +1,102 @@
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+import unittest
+
+from a3.src.RDP_ReadAhead import ReadAhead
+
+
+class _CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ Records the most reads submitted but not yet consumed at once.
+    """
+
+    def __init__(self):
+        super().__init__(2)
+        self.submitted = 0
+        self.most_ahead = 0
+        self.consumed = 0
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        self.most_ahead = max(self.most_ahead, self.submitted - self.consumed)
+        return super().submit(fn, *args)
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.executor = _CountingExecutor()
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = bytes(range(256)) * 20
+        self.path = os.path.join(self.directory.name, "file")
+        with open(self.path, "wb") as file:
+            file.write(self.data)
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+        self.directory.cleanup()
+
+    def _read(self, *args, **kwargs):
+        reader = ReadAhead(self.executor, self.path, *args, **kwargs)
+        chunks = []
+        for chunk in reader:
+            chunks.append(chunk)
+            self.executor.consumed += 1
+        return reader, chunks
+
+    def test_ranges(self):
+        cases = [(0, None), (100, None), (100, 2000), (5000, 10), (0, 0),
+                 (len(self.data) + 5, None)]
+        for offset, length in cases:
+            reader, chunks = self._read(1000, offset, length)
+            end = None if length is None else offset + length
+            expected = self.data[offset:end]
+            self.assertEqual(expected, b"".join(chunks))
+            self.assertEqual(len(expected), reader.size)
+            self.assertTrue(chunks)
+            self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+
+    def test_first_chunk_prefix_and_hash(self):
+        content_hash = hashlib.md5()
+        _, chunks = self._read(1000, first_chunk_size=992, prefix=b"200",
+                               content_hash=content_hash)
+        self.assertEqual(3 + 992, len(chunks[0]))
+        self.assertTrue(all(chunk.startswith(b"200") for chunk in chunks))
+        self.assertEqual(self.data, b"".join(chunk[3:] for chunk in chunks))
+        self.assertEqual(hashlib.md5(self.data).digest(),
+                         content_hash.digest())
+
+    def test_reads_at_most_depth_ahead(self):
+        _, chunks = self._read(100, depth=3)
+        self.assertEqual(len(chunks), self.executor.submitted)
+        self.assertEqual(3, self.executor.most_ahead)
+
+    def test_truncated_file(self):
+        reader = ReadAhead(self.executor, self.path, 1000, depth=1)
+        chunks = iter(reader)
+        first = next(chunks)
+        os.truncate(self.path, 1500)
+        self.assertEqual(self.data[:1500], first + b"".join(chunks))
+
+    def test_close(self):
+        reader = ReadAhead(self.executor, self.path, 100)
+        chunks = iter(reader)
+        next(chunks)
+        fd = reader.fd
+        reader.close()
+        self.assertIsNone(reader.fd)
+        self.assertRaises(OSError, os.fstat, fd)
+
+        # A descriptor given to the reader stays open
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            reader = ReadAhead(self.executor, None, 1000, fd=fd)
+            self.assertEqual(self.data, b"".join(reader))
+            os.fstat(fd)
+        finally:
+            os.close(fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
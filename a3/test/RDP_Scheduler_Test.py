@@ -0,0 +1,103 @@
+import unittest
+
+from a3.src.RDP_Scheduler import *
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _drain(scheduler, clock=None, step=0.0):
+    order = []
+    while len(scheduler):
+        if clock:
+            clock.now += step
+        order.append(scheduler.next())
+    return order
+
+
+class SendSchedulerTest(unittest.TestCase):
+
+    def _scheduler(self, policy, clock=None, **flows):
+        """ Adds a flow for each keyword, queueing sends of the sizes given.
+        """
+        scheduler = SendScheduler(policy, quantum=100,
+                                  clock=clock or _Clock())
+        for key, sizes in flows.items():
+            scheduler.add_flow(key)
+            for i, size in enumerate(sizes):
+                scheduler.enqueue(key, "{}{}".format(key, i), size)
+        return scheduler
+
+    def test_fifo(self):
+        scheduler = self._scheduler(POLICY_FIFO, a=[100] * 3, b=[100])
+        self.assertEqual(["a0", "a1", "a2", "b0"],
+                         [item for _, item in _drain(scheduler)])
+        self.assertIsNone(scheduler.next())
+
+    def test_drr_alternates(self):
+        scheduler = self._scheduler(POLICY_DRR, a=[100] * 3, b=[100] * 2)
+        self.assertEqual(["a0", "b0", "a1", "b1", "a2"],
+                         [item for _, item in _drain(scheduler)])
+
+    def test_drr_shares_bytes_by_weight(self):
+        scheduler = SendScheduler(POLICY_DRR, quantum=100, clock=_Clock())
+        scheduler.add_flow("light")
+        scheduler.add_flow("heavy", weight=3)
+        for i in range(40):
+            scheduler.enqueue("light", i, 100)
+            # Sends larger than the quantum take several turns of credit
+            scheduler.enqueue("heavy", i, 150)
+        sent = {"light": 0, "heavy": 0}
+        for _ in range(30):
+            key, _ = scheduler.next()
+            sent[key] += 100 if key == "light" else 150
+        self.assertAlmostEqual(3, sent["heavy"] / sent["light"], delta=0.3)
+
+    def test_srf(self):
+        scheduler = self._scheduler(POLICY_SRF, large=[100] * 3,
+                                    small=[100])
+        scheduler.add_flow("declared", remaining=150)
+        scheduler.enqueue("declared", "declared0", 100)
+        self.assertEqual(["small0", "declared0", "large0", "large1",
+                          "large2"],
+                         [item for _, item in _drain(scheduler)])
+
+    def test_remove_flow(self):
+        for policy in POLICIES:
+            scheduler = self._scheduler(policy, a=[100] * 2, b=[100] * 2)
+            scheduler.next()
+            scheduler.remove_flow("a")
+            self.assertEqual(["b"] * 2,
+                             [key for key, _ in _drain(scheduler)], policy)
+            # The key can be reused
+            scheduler.add_flow("a")
+            scheduler.enqueue("a", "again", 100)
+            self.assertEqual(("a", "again"), scheduler.next())
+
+    def test_queueing_delay(self):
+        clock = _Clock()
+        scheduler = SendScheduler(clock=clock)
+        flow = scheduler.add_flow("a")
+        for i in range(3):
+            scheduler.enqueue("a", i, 10)
+        _drain(scheduler, clock, step=0.002)
+        self.assertEqual(3, flow.queueing_delay.count)
+        self.assertAlmostEqual(0.002 + 0.004 + 0.006,
+                               flow.queueing_delay.sum)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SendScheduler, "lifo")
+        scheduler = SendScheduler()
+        self.assertRaises(ValueError, scheduler.add_flow, "a", weight=0)
+        scheduler.add_flow("a")
+        self.assertRaises(ValueError, scheduler.add_flow, "a")
+
+
+if __name__ == '__main__':
+    unittest.main()
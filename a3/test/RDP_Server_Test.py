@@ -1,8 +1,16 @@
+import concurrent.futures
+import hashlib
 import os
+import tempfile
+import threading
 import unittest
 from socket import *
 
+from a3.src.RDP_Capture import read_capture
+from a3.src.RDP_Client import RDPSession
+from a3.src.RDP_FileIndex import FileIndex
 from a3.src.RDP_Protocol import *
+from a3.src.RDP_ReadAhead import ReadAhead
 from a3.src.RDP_Server import Server
 
 LOOPBACK = "127.0.0.1"
@@ -44,6 +52,170 @@ class ServerTest(unittest.TestCase):
                 if os.path.exists(filename):
                     os.remove(filename)
 
+    def test_get_data_from_file_range(self):
+        data = bytes(range(256)) * 20
+        filename = str(time.time()) + ".bin"
+        try:
+            with open(filename, 'wb') as file:
+                file.write(data)
+
+            cases = [(0, None), (100, None), (100, 2000), (5000, 10), (0, 0),
+                     (len(data) + 5, None)]
+            for offset, length in cases:
+                result = Server._get_data_from_file(filename, 1000,
+                                                    offset, length)
+                end = None if length is None else offset + length
+                self.assertEqual(data[offset:end], b"".join(result))
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_get_response_bad_range(self):
+        self.server.conn = Connection(SOCKET_ADDRESS, 0)
+        response, digest = self.server._get_response(__file__,
+                                                     {REQUEST_OFFSET: "x"})
+        self.assertEqual([HTTP_BAD_REQUEST_ENCODED], response)
+        self.assertIsNone(digest)
+
+    def test_get_response_from_file_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            data = bytes(range(256)) * 10
+            os.mkdir(os.path.join(directory, "sub"))
+            with open(os.path.join(directory, "sub", "file"), 'wb') as file:
+                file.write(data)
+            self.server.file_index = FileIndex(directory)
+            self.server.file_index.refresh()
+            self.server.conn = Connection(SOCKET_ADDRESS, 0)
+
+            for name in ["sub/file", "/sub/file", "sub/../sub/file"]:
+                response, _ = self.server._get_response(name, {}, reserve=8)
+                self.assertEqual(MAX_PAYLOAD_SIZE - 8, len(response[0]))
+                self.assertEqual(data, b"".join(payload[HTTP_CODE_LEN:]
+                                                for payload in response))
+
+            response, _ = self.server._get_response(
+                "sub/file", {REQUEST_METHOD: METHOD_HEAD})
+            self.assertEqual([HTTP_OK_ENCODED + str(len(data)).encode()],
+                             response)
+
+            for name in ["missing", "sub", "../" + os.path.basename(__file__),
+                         __file__]:
+                response, _ = self.server._get_response(name, {})
+                self.assertEqual([HTTP_FILE_NOT_FOUND_ENCODED], response)
+
+    def test_get_response_read_ahead(self):
+        data = bytes(range(256)) * 10
+        filename = str(time.time()) + ".bin"
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            with open(filename, 'wb') as file:
+                file.write(data)
+            self.server._disk_pool = executor
+            self.server.conn = Connection(SOCKET_ADDRESS, 0)
+            self.server.conn.options[OPTION_DIGEST] = DIGEST_MD5
+
+            response, digest = self.server._get_response(
+                filename, {REQUEST_OFFSET: "10"}, reserve=8)
+            self.assertIsInstance(response, ReadAhead)
+            self.assertEqual(len(data) - 10, response.size)
+            payloads = list(response)
+            self.assertEqual(MAX_PAYLOAD_SIZE - 8, len(payloads[0]))
+            self.assertEqual(data[10:], b"".join(payload[HTTP_CODE_LEN:]
+                                                 for payload in payloads))
+            self.assertEqual(hashlib.md5(data[10:]).digest(), digest())
+        finally:
+            executor.shutdown()
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _temporary_directory(self):
+        """ A directory removed at the end of the test, once any server has
+        stopped.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return directory.name
+
+    def _serve(self, server):
+        """ Serves on a thread until the end of the test.
+        """
+        ready = threading.Event()
+        thread = threading.Thread(target=server.serve, args=(ready,),
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, TIMEOUT)
+        self.addCleanup(server.stop)
+        self.assertTrue(ready.wait(TIMEOUT))
+
+    def test_serve_over_unix_socket(self):
+        directory = self._temporary_directory()
+        data = os.urandom(200000)
+        with open(os.path.join(directory, "file"), 'wb') as file:
+            file.write(data)
+        server = Server(os.path.join(directory, "rdp.sock"),
+                        file_index=FileIndex(directory))
+        self._serve(server)
+
+        options = {OPTION_SIZE: "1", OPTION_DIGEST: DIGEST_MD5}
+        with RDPSession(server.adr, options) as session:
+            self.assertGreater(packet_size_of(session.sock), MAX_PACKET_SIZE)
+            self.assertEqual(data, session.get("file"))
+            self.assertEqual(data[:5], session.get("file", 0, 5))
+
+    def test_serve_from_file_index(self):
+        directory = self._temporary_directory()
+        data = os.urandom(3000)
+        with open(os.path.join(directory, "file"), 'wb') as file:
+            file.write(data)
+        server = Server(SOCKET_ADDRESS, file_index=FileIndex(directory))
+        self._serve(server)
+
+        with RDPSession(server.adr, {OPTION_SIZE: "1"}) as session:
+            self.assertEqual(data, session.get("/file"))
+            self.assertIsNone(session.get(os.path.join(directory, "file")))
+
+    def test_stop(self):
+        server = Server(SOCKET_ADDRESS)
+        ready = threading.Event()
+        thread = threading.Thread(target=server.serve, args=(ready,),
+                                  daemon=True)
+        thread.start()
+        self.assertTrue(ready.wait(TIMEOUT))
+        server.stop()
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(server.sock)
+
+    def test_capture_requests(self):
+        directory = self._temporary_directory()
+        data = os.urandom(3000)
+        with open(os.path.join(directory, "file"), 'wb') as file:
+            file.write(data)
+        capture = os.path.join(directory, "capture.jsonl")
+        server = Server(SOCKET_ADDRESS, file_index=FileIndex(directory))
+        server.capture_requests(capture)
+        self._serve(server)
+
+        with RDPSession(server.adr) as session:
+            self.assertEqual(data, session.get("file"))
+            self.assertEqual(data[10:15], session.get("file", 10, 5))
+            self.assertEqual(b"3000", session.request(
+                "file", {REQUEST_METHOD: METHOD_HEAD}))
+            self.assertIsNone(session.get("missing"))
+
+        requests = read_capture(capture)
+        self.assertEqual(4, server.capture.requests)
+        self.assertEqual(["file"] * 3 + ["missing"],
+                         [r["filename"] for r in requests])
+        self.assertEqual([200, 200, 200, 404],
+                         [r["status"] for r in requests])
+        self.assertEqual([3000, 5], [r["bytes"] for r in requests[:2]])
+        self.assertEqual({REQUEST_OFFSET: "10", REQUEST_LENGTH: "5"},
+                         requests[1]["fields"])
+        self.assertTrue(all(r["completed"] for r in requests))
+        self.assertFalse(any(r["compressed"] for r in requests))
+        self.assertEqual(sorted(r["time"] for r in requests),
+                         [r["time"] for r in requests])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,155 @@
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+from a3.src.RDP_Client import RDPSession, connect_to_server, \
+    get_from_server
+from a3.src.RDP_Protocol import *
+from a3.src.RDP_Server import CONNECTION_TIMEOUT, Server
+from a3.src.RDP_SimNet import *
+
+SERVER_ADR = (SIM_IP, 5000)
+
+
+class SimNetworkTest(unittest.TestCase):
+
+    def test_delay_and_timeout(self):
+        with SimNetwork(delay=0.25) as network:
+            a = network.bound_socket()
+            b = network.bound_socket()
+            a.sendto(b"one", b.getsockname())
+            a.sendto(b"two", b.getsockname())
+
+            b.settimeout(0.1)
+            self.assertRaises(socket.timeout, b.recvfrom, 100)
+            self.assertAlmostEqual(0.1, network.now)
+
+            b.settimeout(None)
+            self.assertEqual((b"one", a.getsockname()), b.recvfrom(100))
+            self.assertEqual((b"two", a.getsockname()), b.recvfrom(100))
+            self.assertAlmostEqual(0.25, network.now)
+
+    def test_retries_take_no_real_time(self):
+        with SimNetwork() as network:
+            sock = network.bound_socket()
+            start = time.monotonic()
+            ack = send_until_ack_in(create_syn_message(1), sock, SERVER_ADR)
+            self.assertIsNone(ack)
+            self.assertAlmostEqual(
+                (DEFAULT_RETRY_THRESHOLD + 1) * DEFAULT_ACK_TIMEOUT_SECONDS,
+                network.now)
+            self.assertEqual(DEFAULT_RETRY_THRESHOLD + 1, network.sent)
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_unattached_thread(self):
+        network = SimNetwork()
+        sock = network.bound_socket()
+        sock.settimeout(1)
+        self.assertRaises(RuntimeError, sock.recvfrom, 100)
+
+
+class SimulatedTransferTest(unittest.TestCase):
+    """ End to end transfers between a `Server` and an `RDPSession` over lossy
+    simulated networks.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.log_level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.WARNING)
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.files = {}
+        for size in [0, 1500, 6000]:
+            path = os.path.join(cls.directory.name, str(size))
+            cls.files[path] = os.urandom(size)
+            with open(path, "wb") as f:
+                f.write(cls.files[path])
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger().setLevel(cls.log_level)
+        cls.directory.cleanup()
+
+    def _run(self, seed, options, loss):
+        with SimNetwork(seed, loss, delay=0.01, jitter=0.005) as network:
+            server = Server(None, sock=network.bound_socket(SERVER_ADR))
+            network.spawn(server.serve)
+            with RDPSession(SERVER_ADR, options,
+                            sock=network.bound_socket()) as session:
+                for path, content in self.files.items():
+                    self.assertEqual(content, session.get(path),
+                                     "seed {} options {}".format(seed,
+                                                                 options))
+            return network
+
+    def test_lossy_scenarios(self):
+        option_sets = [{}, {OPTION_FEC: 4},
+                       {OPTION_COMPRESS: "zlib", OPTION_CRC: "1",
+                        OPTION_DIGEST: DIGEST_MD5}]
+        start = time.monotonic()
+        simulated = 0
+        for seed in range(50):
+            for options in option_sets:
+                network = self._run(seed, options, loss=0.1)
+                simulated += network.now
+        # Far more simulated time than real time passes
+        self.assertGreater(simulated, 10 * (time.monotonic() - start))
+
+    def test_fast_open_on_lossless_network(self):
+        with SimNetwork(delay=0.05) as network:
+            server = Server(None, sock=network.bound_socket(SERVER_ADR))
+            network.spawn(server.serve)
+            path = list(self.files)[-1]
+            with RDPSession(SERVER_ADR, fast_open=True,
+                            sock=network.bound_socket()) as session:
+                self.assertEqual(self.files[path], session.get(path))
+                # The first of the 6 APP messages answers the SYN carrying the
+                # request, and each is then one round trip
+                self.assertAlmostEqual(0.1 * 6, network.now)
+
+    def test_persistent_connection_outlives_slow_response(self):
+        data = os.urandom(40000)
+        path = os.path.join(self.directory.name, "slow")
+        with open(path, "wb") as f:
+            f.write(data)
+        with SimNetwork(delay=0.05) as network:
+            server = Server(None, sock=network.bound_socket(SERVER_ADR))
+            network.spawn(server.serve)
+            with RDPSession(SERVER_ADR, sock=network.bound_socket()) \
+                    as session:
+                durations = []
+                for _ in range(2):
+                    start = network.now
+                    self.assertEqual(data, session.get(path))
+                    durations.append(network.now - start)
+            # Each response takes a round trip per message, longer than the
+            # idle timeout, and the connection is kept open throughout: the
+            # second request needs no retries (nor a handshake)
+            self.assertGreater(durations[0], CONNECTION_TIMEOUT)
+            self.assertLess(durations[1], durations[0])
+            self.assertEqual(
+                0, server.metrics.counters["abandoned_connections"])
+
+    def test_failed_request_closes_connection(self):
+        path = list(self.files)[-1]
+        missing = os.path.join(self.directory.name, "missing")
+        # A missing file is answered 404, a malformed range 400
+        for filename, offset in [(missing, 0), (path, -1)]:
+            with SimNetwork(delay=0.01) as network:
+                server = Server(None, sock=network.bound_socket(SERVER_ADR))
+                network.spawn(server.serve)
+                connection = connect_to_server(SERVER_ADR,
+                                               network.bound_socket())
+                self.assertIsNone(get_from_server(filename, connection,
+                                                  offset))
+                # The server's FIN was answered, rather than the server giving
+                # up on the client
+                counters = server.metrics.counters
+                self.assertEqual(1, counters["connections"])
+                self.assertEqual(0, counters["abandoned_connections"])
+
+
+if __name__ == '__main__':
+    unittest.main()
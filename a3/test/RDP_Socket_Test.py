@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+
+from a3.src.RDP_Protocol import *
+from a3.src.RDP_Socket import DatagramSocket, bind_socket, mmsg_available, \
+    parse_address, wrap_socket
+
+LOOPBACK_ADR = ('127.0.0.1', 0)
+TEST_TIMEOUT = 5
+
+
+def _make_socket(**kwargs):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(LOOPBACK_ADR)
+    return DatagramSocket(sock, **kwargs)
+
+
+class DatagramSocketTest(unittest.TestCase):
+    use_mmsg = True
+
+    def setUp(self) -> None:
+        self.sock = _make_socket(ring_size=4, use_mmsg=self.use_mmsg)
+        self.sock.settimeout(TEST_TIMEOUT)
+        self.adr = self.sock.getsockname()
+
+    def tearDown(self) -> None:
+        self.sock.close()
+
+    def test_getsockname_is_cached(self):
+        self.assertEqual(self.sock.sock.getsockname(), self.adr)
+
+    def test_send_and_receive(self):
+        self.sock.sendto(b"hello", self.adr)
+        data, src = self.sock.recvfrom(MAX_PACKET_SIZE)
+        self.assertEqual(b"hello", data)
+        self.assertEqual(self.adr, src)
+
+    def test_timeout(self):
+        self.sock.settimeout(0.05)
+        self.assertRaises(socket.timeout, self.sock.recvfrom)
+
+    def test_queue_and_flush_preserves_order(self):
+        # More datagrams than ring slots exercises both batch boundaries.
+        payloads = [bytes([i]) * (i + 1) for i in range(10)]
+        for payload in payloads:
+            self.sock.queue(payload, self.adr)
+        self.sock.flush()
+
+        received = [self.sock.recvfrom()[0] for _ in payloads]
+        self.assertEqual(payloads, received)
+
+    def test_drains_ready_datagrams_in_one_wakeup(self):
+        for i in range(3):
+            self.sock.sendto(bytes([i]), self.adr)
+
+        # Wait until the kernel has queued all three
+        time.sleep(0.05)
+        self.sock.recvfrom()
+        self.assertEqual(2, self.sock.pending())
+
+    def test_protocol_functions(self):
+        message = create_app_message(3, 4, b"payload")
+        send_message(self.sock, message, self.adr)
+        result = try_read_message(self.sock, TEST_TIMEOUT)
+        self.assertEqual(message, result)
+        self.assertEqual(self.adr, result.src_adr)
+
+
+@unittest.skipUnless(mmsg_available(), "recvmmsg/sendmmsg unavailable")
+class FallbackDatagramSocketTest(DatagramSocketTest):
+    use_mmsg = False
+
+
+class WrapSocketTest(unittest.TestCase):
+
+    def test_wrap_is_idempotent(self):
+        with _make_socket() as sock:
+            self.assertIs(sock, wrap_socket(sock))
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "AF_UNIX unavailable")
+class UnixSocketTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "rdp.sock")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_parse_address(self):
+        self.assertEqual("/tmp/rdp.sock", parse_address("unix:/tmp/rdp.sock"))
+        self.assertEqual(("127.0.0.1", 80), parse_address("127.0.0.1", 80))
+        self.assertRaises(ValueError, parse_address, "127.0.0.1")
+
+    def test_large_packets(self):
+        with wrap_socket(bind_socket(self.path)) as server, \
+                wrap_socket(bind_socket("")) as client:
+            self.assertEqual(UNIX_MAX_PACKET_SIZE, packet_size_of(server))
+            server.settimeout(TEST_TIMEOUT)
+            client.settimeout(TEST_TIMEOUT)
+
+            payload = os.urandom(UNIX_MAX_PACKET_SIZE - HEADER_SIZE - CRC_SIZE)
+            message = create_app_message(3, 4, payload, FLAG_CRC)
+            send_message(client, message, self.path)
+            result = try_read_message(server, TEST_TIMEOUT)
+            self.assertEqual(payload, bytes(result.payload))
+
+            # The client is reachable at its autobound address
+            send_message(server, create_ack_message(4, 3), result.src_adr)
+            self.assertEqual(3, try_read_message(client, TEST_TIMEOUT).ack_no)
+
+    def test_replaces_stale_socket_file(self):
+        bind_socket(self.path).close()  # Leaves the file behind
+        with bind_socket(self.path) as sock:
+            self.assertEqual(self.path, sock.getsockname())
+            # A path in use is not taken over
+            self.assertRaises(OSError, bind_socket, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from a3.src.RDP_Client import RDPSession
+from a3.src.RDP_Supervisor import Supervisor
+
+LOOPBACK_ADR = ("127.0.0.1", 0)
+TIMEOUT = 5
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "needs SO_REUSEPORT")
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "file")
+        self.content = os.urandom(5000)
+        with open(self.path, "wb") as f:
+            f.write(self.content)
+
+        self.supervisor = Supervisor(LOOPBACK_ADR, workers=2,
+                                     stats_interval=0.1)
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.supervisor.serve,
+                                       args=(ready,), daemon=True)
+        self.thread.start()
+        self.assertTrue(ready.wait(TIMEOUT))
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.thread.join(TIMEOUT)
+        self.directory.cleanup()
+
+    def _fetch(self, count):
+        for _ in range(count):
+            with RDPSession(self.supervisor.adr) as session:
+                self.assertEqual(self.content, session.get(self.path))
+
+    def _wait_for(self, predicate):
+        deadline = time.monotonic() + TIMEOUT
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def _connections(self):
+        return self.supervisor.metrics().counters["connections"]
+
+    def test_serves_and_aggregates(self):
+        self._fetch(4)
+        self._wait_for(lambda: self._connections() == 4)
+
+    def test_restarts_dead_worker(self):
+        self._fetch(4)
+        self._wait_for(lambda: self._connections() == 4)
+
+        pids = [worker.process.pid for worker in self.supervisor.workers]
+        self.supervisor.workers[0].process.kill()
+        self._wait_for(lambda: self.supervisor.restarts == 1)
+        # Until the replacement is serving, the workers are changing and
+        # clients may be moved between them part way through a transfer
+        self.assertTrue(self.supervisor.workers[0].ready.wait(TIMEOUT))
+        self.assertNotEqual(pids[0], self.supervisor.workers[0].process.pid)
+        self.assertEqual(pids[1], self.supervisor.workers[1].process.pid)
+
+        # The replaced worker's totals are kept
+        self.assertEqual(4, self._connections())
+        self.assertEqual(
+            1, self.supervisor.metrics().counters["worker_restarts"])
+        self._fetch(2)
+        self._wait_for(lambda: self._connections() == 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
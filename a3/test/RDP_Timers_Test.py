@@ -0,0 +1,96 @@
+import unittest
+
+from a3.src.RDP_Timers import TimerWheel
+
+
+class FakeClock:
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=0.01, slot_count=16, clock=self.clock)
+        self.fired = []
+
+    def _schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def test_fires_in_deadline_order_only_once_due(self):
+        self._schedule(0.5, "b")
+        self._schedule(0.1, "a")
+
+        self.clock.now += 0.05
+        self.assertEqual(0, self.wheel.advance())
+
+        self.clock.now += 0.06
+        self.wheel.advance()
+        self.assertEqual(["a"], self.fired)
+
+        self.clock.now += 1
+        self.wheel.advance()
+        self.assertEqual(["a", "b"], self.fired)
+        self.assertEqual(0, len(self.wheel))
+
+    def test_cancel(self):
+        timer = self._schedule(0.1, "a")
+        self.assertTrue(timer.is_active())
+        self.wheel.cancel(timer)
+        self.assertFalse(timer.is_active())
+
+        self.clock.now += 1
+        self.wheel.advance()
+        self.assertEqual([], self.fired)
+
+        # Cancelling twice, or cancelling None, is harmless
+        self.wheel.cancel(timer)
+        self.wheel.cancel(None)
+
+    def test_timers_beyond_one_revolution(self):
+        # 16 slots of 10ms is a 160ms revolution
+        self._schedule(0.5, "late")
+        self._schedule(0.02, "early")
+
+        self.assertAlmostEqual(self.clock.now + 0.02,
+                               self.wheel.next_deadline())
+
+        for _ in range(60):
+            self.clock.now += 0.01
+            self.wheel.advance()
+            if self.clock.now < 1000.49:
+                self.assertNotIn("late", self.fired)
+
+        self.assertEqual(["early", "late"], self.fired)
+
+    def test_time_until_next(self):
+        self.assertIsNone(self.wheel.time_until_next())
+        self._schedule(0.25, "a")
+        wait = self.wheel.time_until_next()
+        self.assertGreaterEqual(wait, 0.25)
+        self.assertLess(wait, 0.25 + self.wheel.tick)
+
+        # Waiting for the returned time is enough for the timer to fire
+        self.clock.now += wait
+        self.assertEqual(1, self.wheel.advance())
+
+    def test_reschedule(self):
+        timer = self._schedule(0.1, "a")
+        self.clock.now += 0.05
+        timer = self.wheel.reschedule(timer, 0.1)
+
+        self.clock.now += 0.07
+        self.wheel.advance()
+        self.assertEqual([], self.fired)
+
+        self.clock.now += 0.05
+        self.wheel.advance()
+        self.assertEqual(["a"], self.fired)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from a3.src import RDP_Trace
+from a3.src.RDP_Protocol import *
+from a3.src.RDP_Trace import PacketTrace, RECEIVED, SENT
+
+
+class PacketTraceTest(unittest.TestCase):
+
+    def test_record_and_decode(self):
+        trace = PacketTrace(capacity=8)
+        trace.record(SENT, message_to_bytes(create_syn_message(7)))
+        trace.record(RECEIVED, message_to_bytes(
+            create_app_message(1, 7, b"x" * 300)))
+
+        syn, app = trace.events()
+        self.assertEqual((SENT, "SYN", 7, None, 0),
+                         (syn.direction, syn.packet_type, syn.seq_no,
+                          syn.ack_no, syn.payload_len))
+        self.assertEqual((RECEIVED, "APP", 1, 7, 300),
+                         (app.direction, app.packet_type, app.seq_no,
+                          app.ack_no, app.payload_len))
+        self.assertLessEqual(syn.timestamp, app.timestamp)
+
+    def test_ring_keeps_most_recent(self):
+        trace = PacketTrace(capacity=4)
+        for seq in range(10):
+            trace.record(SENT, message_to_bytes(create_ack_message(seq, 0)))
+
+        self.assertEqual(4, len(trace))
+        self.assertEqual([6, 7, 8, 9], [e.seq_no for e in trace.events()])
+
+    def test_dump_and_load(self):
+        trace = PacketTrace(capacity=4)
+        for seq in range(6):
+            trace.record(SENT, message_to_bytes(create_fin_message(seq, 1)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.bin")
+            trace.dump(path)
+            events = RDP_Trace.load(path)
+
+        self.assertEqual(trace.events(), events)
+        timeline = RDP_Trace.format_timeline(events).splitlines()
+        self.assertEqual(4, len(timeline))
+        self.assertIn("FIN", timeline[0])
+
+    def test_protocol_functions_are_traced(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            message = create_app_message(42, 3, b"hi")
+            send_message(sock, message, sock.getsockname())
+            try_read_message(sock, 5)
+
+        sent, received = RDP_Trace.TRACE.events()[-2:]
+        self.assertEqual((SENT, 42), (sent.direction, sent.seq_no))
+        self.assertEqual((RECEIVED, 42), (received.direction, received.seq_no))
+
+
+if __name__ == '__main__':
+    unittest.main()